@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""Benchmark the extraction pipeline in regs_common.extraction against a fixed corpus.
+
+Run from the regscrape directory:
+
+    python benchmarks/extraction.py generate [--corpus DIR]
+    python benchmarks/extraction.py run [--corpus DIR] [--modes serial,gevent,mp] [--out FILE]
+    python benchmarks/extraction.py compare OLD.json NEW.json
+
+"generate" writes a synthetic corpus: text PDFs, image-only ("scanned") PDFs,
+DOCX, RTF and HTML at a few sizes, all built in Python so the corpus is the
+same everywhere. DOC and WordPerfect files can't be written without the
+programs that make them, so DOC files are made with soffice if it's around,
+and otherwise (and for WordPerfect) drop real samples into the corpus
+directory and list them in its manifest.json.
+
+"run" pushes the whole corpus through serial_bulk_extract, bulk_extract
+and mp_bulk_extract, each in a fresh process so peak RSS means something,
+and reports files and bytes per second, peak RSS, and latency per
+extractor. Results are saved as JSON under benchmarks/results/ for
+"compare" to diff against later runs.
+
+The extraction cache and adaptive extractor ordering are switched off, so
+every run does the same work and nothing touches the database."""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import zipfile
+import datetime
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+DEFAULT_CORPUS = os.path.join(BENCHMARK_DIR, 'corpus')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+MODES = ('serial', 'gevent', 'mp')
+SIZES = {'small': 1, 'medium': 10, 'large': 100}
+SCANNED_PAGES = {1: 1, 10: 3, 100: 10}
+
+WORDS = ('the proposed rule would require agencies to consider public comments on '
+    'environmental financial and health impacts before final action is taken by the '
+    'commission and its staff in accordance with applicable law').split()
+
+def _lines(page, count=40, seed=0):
+    rng = random.Random(page * 1000 + seed)
+    return [' '.join(rng.choice(WORDS) for i in range(12)) for line in range(count)]
+
+# corpus generation
+
+def make_pdf(path, pages, scanned=False):
+    """A minimal PDF, with either a text layer or just a noisy greyscale image on each page."""
+    objects = []
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    page_tree = add(None)
+    font = add('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+
+    page_ids = []
+    for page in range(pages):
+        if scanned:
+            width, height = 612, 792
+            rng = random.Random(page)
+            pixels = ''.join(chr(rng.choice((0, 255, 255, 255))) for i in range(width * height / 16))
+            data = zlib.compress(pixels * 16)
+            image = add('<< /Type /XObject /Subtype /Image /Width %s /Height %s /ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode /Length %s >>\nstream\n%s\nendstream' % (width, height, len(data), data))
+            content = 'q %s 0 0 %s 0 0 cm /Im0 Do Q' % (width, height)
+            resources = '<< /XObject << /Im0 %s 0 R >> >>' % image
+        else:
+            text = ' '.join('(%s) Tj T*' % line for line in _lines(page))
+            content = 'BT /F1 10 Tf 12 TL 50 760 Td %s ET' % text
+            resources = '<< /Font << /F1 %s 0 R >> >>' % font
+
+        stream = add('<< /Length %s >>\nstream\n%s\nendstream' % (len(content), content))
+        page_ids.append(add('<< /Type /Page /Parent %s 0 R /MediaBox [0 0 612 792] /Resources %s /Contents %s 0 R >>' % (page_tree, resources, stream)))
+
+    objects[catalog - 1] = '<< /Type /Catalog /Pages %s 0 R >>' % page_tree
+    objects[page_tree - 1] = '<< /Type /Pages /Kids [%s] /Count %s >>' % (' '.join('%s 0 R' % i for i in page_ids), len(page_ids))
+
+    out = ['%PDF-1.4\n']
+    offsets = []
+    position = len(out[0])
+    for number, body in enumerate(objects, 1):
+        chunk = '%s 0 obj\n%s\nendobj\n' % (number, body)
+        offsets.append(position)
+        out.append(chunk)
+        position += len(chunk)
+
+    out.append('xref\n0 %s\n0000000000 65535 f \n' % (len(objects) + 1))
+    out.extend('%010d 00000 n \n' % offset for offset in offsets)
+    out.append('trailer\n<< /Size %s /Root %s 0 R >>\nstartxref\n%s\n%%%%EOF\n' % (len(objects) + 1, catalog, position))
+
+    f = open(path, 'wb')
+    f.write(''.join(out))
+    f.close()
+
+def make_docx(path, pages):
+    paragraphs = ''.join(
+        '<w:p><w:r><w:t>%s</w:t></w:r></w:p>' % line
+        for page in range(pages) for line in _lines(page)
+    )
+    archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    archive.writestr('[Content_Types].xml', '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"><Default Extension="xml" ContentType="application/xml"/><Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>')
+    archive.writestr('word/document.xml', '<?xml version="1.0" encoding="UTF-8"?><w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>%s</w:body></w:document>' % paragraphs)
+    archive.close()
+
+def make_rtf(path, pages):
+    body = '\n'.join('%s\\par' % line for page in range(pages) for line in _lines(page))
+    f = open(path, 'w')
+    f.write('{\\rtf1\\ansi\\deff0 {\\fonttbl {\\f0 Times New Roman;}}\n\\f0\\fs24 %s\n}' % body)
+    f.close()
+
+def make_html(path, pages):
+    body = '\n'.join('<p>%s</p>' % line for page in range(pages) for line in _lines(page))
+    f = open(path, 'w')
+    f.write('<!DOCTYPE html><html><head><title>Comment</title></head><body>%s</body></html>' % body)
+    f.close()
+
+def generate(corpus):
+    if not os.path.exists(corpus):
+        os.makedirs(corpus)
+
+    manifest_path = os.path.join(corpus, 'manifest.json')
+    manifest = json.load(open(manifest_path)) if os.path.exists(manifest_path) else {}
+
+    makers = [
+        ('text_pdf', 'pdf', 'pdf', lambda path, pages: make_pdf(path, pages)),
+        # OCR is slow enough that scanned documents get fewer pages
+        ('scanned_pdf', 'pdf', 'xpdf', lambda path, pages: make_pdf(path, SCANNED_PAGES.get(pages, pages), scanned=True)),
+        ('docx', 'docx', 'msw12', make_docx),
+        ('rtf', 'rtf', 'rtf', make_rtf),
+        ('html', 'html', 'html', make_html),
+    ]
+    for label, size in sorted(SIZES.items(), key=lambda item: item[1]):
+        for kind, extension, filetype, maker in makers:
+            name = '%s-%s.%s' % (kind, label, extension)
+            maker(os.path.join(corpus, name), size)
+            manifest[name] = filetype
+
+        # doc files we can only get by converting
+        rtf_name = 'rtf-%s.rtf' % label
+        try:
+            subprocess.check_call(['soffice', '--headless', '--convert-to', 'doc', '--outdir', corpus, os.path.join(corpus, rtf_name)], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+            doc_name = 'doc-%s.doc' % label
+            os.rename(os.path.join(corpus, rtf_name.replace('.rtf', '.doc')), os.path.join(corpus, doc_name))
+            manifest[doc_name] = 'msw8'
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    json.dump(manifest, open(manifest_path, 'w'), indent=1, sort_keys=True)
+
+    missing = set(['msw8', 'wp8']) - set(manifest.values())
+    print 'Wrote %s files to %s.' % (len(manifest), corpus)
+    if missing:
+        print 'No samples of %s; add real files to the corpus and list them in manifest.json to cover them.' % ', '.join(sorted(missing))
+
+# running
+
+def load_corpus(corpus):
+    manifest = json.load(open(os.path.join(corpus, 'manifest.json')))
+    return [(os.path.join(corpus, name), filetype) for name, filetype in sorted(manifest.items())]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run_mode(mode, corpus, timings_path):
+    """Run one mode in this process and return its numbers; meant to be run in a fresh process."""
+    if mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+    import resource
+    import settings
+    settings.EXTRACTION_CACHE = False
+    settings.ADAPTIVE_EXTRACTORS = False
+
+    from regs_common import extraction
+
+    # time every extractor; workers may be separate processes, so each one appends to a shared file
+    def timed(extractor):
+        def wrapper(filename):
+            start = time.time()
+            succeeded = False
+            try:
+                output = extractor(filename)
+                succeeded = True
+                return output
+            finally:
+                out = open(timings_path, 'a')
+                out.write(json.dumps([extractor.__str__(), time.time() - start, succeeded]) + '\n')
+                out.close()
+        wrapper.__str__ = extractor.__str__
+        wrapper.output_type = getattr(extractor, 'output_type', 'text')
+        wrapper.ocr = getattr(extractor, 'ocr', False)
+        return wrapper
+
+    wrapped = {}
+    for filetype, chain in extraction.EXTRACTORS.items():
+        extraction.EXTRACTORS[filetype] = [wrapped.setdefault(id(extractor), timed(extractor)) for extractor in chain]
+
+    files = load_corpus(corpus)
+    results = {'succeeded': 0, 'failed': 0, 'text_bytes': 0}
+    def status_func(status, text, filename, filetype, output_type, used_ocr, record):
+        if status[0]:
+            results['succeeded'] += 1
+            results['text_bytes'] += text.size
+            text.remove()
+        else:
+            results['failed'] += 1
+
+    run = {
+        'serial': extraction.serial_bulk_extract,
+        'gevent': extraction.bulk_extract,
+        'mp': extraction.mp_bulk_extract
+    }[mode]
+
+    start = time.time()
+    run(((filename, filetype, None) for filename, filetype in files), status_func)
+    elapsed = time.time() - start
+
+    input_bytes = sum(os.path.getsize(filename) for filename, filetype in files)
+    results.update({
+        'files': len(files),
+        'input_bytes': input_bytes,
+        'seconds': elapsed,
+        'files_per_second': len(files) / elapsed,
+        'bytes_per_second': input_bytes / elapsed,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_children_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    })
+    return results
+
+def summarize_timings(timings_path):
+    by_extractor = {}
+    if os.path.exists(timings_path):
+        for line in open(timings_path):
+            name, seconds, succeeded = json.loads(line)
+            by_extractor.setdefault(name, []).append((seconds, succeeded))
+
+    out = {}
+    for name, runs in by_extractor.items():
+        seconds = [run[0] for run in runs]
+        out[name] = {
+            'calls': len(runs),
+            'failures': len([run for run in runs if not run[1]]),
+            'mean': sum(seconds) / len(seconds),
+            'p50': percentile(seconds, 0.5),
+            'p95': percentile(seconds, 0.95)
+        }
+    return out
+
+def run(corpus, modes, out_path):
+    import tempfile
+
+    report = {'started': datetime.datetime.now().isoformat(), 'corpus': corpus, 'files': len(load_corpus(corpus)), 'modes': {}}
+    for mode in modes:
+        fd, timings_path = tempfile.mkstemp(prefix='extraction-timings-')
+        os.close(fd)
+
+        print 'Running %s...' % mode
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '_mode', mode, corpus, timings_path], stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            print 'The %s run failed.' % mode
+            continue
+
+        # the numbers are the last line; anything before that is extraction chatter
+        result = json.loads(output.strip().split('\n')[-1])
+        result['extractors'] = summarize_timings(timings_path)
+        os.unlink(timings_path)
+        report['modes'][mode] = result
+
+        print '  %(files)s files in %(seconds).1fs: %(files_per_second).2f files/s, %(bytes_per_second).0f bytes/s, peak RSS %(peak_rss_kb)s KB (children %(peak_children_rss_kb)s KB)' % result
+        for name, stats in sorted(result['extractors'].items()):
+            print '    %-20s %5s calls %4s failed  mean %.3fs  p50 %.3fs  p95 %.3fs' % (name, stats['calls'], stats['failures'], stats['mean'], stats['p50'], stats['p95'])
+
+    if not out_path:
+        if not os.path.exists(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        out_path = os.path.join(RESULTS_DIR, 'extraction-%s.json' % datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+    json.dump(report, open(out_path, 'w'), indent=1, sort_keys=True)
+    print 'Saved results to %s.' % out_path
+
+def compare(old_path, new_path):
+    old, new = json.load(open(old_path)), json.load(open(new_path))
+    for mode in sorted(set(old['modes']) & set(new['modes'])):
+        before, after = old['modes'][mode], new['modes'][mode]
+        print '%s: %.2f -> %.2f files/s (%+.0f%%), peak RSS %s -> %s KB' % (
+            mode,
+            before['files_per_second'],
+            after['files_per_second'],
+            (after['files_per_second'] / before['files_per_second'] - 1) * 100,
+            before['peak_rss_kb'],
+            after['peak_rss_kb']
+        )
+        for name in sorted(set(before['extractors']) & set(after['extractors'])):
+            print '    %-20s mean %.3fs -> %.3fs' % (name, before['extractors'][name]['mean'], after['extractors'][name]['mean'])
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog generate|run|compare [options]')
+    parser.add_option('-c', '--corpus', dest='corpus', default=DEFAULT_CORPUS, help='Corpus directory.')
+    parser.add_option('-m', '--modes', dest='modes', default=','.join(MODES), help='Comma-separated modes to run: %s.' % ', '.join(MODES))
+    parser.add_option('-o', '--out', dest='out', default=None, help='Where to save the results.')
+    options, args = parser.parse_args()
+
+    if not args:
+        parser.error('Specify generate, run or compare.')
+    elif args[0] == 'generate':
+        generate(options.corpus)
+    elif args[0] == 'run':
+        if not os.path.exists(os.path.join(options.corpus, 'manifest.json')):
+            generate(options.corpus)
+        run(options.corpus, [mode for mode in options.modes.split(',') if mode in MODES], options.out)
+    elif args[0] == 'compare' and len(args) == 3:
+        compare(args[1], args[2])
+    elif args[0] == '_mode':
+        # internal: one mode, in its own process
+        print json.dumps(run_mode(args[1], args[2], args[3]))
+    else:
+        parser.error('Unknown command.')
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Compare the old regex-based html_is_empty with the single-pass scanner in
+regs_common.htmlscan, on synthetic pdftohtml output of increasing size.
+
+Run from the regscrape directory:  python benchmarks/html_scan.py [pages ...]"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from regs_common.htmlscan import html_has_text
+
+# the implementation this replaced
+_tag_stripper = re.compile(r'<[^>]*?>')
+_body_finder = re.compile(r"<body[^>]*>(.*)</body>", re.I | re.DOTALL)
+_outline_finder = re.compile(r'<a name="outline"></a>\s*<h1>Document Outline</h1>\s*<ul>.*</ul>', re.I | re.DOTALL)
+def regex_is_empty(text):
+    body = _body_finder.findall(text)
+    if not body:
+        return True
+    without_outline = _outline_finder.sub("", body[0])
+    return not _tag_stripper.sub('', without_outline).strip()
+
+def scanner_is_empty(text):
+    return not html_has_text(text)
+
+def pdftohtml_output(pages, with_text=True):
+    """Something shaped like pdftohtml -noframes -i output: an outline, then the pages."""
+    out = ['<!DOCTYPE html><html><head><title>doc</title></head>\n<body bgcolor="#A0A0A0" vlink="blue" link="blue">\n']
+    out.append('<a name="outline"></a><h1>Document Outline</h1>\n<ul>')
+    for page in range(1, pages + 1):
+        out.append('<li><a href="#%s">Section %s</a></li>\n' % (page, page))
+    out.append('</ul><hr>\n')
+    for page in range(1, pages + 1):
+        out.append('<a name=%s></a>' % page)
+        for line in range(40):
+            if with_text:
+                out.append('Comment text on page %s, line %s, about the proposed rule.<br>\n' % (page, line))
+            else:
+                out.append('<b></b>&#160;<br>\n'.replace('&#160;', ' '))
+        out.append('<hr>\n')
+    out.append('</body>\n</html>\n')
+    return ''.join(out)
+
+def best_of(func, text, runs=3):
+    timings = []
+    for i in range(runs):
+        start = time.time()
+        result = func(text)
+        timings.append(time.time() - start)
+    return min(timings), result
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 5000]
+
+    print '%8s %6s %10s %12s %12s %8s' % ('pages', 'text', 'size (MB)', 'regex (s)', 'scanner (s)', 'agree')
+    for pages in sizes:
+        for with_text in (True, False):
+            text = pdftohtml_output(pages, with_text)
+            regex_time, regex_result = best_of(regex_is_empty, text)
+            scanner_time, scanner_result = best_of(scanner_is_empty, text)
+            print '%8s %6s %10.1f %12.4f %12.4f %8s' % (pages, with_text, len(text) / 1048576.0, regex_time, scanner_time, regex_result == scanner_result)
@@ -3,33 +3,47 @@ import pymongo
 import json
 import sys
 import os
-import subprocess
-import time
 import signal
 import datetime
 
-DEFAULT_SEQUENCE = [
-    'rdg_dump_api',
-    'rdg_parse_api',
-    'rdg_scrape',
-    'rdg_download',
-    'extract',
-    'create_dockets',
-    'rdg_scrape_dockets',
-    'add_to_search',
-    'run_aggregates'    
-]
+from regs_common.scheduler import Scheduler
+from regs_common.supervisor import Supervisor
+
 OVERRIDE_SEQUENCES = {}
 FLAGS = {
     'scrape': ['-m', '8'],
-    'scrape_dockets': ['-m', '8']
+    'scrape_dockets': ['-m', '8'],
+    'extract_slow': ['--slow'],
+}
+
+# stages that run a command under another name, with different flags
+COMMANDS = {
+    'extract_slow': 'extract',
 }
 
-running = {}
+# optionally extract as files arrive, so the extract stage only has stragglers to pick up; off by
+# default, since it means forking extraction workers from the (gevent-patched) download process
+if getattr(settings, 'PIPELINE_STREAMING_EXTRACTION', False):
+    FLAGS['rdg_download'] = ['--extract']
+
+# if a worker daemon is running (./run.py worker_daemon), send commands through it so they start warm
+WORKER_SOCKET = getattr(settings, 'PIPELINE_WORKER_SOCKET', None)
+
+# how often to print a heartbeat when nothing is happening
+HEARTBEAT = 60
+
+scheduler = Scheduler(overrides=OVERRIDE_SEQUENCES)
+
+# children are keyed by (agency, command)
+supervisor = Supervisor()
 
 db = pymongo.Connection(**settings.DB_SETTINGS)[settings.DB_NAME]
 pid = os.getpid()
 
+# identifies this run in the stage history, for run-over-run comparisons (see ./run.py pipeline_report)
+run_id = datetime.datetime.now()
+db.pipeline_runs.ensure_index([('agency', 1), ('command', 1), ('run', -1)])
+
 enabled = True
 def sigint_handler(signum, frame):
     global enabled
@@ -43,58 +57,66 @@ def preexec_function():
     # signal handler SIG_IGN.
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-# start by resetting failures
+# start by resetting failures, along with everything downstream of them
 for agency_record in db.pipeline.find():
-    sequence = OVERRIDE_SEQUENCES.get(agency_record['_id'], DEFAULT_SEQUENCE)
     completed = agency_record['completed']
-    failed_idxs = [i for i in xrange(len(sequence)) if sequence[i] in completed and type(completed[sequence[i]]) != dict]
-    if failed_idxs:
-        print "Resetting everything for agency %s after command %s" % (agency_record['_id'], sequence[failed_idxs[0]])
-        for command in sequence[failed_idxs[0]:]:
-            if command in completed:
-                print "Resetting %s" % command
-                del completed[command]
+    to_reset = scheduler.stages_to_reset(agency_record['_id'], completed)
+    if to_reset:
+        print "Resetting everything for agency %s that depends on a failed command" % agency_record['_id']
+        for command in to_reset:
+            print "Resetting %s" % command
+            del completed[command]
         db.pipeline.update({'_id': agency_record['_id']}, {'$set': {'completed': completed}}, safe=True)
 
+changed = True
 while True:
     now = str(datetime.datetime.now())
-    print "[%s] TICK %s" % (now, pid)
-
-    # book-keep already started processes
-    for command, info in running.items():
-        agency, proc = info
-        if proc.poll() is not None:
-            print "[%s] %s has finished command %s" % (now, agency, command)
-            results = proc.stdout.read()
-            try:
-                parsed = json.loads(results)
-            except ValueError:
-                parsed = "parse_failure"
-
-            db.pipeline.update({'_id': agency}, {'$set': {('completed.' + command): parsed}}, safe=True)
-            del running[command]
-
-    # start up new ones as necessary, assuming we're still going
-    if enabled:
-        for agency_record in db.pipeline.find().sort('count'):
-            agency = agency_record['_id']
-
-            sequence = OVERRIDE_SEQUENCES.get(agency, DEFAULT_SEQUENCE)
-            completed = agency_record['completed'].keys()
-            to_do = [command for command in sequence if command not in completed]
-
-            if not to_do:
-                continue
-
-            next = to_do[0]
-            if next not in running:
-                full_command = [sys.executable, './run.py', next] + FLAGS.get(next, []) + ['-a', agency, '--parsable']
-                proc = subprocess.Popen(full_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=preexec_function)
-                running[next] = (agency, proc)
-                print '[%s] %s has started command %s' % (now, agency, next)
-
-    if not running.keys():
+
+    # start up new ones as necessary, assuming we're still going; the pipeline collection only
+    # changes when one of our children finishes, so there's no point rescanning it otherwise
+    if enabled and changed:
+        agency_records = list(db.pipeline.find().sort('count'))
+        for agency, command in scheduler.next_tasks(agency_records, supervisor.children):
+            full_command = [sys.executable, './run.py'] + (['--worker=' + WORKER_SOCKET] if WORKER_SOCKET else []) + [COMMANDS.get(command, command)] + FLAGS.get(command, []) + ['-a', agency, '--parsable']
+            supervisor.spawn((agency, command), full_command, preexec_fn=preexec_function)
+            print '[%s] %s has started command %s' % (now, agency, command)
+    changed = False
+
+    if not len(supervisor):
         print 'Nothing left to do; exiting.'
         break
 
-    time.sleep(1)
\ No newline at end of file
+    finished = supervisor.wait(HEARTBEAT)
+    now = str(datetime.datetime.now())
+    if not finished:
+        print "[%s] TICK %s (%s running)" % (now, pid, len(supervisor))
+
+    # book-keep finished processes
+    for child in finished:
+        agency, command = child.key
+        print "[%s] %s has finished command %s" % (now, agency, command)
+        try:
+            parsed = json.loads(child.stdout)
+        except ValueError:
+            parsed = "parse_failure"
+            if child.stderr:
+                print "[%s] stderr from %s %s:\n%s" % (now, agency, command, child.stderr.strip()[-2000:])
+
+        # the supervisor knows when the stage really started and stopped; the child knows what it did
+        stage_metrics = parsed.pop('metrics', {}) if type(parsed) is dict else {}
+        duration = (child.finished - child.started).total_seconds()
+        stage_metrics.update({
+            'started': child.started,
+            'finished': child.finished,
+            'duration': duration,
+            'returncode': child.returncode,
+            'succeeded': type(parsed) is dict
+        })
+        if child.rusage:
+            stage_metrics['peak_rss_kb'] = max(child.rusage.ru_maxrss, stage_metrics.get('peak_rss_kb', 0))
+        if stage_metrics.get('items') is not None:
+            stage_metrics['items_per_second'] = stage_metrics['items'] / duration if duration > 0 else None
+
+        db.pipeline.update({'_id': agency}, {'$set': {('completed.' + command): parsed, ('metrics.' + command): stage_metrics}}, safe=True)
+        db.pipeline_runs.insert(dict(stage_metrics, agency=agency, command=command, run=run_id), safe=True)
+        changed = True
@@ -0,0 +1,200 @@
+"""Content-addressed storage for downloaded files.
+
+Each downloaded file is stored once per distinct content, under the SHA-1
+of its bytes, in BLOB_DIR/ab/cd/<sha1>. Form letters and re-posted
+attachments that show up at many URLs therefore only take up space once.
+Files are compressed with zstd (if the zstandard module is installed) or
+gzip, and get a matching .zst or .gz suffix. A file that doesn't shrink by
+at least BLOB_MIN_SAVING is kept as it is, which is usually the case for
+PDFs and docx files that are compressed already.
+
+A view's file_path points straight at its blob. Nothing that reads a
+file_path has to care whether it's a blob or an old-style download:
+open_file() decompresses as it reads, and local_file() gives extractors a
+real uncompressed file when they need one.
+
+db.blobs counts how many views point at each blob. The blob_gc command
+deletes blobs that nothing has pointed at for a while, and can rebuild
+the counts from the views themselves if they drift. A downloader counts
+its reference before calling put(), so that blob_gc can't delete a blob
+between put() finding it and the view being saved."""
+
+import os
+import re
+import gzip
+import shutil
+import hashlib
+import tempfile
+import datetime
+import settings
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+SUFFIXES = {'zstd': '.zst', 'gzip': '.gz', None: ''}
+COPY_CHUNK = 1024 * 1024
+
+_blob_name = re.compile(r'^([0-9a-f]{40})(\.zst|\.gz)?$')
+
+def is_enabled():
+    return getattr(settings, 'BLOB_STORE', True)
+
+def blob_dir():
+    return getattr(settings, 'BLOB_DIR', os.path.join(settings.DOWNLOAD_DIR, 'blobs'))
+
+def compression():
+    method = getattr(settings, 'BLOB_COMPRESSION', 'zstd' if HAS_ZSTD else 'gzip')
+    if method == 'zstd' and not HAS_ZSTD:
+        method = 'gzip'
+    return method
+
+def _db():
+    from regs_models import Doc
+    return Doc._get_db()
+
+def _parse(path):
+    """The digest and compression of a blob path, or (None, None) for anything else."""
+    if not path or not os.path.abspath(path).startswith(os.path.abspath(blob_dir()) + os.sep):
+        return None, None
+    match = _blob_name.match(os.path.basename(path))
+    if not match:
+        return None, None
+    return match.group(1), {'.zst': 'zstd', '.gz': 'gzip'}.get(match.group(2))
+
+def digest_of(path):
+    """The SHA-1 of a blob's (uncompressed) contents, which is in its name, or None if it isn't a blob."""
+    return _parse(path)[0]
+
+def _paths(digest):
+    directory = os.path.join(blob_dir(), digest[:2], digest[2:4])
+    return directory, [os.path.join(directory, digest + suffix) for suffix in ('.zst', '.gz', '')]
+
+def find(digest):
+    directory, candidates = _paths(digest)
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    for chunk in iter(lambda: f.read(COPY_CHUNK), ''):
+        digest.update(chunk)
+    f.close()
+    return digest.hexdigest()
+
+def _compress(source, out, method):
+    if method == 'zstd':
+        zstandard.ZstdCompressor(level=getattr(settings, 'BLOB_ZSTD_LEVEL', 3)).copy_stream(source, out)
+    else:
+        gz = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=getattr(settings, 'BLOB_GZIP_LEVEL', 6))
+        shutil.copyfileobj(source, gz, COPY_CHUNK)
+        gz.close()
+
+def put(path, digest=None):
+    """Move a file into the store (or, if its contents are already there, just
+    delete it), and return the path of its blob. The caller should already
+    have called add_ref() with the file's digest."""
+    digest = digest if digest else file_digest(path)
+    existing = find(digest)
+    if existing:
+        try:
+            # freshen it, so a blob_gc --recount that's walking the disk right now leaves it be
+            os.utime(existing, None)
+            os.unlink(path)
+            return existing
+        except OSError:
+            # blob_gc got to it first, so ours will have to do instead
+            pass
+
+    directory, candidates = _paths(digest)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another downloader may have just made it
+            if not os.path.isdir(directory):
+                raise
+
+    method = compression()
+    if method:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            out = os.fdopen(fd, 'wb')
+            source = open(path, 'rb')
+            _compress(source, out, method)
+            source.close()
+            out.close()
+
+            # not worth it for things that were already compressed
+            if os.path.getsize(tmp_path) <= os.path.getsize(path) * (1 - getattr(settings, 'BLOB_MIN_SAVING', 0.1)):
+                blob_path = os.path.join(directory, digest + SUFFIXES[method])
+                os.rename(tmp_path, blob_path)
+                os.unlink(path)
+                return blob_path
+            os.unlink(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    blob_path = os.path.join(directory, digest)
+    shutil.move(path, blob_path)
+    return blob_path
+
+def open_file(path):
+    """Open a file_path for reading, decompressing it on the way if it's a compressed blob."""
+    digest, method = _parse(path)
+    if method == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    elif method == 'gzip':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def copy_out(path, output_file):
+    """Write a file_path's (uncompressed) contents to output_file; returns the size."""
+    source = open_file(path)
+    out = open(output_file, 'wb')
+    size = 0
+    for chunk in iter(lambda: source.read(COPY_CHUNK), ''):
+        out.write(chunk)
+        size += len(chunk)
+    out.close()
+    source.close()
+    return size
+
+def local_file(path):
+    """A real, uncompressed file with a file_path's contents, for tools that need a
+    filename, plus a function to call when done with it."""
+    digest, method = _parse(path)
+    if not method:
+        return path, lambda: None
+
+    fd, tmp_path = tempfile.mkstemp(prefix='blob-', dir=getattr(settings, 'EXTRACTION_SPOOL_DIR', None))
+    os.close(fd)
+    try:
+        copy_out(path, tmp_path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+    def cleanup():
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+    return tmp_path, cleanup
+
+# reference counts, by digest
+
+def add_ref(digest, db=None):
+    db = db if db else _db()
+    db.blobs.update({'_id': digest}, {'$inc': {'refs': 1}, '$set': {'updated': datetime.datetime.now()}}, upsert=True)
+
+def release(digest, db=None):
+    db = db if db else _db()
+    db.blobs.update({'_id': digest}, {'$inc': {'refs': -1}, '$set': {'updated': datetime.datetime.now()}})
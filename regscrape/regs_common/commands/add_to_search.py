@@ -7,6 +7,7 @@ arg_parser.add_option("-d", "--docket", dest="docket", action="store", type="str
 arg_parser.add_option("-A", "--all", dest="process_all", action="store_true", default=False, help="Replace existing search data with new data.")
 
 from regs_models import *
+from regs_common.normalize import view_text
 import urllib2, json, traceback, datetime, zlib, pymongo, pytz, itertools
 import rawes, requests, thrift
 
@@ -112,7 +113,7 @@ def add_to_search(options, args):
                 "object_id": doc.object_id,
                 "file_type": view.type,
                 "view_type": "document_view",
-                "text": view.as_text()[:100000],
+                "text": view_text(view)[:100000],
                 "entities": view.entities
             })
 
@@ -127,7 +128,7 @@ def add_to_search(options, args):
                     "object_id": attachment.object_id,
                     "file_type": view.type,
                     "view_type": "attachment_view",
-                    "text": view.as_text()[:100000],
+                    "text": view_text(view)[:100000],
                     "entities": view.entities
                 })
 
@@ -4,6 +4,7 @@ GEVENT = False
 
 from regs_common.exceptions import *
 from regs_models import *
+from regs_common.normalize import view_text
 from optparse import OptionParser
 
 import json, urllib, urllib2, os, re, datetime
@@ -24,8 +25,7 @@ NUMBER = re.compile("^(\d+)$")
 THREE_MONTHS = datetime.timedelta(days=90)
 
 def fr_citation_from_view(view):
-    view_text = view.as_text()
-    lines = view_text.split("\n")
+    lines = view_text(view).split("\n")
 
     # look for a page header
     header_match = [HEADER_MATCHER.match(l) for l in lines]
@@ -0,0 +1,32 @@
+"""Store plain-text copies of HTML views extracted before they got one."""
+
+GEVENT = False
+
+from optparse import OptionParser
+arg_parser = OptionParser()
+arg_parser.add_option("-a", "--agency", dest="agency", action="store", type="string", default=None, help="Specify an agency to which to limit the backfill.")
+arg_parser.add_option("-d", "--docket", dest="docket", action="store", type="string", default=None, help="Specify a docket to which to limit the backfill.")
+
+def run(options, args):
+    from regs_common.processing import find_views, find_attachment_views
+    from regs_common.normalize import backfill
+
+    query = {'deleted': False}
+    if options.agency:
+        query['agency'] = options.agency
+    if options.docket:
+        query['docket_id'] = options.docket
+
+    stats = {}
+    for label, find_func in (('document_views', find_views), ('attachment_views', find_attachment_views)):
+        print 'Backfilling plain text for %s.' % label.replace('_', ' ')
+        stats[label] = {'stored': 0, 'skipped': 0}
+        views = find_func(extracted="yes", mode="html", query=query, checkpoint='backfill_plain_text:%s:%s:%s' % (find_func.__name__, options.agency, options.docket))
+        for result in views:
+            if backfill(result['view']):
+                stats[label]['stored'] += 1
+            else:
+                stats[label]['skipped'] += 1
+        print 'Stored %s.' % stats[label]['stored']
+
+    return stats
@@ -0,0 +1,113 @@
+"""Delete downloaded blobs that no view points at any more."""
+
+GEVENT = False
+
+from optparse import OptionParser
+arg_parser = OptionParser()
+arg_parser.add_option("-r", "--recount", dest="recount", action="store_true", default=False, help="Rebuild the reference counts from the views first, and clean up blobs that were never counted.")
+arg_parser.add_option("-g", "--grace", dest="grace", action="store", type="float", default=24, help="Only delete blobs that have been unreferenced for at least this many hours.")
+arg_parser.add_option("-n", "--dry-run", dest="dry_run", action="store_true", default=False, help="Report what would be deleted without deleting anything.")
+
+def count_refs(db):
+    """How many views point at each blob, going by the views themselves."""
+    from regs_common import blob_store
+
+    counts = {}
+    for doc in db.docs.find({}, fields=['views.file_path', 'attachments.views.file_path']):
+        views = list(doc.get('views', []))
+        for attachment in doc.get('attachments', []):
+            views.extend(attachment.get('views', []))
+
+        for view in views:
+            digest = blob_store.digest_of(view.get('file_path'))
+            if digest:
+                counts[digest] = counts.get(digest, 0) + 1
+    return counts
+
+def run(options, args):
+    import os, time, datetime
+    from regs_common import blob_store
+    from regs_models import Doc
+
+    db = Doc._get_db()
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=options.grace)
+    stats = {'deleted': 0, 'bytes_freed': 0, 'recounted': 0}
+
+    def discard(digest, path):
+        """Delete a blob's file, unless a reference to it turns up while we're at it."""
+        size = os.path.getsize(path)
+        if not options.dry_run:
+            # move it aside first, so a downloader that counts a reference from here on finds it gone
+            # and stores its own copy, and then put it back if one counted a reference in the meantime
+            tombstone = os.path.join(os.path.dirname(path), '.gc-' + os.path.basename(path))
+            os.rename(path, tombstone)
+            if db.blobs.find_one({'_id': digest}, fields=['_id']):
+                if os.path.exists(path):
+                    os.unlink(tombstone)
+                else:
+                    os.rename(tombstone, path)
+                return
+            os.unlink(tombstone)
+        stats['bytes_freed'] += size
+        stats['deleted'] += 1
+
+    def delete(digest):
+        if options.dry_run:
+            path = blob_store.find(digest)
+            if path:
+                discard(digest, path)
+            return
+
+        # claim the row first, so that a downloader reusing the blob at the same moment either
+        # keeps it from being claimed (by counting its reference first) or sees it go
+        if not db.blobs.find_and_modify({'_id': digest, 'refs': {'$lte': 0}, 'updated': {'$lt': cutoff}}, remove=True):
+            return
+        path = blob_store.find(digest)
+        if path:
+            try:
+                discard(digest, path)
+            except OSError:
+                # somebody else's gc got there first
+                pass
+
+    if options.recount:
+        print 'Counting references...'
+        counts = count_refs(db)
+        now = datetime.datetime.now()
+        for row in db.blobs.find({}, fields=['refs']):
+            refs = counts.get(row['_id'], 0)
+            if refs != row.get('refs'):
+                stats['recounted'] += 1
+                if not options.dry_run:
+                    db.blobs.update({'_id': row['_id']}, {'$set': {'refs': refs, 'updated': now}})
+
+        known = set(row['_id'] for row in db.blobs.find({}, fields=['_id']))
+        for digest in set(counts) - known:
+            stats['recounted'] += 1
+            if not options.dry_run:
+                db.blobs.update({'_id': digest}, {'$set': {'refs': counts[digest], 'updated': now}}, upsert=True)
+
+        # blobs on disk that never made it into db.blobs, say because a download died between storing and counting
+        for root, dirs, files in os.walk(blob_store.blob_dir()):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.getmtime(path) > time.mktime(cutoff.timetuple()):
+                    continue
+                digest = blob_store.digest_of(path)
+                if name.startswith('.tmp-') or name.startswith('.gc-'):
+                    stats['bytes_freed'] += os.path.getsize(path)
+                    if not options.dry_run:
+                        os.unlink(path)
+                    stats['deleted'] += 1
+                elif digest and digest not in known and digest not in counts:
+                    try:
+                        discard(digest, path)
+                    except OSError:
+                        pass
+
+    print 'Deleting unreferenced blobs...'
+    for row in db.blobs.find({'refs': {'$lte': 0}, 'updated': {'$lt': cutoff}}, fields=['_id']):
+        delete(row['_id'])
+
+    print '%s %s blobs (%s MB)%s.' % ('Would delete' if options.dry_run else 'Deleted', stats['deleted'], stats['bytes_freed'] / (1024 * 1024), '; fixed %s reference counts' % stats['recounted'] if options.recount else '')
+    return stats
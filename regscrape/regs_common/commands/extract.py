@@ -10,18 +10,25 @@ arg_parser = OptionParser()
 arg_parser.add_option("-t", "--type", action="store", dest="type", default=None)
 arg_parser.add_option("-a", "--agency", dest="agency", action="store", type="string", default=None, help="Specify an agency to which to limit the dump.")
 arg_parser.add_option("-d", "--docket", dest="docket", action="store", type="string", default=None, help="Specify a docket to which to limit the dump.")
+arg_parser.add_option("-s", "--slow", dest="slow", action="store_true", default=False, help="Retry views whose extraction timed out, with longer timeouts and fewer workers.")
+arg_parser.add_option("-q", "--queue", dest="queue", action="store_true", default=False, help="Claim views from the view_tasks queue (see queue_views) instead of scanning all documents.")
 
 # runner
 def run(options, args): 
-    global Pool, sys, settings, subprocess, os, urlparse, json, regs_common, pymongo, mp_bulk_extract
-    from regs_common.processing import find_views, update_view, find_attachment_views, update_attachment_view
-    from regs_common.extraction import mp_bulk_extract
+    global Pool, sys, settings, subprocess, os, urlparse, json, regs_common, pymongo, mp_bulk_extract, view_status_func, view_save_error_func, view_tasks, ViewUpdateBatcher
+    from regs_common.processing import find_views, update_view, find_attachment_views, update_attachment_view, ViewUpdateBatcher
+    from regs_common.extraction import mp_bulk_extract, view_status_func, view_save_error_func
+    from regs_common import view_tasks
     from gevent.pool import Pool
     import sys
     import settings
     import subprocess, os, urlparse, json
     import pymongo
 
+    if options.slow:
+        # the slow lane: only timed-out views, with a lot more time each, a few at a time
+        settings.EXTRACTION_TIMEOUT_FACTOR = getattr(settings, 'EXTRACTION_SLOW_FACTOR', 10)
+
     return {
         'document_views': run_for_view_type('document views', find_views, update_view, options),
         'attachment_views': run_for_view_type('attachment views', find_attachment_views, update_attachment_view, options)
@@ -38,7 +45,7 @@ def run_for_view_type(view_label, find_func, update_func, options):
 
     find_conditions = {
         'downloaded': "yes",
-        'extracted': "no",
+        'extracted': "failed_timeout" if options.slow else "no",
         'query': query
     }
     if options.type:
@@ -47,7 +54,13 @@ def run_for_view_type(view_label, find_func, update_func, options):
     # track stats -- no locks because yay for cooperative multitasking
     stats = {'extracted': 0, 'failed': 0}
 
-    views = find_func(**find_conditions)
+    def get_views():
+        if options.queue and not options.slow:
+            # claim work from the shared task queue instead of scanning documents
+            is_pending = lambda view: view.downloaded == "yes" and view.extracted == "no"
+            return view_tasks.claimed_views('extract', agency=options.agency, docket_id=options.docket, attachments=find_func.__name__ == 'find_attachment_views', view_type=options.type, is_pending=is_pending)
+        return find_func(checkpoint='extract:%s:%s:%s:%s:%s' % (find_func.__name__, options.agency, options.docket, options.type, 'slow' if options.slow else 'normal'), **find_conditions)
+    views = get_views()
 
     # same yucky hack as in downloads
     v_array = [views]
@@ -55,44 +68,29 @@ def run_for_view_type(view_label, find_func, update_func, options):
         while True:
             try:
                 result = v_array[0].next()
-                yield (result['view'].file_path, None, result)
+                # blobs are named after their contents, so the type has to come from the view
+                yield (result['view'].file_path, result['view'].type, result)
             except pymongo.errors.OperationFailure:
                 # occasionally pymongo seems to lose track of the cursor for some reason, so reset the query
-                v_array[0] = find_func(**find_conditions)
+                v_array[0] = get_views()
                 continue
             except StopIteration:
                 break
 
-    def status_func(status, text, filename, filetype, output_type, used_ocr, result):
-        if status[0]:
-            result['view'].extracted = "yes"
-
-            result['view'].content.new_file()
-            result['view'].content.content_type = 'text/plain'
-            result['view'].content.write(text.encode('utf-8'))
-            result['view'].content.close()
-
-            result['view'].mode = output_type
-            result['view'].ocr = used_ocr
-            try:
-                update_func(**result)
-                print 'Extracted and saved text from %s' % filename
-                stats['extracted'] += 1
-            except (pymongo.errors.OperationFailure, pymongo.errors.InvalidDocument):
-                print 'Extracted text from %s but failed to save due to oversized document.' % filename
-                stats['failed'] += 1
-                
-                if not 'oversized' in stats:
-                    stats['oversized'] = []
-                stats['oversized'].append(result['view'].url())
-        else:
-            result['view'].extracted = 'failed_no_extractor' if 'no extractor' in status[1] else 'failed_extraction'
-            update_func(**result)
-            print 'Saved failure to decode %s' % result['view'].file_path
-            stats['failed'] += 1
-        update_func(**result)
+    # results are saved by this process as the workers send them back, so they can be batched;
+    # the batcher's methods are named after the unbatched functions they replace
+    batcher = ViewUpdateBatcher(on_flush=view_tasks.completer('extract', lambda view: view.extracted == "yes") if options.queue else None, on_error=view_save_error_func(stats))
+    status_func = view_status_func(getattr(batcher, update_func.__name__), stats)
     
-    mp_bulk_extract(extract_generator(), status_func, verbose=True)
+    def on_wait():
+        batcher.flush_if_due()
+        if options.queue:
+            view_tasks.keep_alive()
+
+    mp_bulk_extract(extract_generator(), status_func, verbose=True, num_workers=getattr(settings, 'EXTRACTION_SLOW_WORKERS', 1) if options.slow else None, on_wait=on_wait)
+    batcher.close()
+    if batcher.errors:
+        stats['write_errors'] = batcher.errors
 
     print 'Done with %s.' % view_label
     
@@ -2,6 +2,7 @@ GEVENT = False
 
 import zlib
 import datetime
+import time
 import settings
 
 import pymongo
@@ -10,7 +11,10 @@ import os
 import re
 import multiprocessing
 from Queue import Empty
+from regs_common.profiling import profiled
+from regs_common import metrics
 from regs_models import *
+from regs_common.normalize import view_text
 
 from oxtail.matching import match
 
@@ -26,10 +30,8 @@ arg_parser.add_option("-m", "--multi", dest="multi", action="store", type="int",
 NAME_FINDER = re.compile(r"^(public )?(comment|submission)s? (by|from) (?P<name>.*)$", re.I)
 
 def get_text(view):
-    if not view.content:
-        return ''
-    
-    return view.content.read()
+    # the stored plain text, so HTML views don't get their markup matched against
+    return view_text(view).encode('utf-8')
 
 def process_doc(doc):
     # entity extraction
@@ -87,6 +89,7 @@ def process_worker(todo_queue):
             print '[%s] Processing complete.' % pid
             return
         
+        start = time.time()
         try:
             doc_success = process_doc(doc)
             print '[%s] Processing of doc %s succeeded.' % (pid, doc.id)
@@ -94,6 +97,7 @@ def process_worker(todo_queue):
             print '[%s] Processing of doc %s failed.' % (pid, doc.id)
             traceback.print_exc()
         
+        metrics.observe(time.time() - start)
         todo_queue.task_done()
 
 def run(options, args):
@@ -127,7 +131,7 @@ def run(options, args):
     
     processes = []
     for i in range(num_workers):
-        proc = multiprocessing.Process(target=process_worker, args=(todo_queue,))
+        proc = multiprocessing.Process(target=profiled(process_worker), args=(todo_queue,))
         proc.start()
         processes.append(proc)
     
@@ -0,0 +1,90 @@
+GEVENT = False
+
+import settings
+
+from optparse import OptionParser
+arg_parser = OptionParser()
+arg_parser.add_option("-a", "--agency", dest="agency", action="store", type="string", default=None, help="Limit the report to one agency.")
+arg_parser.add_option("-n", "--history", dest="history", action="store", type="int", default=5, help="Number of previous runs to compare the latest one against.")
+arg_parser.add_option("-t", "--threshold", dest="threshold", action="store", type="float", default=1.5, help="Flag stages that are this many times slower than their usual speed.")
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) / 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def critical_path(stages, graph):
+    """Work backwards from the stage that finished last, each time following
+    the dependency that finished latest, since that's the one that held it up."""
+    if not stages:
+        return []
+
+    current = max(stages.values(), key=lambda stage: stage['finished'])
+    path = [current]
+    while True:
+        deps = [stages[dep] for dep in graph.get(current['command'], []) if dep in stages]
+        if not deps:
+            break
+        current = max(deps, key=lambda stage: stage['finished'])
+        path.append(current)
+    return list(reversed(path))
+
+def seconds_per_item(stage):
+    # compare rates where we can, so a stage isn't flagged just for having had more to do
+    if stage.get('items'):
+        return stage['duration'] / float(stage['items'])
+    return stage['duration']
+
+def run(options, args):
+    import pymongo
+    from regs_common.scheduler import Scheduler
+
+    db = pymongo.Connection(**settings.DB_SETTINGS)[settings.DB_NAME]
+    scheduler = Scheduler()
+
+    conditions = {}
+    if options.agency:
+        conditions['agency'] = options.agency
+
+    latest_run = db.pipeline_runs.find(conditions).sort('run', -1).limit(1)
+    latest_run = list(latest_run)
+    if not latest_run:
+        print 'No pipeline runs have been recorded.'
+        return {'agencies': 0, 'regressions': []}
+    run_id = latest_run[0]['run']
+
+    by_agency = {}
+    for stage in db.pipeline_runs.find(dict(conditions, run=run_id)):
+        by_agency.setdefault(stage['agency'], {})[stage['command']] = stage
+
+    print 'Pipeline run of %s' % run_id
+    regressions = []
+    for agency in sorted(by_agency.keys()):
+        stages = by_agency[agency]
+        path = critical_path(stages, scheduler.graph_for(agency))
+        wall = (path[-1]['finished'] - path[0]['started']).total_seconds()
+
+        print ''
+        print '%s: %s stages, critical path %.0f seconds' % (agency, len(stages), wall)
+        for stage in path:
+            print '    %-20s %8.0fs  %8s items  %s/s' % (
+                stage['command'],
+                stage['duration'],
+                stage.get('items', '--'),
+                '%.2f' % stage['items_per_second'] if stage.get('items_per_second') else '--'
+            )
+
+        for command, stage in sorted(stages.items()):
+            previous = db.pipeline_runs.find({'agency': agency, 'command': command, 'run': {'$lt': run_id}, 'succeeded': True}).sort('run', -1).limit(options.history)
+            usual = median([seconds_per_item(p) for p in previous])
+            if not usual:
+                continue
+
+            ratio = seconds_per_item(stage) / usual
+            if ratio >= options.threshold:
+                print '    REGRESSION: %s is %.1fx slower than the median of its last %s runs' % (command, ratio, options.history)
+                regressions.append({'agency': agency, 'command': command, 'ratio': ratio})
+
+    return {'agencies': len(by_agency), 'regressions': regressions}
@@ -0,0 +1,33 @@
+"""Queue up pending views in db.view_tasks for rdg_download/extract --queue."""
+
+GEVENT = False
+
+from optparse import OptionParser
+arg_parser = OptionParser()
+arg_parser.add_option("-s", "--stage", dest="stage", action="store", type="choice", choices=['download', 'extract'], default="download", help="Which stage to queue views for (download or extract).")
+arg_parser.add_option("-a", "--agency", dest="agency", action="store", type="string", default=None, help="Specify an agency to which to limit the queueing.")
+arg_parser.add_option("-d", "--docket", dest="docket", action="store", type="string", default=None, help="Specify a docket to which to limit the queueing.")
+
+def run(options, args):
+    from regs_common.processing import find_views, find_attachment_views
+    from regs_common import view_tasks
+
+    query = {'deleted': False}
+    if options.agency:
+        query['agency'] = options.agency
+    if options.docket:
+        query['docket_id'] = options.docket
+
+    # same conditions the commands themselves use when they scan
+    if options.stage == 'download':
+        find_conditions = {'downloaded': "no", 'query': query}
+    else:
+        find_conditions = {'downloaded': "yes", 'extracted': "no", 'query': query}
+
+    stats = {}
+    for label, find_func in (('document_views', find_views), ('attachment_views', find_attachment_views)):
+        print 'Queueing %s for %s.' % (label.replace('_', ' '), options.stage)
+        stats[label] = view_tasks.populate(options.stage, find_func, find_conditions)
+        print 'Queued %s.' % stats[label]
+
+    return stats
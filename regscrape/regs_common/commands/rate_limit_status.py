@@ -0,0 +1,28 @@
+"""Show how full each host's shared rate-limit bucket is."""
+
+GEVENT = False
+
+from optparse import OptionParser
+arg_parser = OptionParser()
+arg_parser.add_option("-r", "--reset", dest="reset", action="store_true", default=False, help="Clear any backoff and refill the buckets.")
+
+def run(options, args):
+    from regs_common import rate_limit
+
+    levels = []
+    for host in sorted(rate_limit.limits()):
+        limiter = rate_limit.for_host(host)
+        if options.reset:
+            limiter.reset()
+
+        level = limiter.level()
+        print '%s: %.1f of %s tokens, refilling at %.2f/s%s' % (
+            host,
+            level['tokens'],
+            level['capacity'],
+            level['rate'],
+            '; backed off %s times, next request in %ds' % (level['strikes'], level['wait']) if level['wait'] else ''
+        )
+        levels.append(level)
+
+    return {'buckets': levels}
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
 def run():
-    global os, settings
-    from regs_common.processing import find_views, update_view, find_attachment_views, update_attachment_view
+    global os, settings, ViewUpdateBatcher
+    from regs_common.processing import find_views, update_view, find_attachment_views, update_attachment_view, ViewUpdateBatcher
     import os
     import settings
 
@@ -13,9 +13,14 @@ def run_for_view_type(view_label, find_func, update_func):
     print 'Resetting %s.' % view_label
     views = find_func(extracted='failed', query={'deleted': False})
     
+    # the batcher's methods are named after the unbatched functions they replace
+    batcher = ViewUpdateBatcher()
+    update_func = getattr(batcher, update_func.__name__)
+
     for result in views:
         result['view'].extracted = 'no'
         update_func(**result)
+    batcher.close()
     
     print 'Done with %s.' % view_label
 
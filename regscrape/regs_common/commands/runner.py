@@ -2,11 +2,28 @@
 
 import sys, optparse, json, settings
 
-def run_command():    
-    if len(sys.argv) < 2:
-        print 'Usage: ./run.py <command>'
+def run_command(argv=None):
+    argv = argv if argv is not None else sys.argv
+    
+    # hand the whole command off to a warm worker daemon if asked to
+    if len(argv) > 1 and argv[1].startswith('--worker='):
+        from regs_common.worker import submit
+        sys.exit(submit(argv[1].split('=', 1)[1], argv[2:]))
+    
+    if len(argv) < 2 or argv[1] in ('-h', '--help'):
+        print 'Usage: ./run.py [--worker=<socket>] <command> [options]'
+        print '       ./run.py --list'
+        print 'Run ./run.py <command> --help for help with a specific command.'
+        sys.exit()
+    command = argv[1]
+    
+    if command == '--list':
+        from regs_common.registry import load_registry
+        registry = load_registry()
+        for name in sorted(registry.keys()):
+            info = registry[name]
+            print '%-30s %s%s' % (name, info['module'], ' - %s' % info['description'] if info['description'] else '')
         sys.exit()
-    command = sys.argv[1]
     
     if command.endswith('.py'):
         mod_name = command.split('/').pop().rsplit('.', 1)[0]
@@ -16,26 +33,25 @@ def run_command():
         except ImportError:
             print 'Could not load custom command: %s' % command
             sys.exit()
+        
+        if getattr(mod, 'GEVENT', True):
+            from gevent.monkey import patch_all
+            patch_all()
     else:
-        imported = False
-        for lib in ['regs_common'] + settings.SITES:
-            try:
-                parent_mod = __import__('%s.commands' % lib, fromlist=[command])
-                mod = getattr(parent_mod, command)
-                imported = True
-                break
-            except ImportError:
-                pass
-            except AttributeError:
-                pass
-        if not imported:
+        from regs_common.registry import load_registry
+        registry = load_registry()
+        if command not in registry:
             print 'No such command: %s' % command
             sys.exit()
+        
+        # we know ahead of time whether the command wants gevent, so patch before importing it
+        if registry[command]['gevent']:
+            from gevent.monkey import patch_all
+            patch_all()
+        
+        import importlib
+        mod = importlib.import_module(registry[command]['module'])
     
-    if getattr(mod, 'GEVENT', True):
-        from gevent.monkey import patch_all
-        patch_all()
-
     run = getattr(mod, 'run', False)
     if not run or not callable(run):
         print 'Command %s is not runnable' % command
@@ -47,7 +63,8 @@ def run_command():
     if not parser:
         parser = optparse.OptionParser()
     parser.add_option('--parsable', dest='parsable', action='store_true', default=False, help='Output JSON instead of human-readable messages.')
-    parse_results = parser.parse_args(sys.argv[2:])
+    parser.add_option('--profile', dest='profile', action='store', type='choice', choices=['cpu', 'wall', 'mem'], default=None, help='Profile the command (cpu, wall or mem) and write the results to settings.PROFILE_DIR.')
+    parse_results = parser.parse_args(argv[2:])
     
     dev_null = open('/dev/null', 'w')
     if parse_results[0].parsable:
@@ -58,8 +75,27 @@ def run_command():
     from regs_common.util import bootstrap_settings
     bootstrap_settings()
     
+    from regs_common import metrics
+    metrics.start()
+    
+    profiler = None
+    if parse_results[0].profile:
+        from regs_common import profiling
+        agency = getattr(parse_results[0], 'agency', None)
+        profiling.configure(parse_results[0].profile, command.split('/').pop().rsplit('.', 1)[0] + ('-%s' % agency if agency else ''))
+        profiler = profiling.start()
+    
     out = run(*(parse_results if parser_defined else []))
     
+    if profiler:
+        profile_paths = profiler.stop()
+        print 'Wrote profile to %s' % ', '.join(profile_paths)
+        if type(out) is dict:
+            out['profile'] = profile_paths
+    
+    if type(out) is dict:
+        out['metrics'] = metrics.summary(out)
+    
     if parse_results[0].parsable:
         # turn stdout back on so we can print output
         sys.stdout = real_stdout
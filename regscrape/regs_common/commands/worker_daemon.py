@@ -0,0 +1,14 @@
+GEVENT = False
+
+import os
+import settings
+
+from optparse import OptionParser
+arg_parser = OptionParser()
+arg_parser.add_option("-s", "--socket", dest="socket", action="store", type="string", default=None, help="Path of the unix socket to listen on (gevent commands get <socket>.gevent).  Defaults to settings.WORKER_SOCKET.")
+
+def run(options, args):
+    from regs_common.worker import serve
+
+    socket_path = options.socket if options.socket else getattr(settings, 'WORKER_SOCKET', os.path.join(settings.DATA_DIR, 'worker.sock'))
+    serve(socket_path)
@@ -0,0 +1,71 @@
+"""Resumable scans over big collections.
+
+A plain find() over db.docs can run for hours, and when the server loses
+track of the cursor partway through the only thing we used to be able to do
+was start over. resumable_find() instead walks the matching documents in _id
+order a bounded batch at a time, so a lost cursor only costs the batch it was
+in; and if it's given a checkpoint name it records how far it's got in
+db.checkpoints, so that a run that dies can pick up where it left off.
+
+Records are usually handed off to workers rather than processed in place,
+so the saved checkpoint lags a batch behind what's been yielded: by the time
+we're fetching batch n+2, batch n has almost certainly been dealt with.
+Resuming may therefore redo up to a couple of batches, but won't skip any."""
+
+import datetime
+import settings
+
+from pymongo.errors import OperationFailure
+
+BATCH_SIZE = 1000
+MAX_RETRIES = 5
+
+def _describe(conditions, fields):
+    # what's being scanned, so that a checkpoint from a different scan doesn't get picked up
+    return repr((sorted(conditions.items()), sorted(fields.items()) if isinstance(fields, dict) else fields))
+
+def resumable_find(collection, conditions, fields=None, checkpoint=None, batch_size=None):
+    """Generator equivalent of collection.find(conditions, fields), in _id order."""
+    batch_size = batch_size if batch_size else getattr(settings, 'SCAN_BATCH_SIZE', BATCH_SIZE)
+    checkpoints = collection.database.checkpoints
+    description = _describe(conditions, fields)
+
+    last_id = None
+    if checkpoint:
+        saved = checkpoints.find_one({'_id': checkpoint})
+        max_age = datetime.timedelta(seconds=getattr(settings, 'CHECKPOINT_MAX_AGE', 86400))
+        if saved and saved.get('description') == description and datetime.datetime.now() - saved['updated'] < max_age:
+            last_id = saved['last_id']
+            print 'Resuming scan %s after %s.' % (checkpoint, last_id)
+
+    previous_batch_end = None
+    failures = 0
+    while True:
+        query = dict(conditions)
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+
+        try:
+            batch = list(collection.find(query, fields).sort('_id', 1).limit(batch_size))
+        except OperationFailure:
+            failures += 1
+            if failures > MAX_RETRIES:
+                raise
+            print 'Lost the cursor for scan %s; picking back up after %s.' % (checkpoint or collection.name, last_id)
+            continue
+        failures = 0
+
+        if checkpoint and previous_batch_end is not None:
+            checkpoints.update({'_id': checkpoint}, {'$set': {'last_id': previous_batch_end, 'description': description, 'updated': datetime.datetime.now()}}, upsert=True)
+
+        if not batch:
+            break
+
+        previous_batch_end = last_id
+        for record in batch:
+            last_id = record['_id']
+            yield record
+
+    # finished cleanly, so the next scan should start from the top
+    if checkpoint:
+        checkpoints.remove({'_id': checkpoint})
@@ -10,10 +10,17 @@ def all_aliases():
         )
     )
 
-def load_trie_from_mongo():
+_trie_loaded = False
+def load_trie_from_mongo(reload=False):
+    global _trie_loaded
     from oxtail import matching
 
+    # a warm worker may already have built it
+    if _trie_loaded and not reload:
+        return
+
     matching._entity_trie = matching.build_token_trie(
         all_aliases(),
         matching._blacklist
-    )
\ No newline at end of file
+    )
+    _trie_loaded = True
\ No newline at end of file
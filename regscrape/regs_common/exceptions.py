@@ -8,4 +8,7 @@ class ChildTimeout(Exception):
     pass
 
 class RateLimitException(Exception):
+    pass
+
+class IncompleteDownload(Exception):
     pass
\ No newline at end of file
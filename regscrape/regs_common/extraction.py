@@ -1,11 +1,28 @@
 from regs_common.processing import *
+from regs_common import metrics
+from regs_common import extraction_cache
+from regs_common.ocr import pdf_ocr
+from regs_common.filetypes import sniff
+from regs_common.extractor_stats import get_stats
+from regs_common.normalize import store_plain_text
+from regs_common import blob_store
 import subprocess
+import traceback
 import settings
+import time
+import os
+
+# html2text is also a Python module, so use it in-process if we can
+try:
+    import html2text
+    HAS_HTML2TEXT = True
+except ImportError:
+    HAS_HTML2TEXT = False
 
 EXTRACTORS = {
     'xml': [
-        binary_extractor('cat', error='The document does not have a content file of type', output_type="html"),
-        binary_extractor('html2text', error='The document does not have a content file of type')
+        python_extractor(read_file, 'read_html', error='The document does not have a content file of type', output_type="html"),
+        python_extractor(html_to_text, 'html2text', error='The document does not have a content file of type') if HAS_HTML2TEXT else binary_extractor('html2text', error='The document does not have a content file of type')
     ],
         
     'pdf': [
@@ -24,11 +41,12 @@ EXTRACTORS = {
     ],
     
     'txt': [
-        binary_extractor('cat', error='The document does not have a content file of type') # not really an error, as above
+        python_extractor(read_file, 'read_text', error='The document does not have a content file of type') # not really an error, as above
     ],
     
     'msw12': [
-        script_extractor('extract_docx.py', error='Failed to decode file')
+        python_extractor(docx_text, 'docx', error='Failed to decode file'),
+        script_extractor('extract_docx.py', error='Failed to decode file') # in case the docx module copes with something we don't
     ],
     
     'wp8': [
@@ -42,19 +60,71 @@ EXTRACTORS['msw6'] = EXTRACTORS['msw8']
 EXTRACTORS['msw'] = EXTRACTORS['msw8']
 EXTRACTORS['xpdf'] = EXTRACTORS['pdf'] + [pdf_ocr]
 
+def chain_for(declared, sniffed):
+    """Pick the extractors to try for a file, most likely to succeed first."""
+    chain = list(EXTRACTORS.get(declared, []))
+    if sniffed and sniffed != declared and sniffed in EXTRACTORS:
+        # go by what the file actually is, but keep the declared type's extractors as fallbacks
+        chain = EXTRACTORS[sniffed] + [extractor for extractor in chain if extractor not in EXTRACTORS[sniffed]]
+
+        # each type's first extractor is the real one and the rest are last resorts (catdoc
+        # "succeeds" on anything), so only the real ones get reordered, and the rest stay last
+        stats = get_stats()
+        if stats:
+            primary = [EXTRACTORS[filetype][0] for filetype in (sniffed, declared) if EXTRACTORS.get(filetype)]
+            chain = stats.order(primary, declared, sniffed) + [extractor for extractor in chain if extractor not in primary]
+    return chain
+
 # extractor factory
-def _get_extractor(status_func, verbose, filename, filetype=None, record=None):
+def _get_extractor(status_func, verbose, filename, filetype=None, record=None, metric=None):
     def extract():
+        # compressed blobs get unpacked to a temporary file for the extractors' benefit
+        local_path, cleanup = blob_store.local_file(filename)
+        try:
+            extract_from(local_path)
+        finally:
+            cleanup()
+
+    def extract_from(local_path):
+        start = time.time()
         local_filetype = filetype if filetype else filename.split('.')[-1]
-        if local_filetype in EXTRACTORS:
+        sniffed = sniff(local_path)
+        chain = chain_for(local_filetype, sniffed)
+        if chain:
+            # identical files (form letters, mostly) only need extracting once
+            cache_key = None
+            if extraction_cache.is_enabled():
+                try:
+                    cache_key = extraction_cache.cache_key(filename, chain)
+                except IOError:
+                    pass
+            cached = extraction_cache.lookup(cache_key) if cache_key else None
+            if cached:
+                if verbose: print 'Reused cached extraction of %s' % filename
+                status_func(
+                    (cached['success'], cached['error']),
+                    cached.get('text'),
+                    filename,
+                    local_filetype,
+                    cached['output_type'],
+                    cached['ocr'],
+                    record
+                )
+                metrics.observe(time.time() - start, metric)
+                return
+
             success = False
             error_message = None
             used_ocr = False
             output_type = "text"
-            for extractor in EXTRACTORS[local_filetype]:
+            timed_out = None
+            used = None
+            stats = get_stats()
+            for extractor in chain:
                 try:
-                    output = extractor(filename)
+                    output = extractor(local_path)
                 except ExtractionFailed as failure:
+                    if stats: stats.record(local_filetype, sniffed, extractor.__str__(), False)
                     reason = str(failure)
                     error_message = 'Failed to extract from %s using %s%s' % (
                         filename,
@@ -69,12 +139,16 @@ def _get_extractor(status_func, verbose, filename, filetype=None, record=None):
                         extractor.__str__()
                     )
                     if verbose: print error_message
+                    if stats: stats.record(local_filetype, sniffed, extractor.__str__(), False)
+                    timed_out = error_message
                     continue
                 
+                if stats: stats.record(local_filetype, sniffed, extractor.__str__(), True)
                 success = True
-                text = unicode(remove_control_chars(output), 'utf-8', 'ignore')
+                used = extractor.__str__()
                 used_ocr = getattr(extractor, 'ocr', False)
                 output_type = getattr(extractor, 'output_type', 'text')
+                text = spool_string(output, output_type)
                 if verbose: print 'Extracted text from %s using %s' % (
                     filename,
                     extractor.__str__()
@@ -82,6 +156,15 @@ def _get_extractor(status_func, verbose, filename, filetype=None, record=None):
                 
                 break
 
+            # if anything timed out, more time might have helped, so say so (for the slow lane)
+            # rather than reporting whatever the last extractor said
+            if timed_out and not success:
+                error_message = timed_out
+
+            # a timeout might not happen next time, so don't remember failures that involved one
+            if cache_key and (success or not timed_out):
+                extraction_cache.store(cache_key, success, text if success else None, output_type, used_ocr, used, error_message)
+
             status_func(
                 (success, error_message),
                 text if success else None,
@@ -101,8 +184,78 @@ def _get_extractor(status_func, verbose, filename, filetype=None, record=None):
                 False,
                 record
             )
+
+        metrics.observe(time.time() - start, metric)
     return extract
 
+def view_status_func(update_func, stats, verbose=True):
+    """Build a status function that saves extracted text (or the failure to
+    extract it) back onto the view described by a find_views-style record."""
+    def status_func(status, text, filename, filetype, output_type, used_ocr, result):
+        if status[0]:
+            result['view'].extracted = "yes"
+
+            # text arrives spooled to disk, so stream it into GridFS rather than reading it all in
+            if text.truncated:
+                result['view'].content.new_file(truncated=True, truncated_at=text.size)
+            else:
+                result['view'].content.new_file()
+            result['view'].content.content_type = 'text/plain'
+            for chunk in text.chunks():
+                result['view'].content.write(chunk)
+            result['view'].content.close()
+
+            # and keep the plain text of HTML next to it, so nothing downstream has to work it out again
+            if output_type == 'html':
+                store_plain_text(result['view'], text.chunks())
+            text.remove()
+
+            result['view'].mode = output_type
+            result['view'].ocr = used_ocr
+        else:
+            if 'no extractor' in status[1]:
+                result['view'].extracted = 'failed_no_extractor'
+            elif 'due to timeout' in status[1]:
+                # these get another go later, with more time, from extract --slow (the extract_slow stage)
+                result['view'].extracted = 'failed_timeout'
+            else:
+                result['view'].extracted = 'failed_extraction'
+
+        # one write per view, whichever way it went; a ViewUpdateBatcher only queues it, and
+        # reports failed saves later to the callback from view_save_error_func
+        try:
+            update_func(**result)
+        except (OperationFailure, InvalidDocument) as e:
+            _count_save_error(stats, verbose, result, e)
+            return
+
+        if status[0]:
+            if verbose: print 'Extracted and saved text from %s' % filename
+            stats['extracted'] += 1
+        else:
+            if verbose: print 'Saved failure to decode %s' % result['view'].file_path
+            stats['failed'] += 1
+    return status_func
+
+def _count_save_error(stats, verbose, record, error):
+    oversized = isinstance(error, InvalidDocument) or 'too large' in str(error)
+    if verbose: print 'Extracted text from %s but failed to save%s.' % (record['view'].file_path, ' due to oversized document' if oversized else ': %s' % error)
+    stats['failed'] += 1
+
+    if oversized:
+        if not 'oversized' in stats:
+            stats['oversized'] = []
+        stats['oversized'].append(record['view'].url)
+
+def view_save_error_func(stats, verbose=True):
+    """Build an on_error callback for the ViewUpdateBatcher behind a
+    view_status_func, which counts views whose save failed as failures
+    rather than whatever they were counted as when they were queued."""
+    def on_error(record, error):
+        stats['extracted' if record['view'].extracted == "yes" else 'failed'] -= 1
+        _count_save_error(stats, verbose, record, error)
+    return on_error
+
 def bulk_extract(extract_iterable, status_func=None, verbose=False):
     from gevent.pool import Pool  
     workers = Pool(getattr(settings, 'EXTRACTORS', 2))
@@ -115,36 +268,157 @@ def bulk_extract(extract_iterable, status_func=None, verbose=False):
     
     return
 
-def mp_bulk_extract(extract_iterable, status_func=None, verbose=False):
-    import multiprocessing
-    from Queue import Empty
+class ExtractionPool(object):
+    """A set of extraction worker processes that can be fed one file at a time,
+    for callers that don't have all of their work up front.
+
+    Workers only extract; they send their results back over a bounded queue,
+    and status_func is called with them here in the parent, so saving text
+    and views happens over the parent's one database connection (and can be
+    batched by the caller). Shutdown is done with sentinels rather than by
+    killing the workers, so nothing in flight is lost. An extraction that
+    raises is reported as a failure, and a worker that dies anyway is
+    replaced.
+
+    If the caller is running under gevent, pass cooperative=True so that a full
+    queue makes the calling greenlet wait instead of blocking the whole hub.
+    on_wait, if given, is called whenever the pool waits on its workers, which
+    is the place to flush a batcher that status_func feeds. metric names the
+    metrics histogram extraction times go into, for commands whose own work
+    is something else."""
+
+    def __init__(self, status_func=None, verbose=False, num_workers=None, cooperative=False, on_wait=None, metric=None):
+        import multiprocessing
+        from regs_common.profiling import profiled
+
+        self.status_func = status_func
+        self.num_workers = num_workers if num_workers else getattr(settings, 'EXTRACTORS', multiprocessing.cpu_count())
+        self.cooperative = cooperative
+        self.on_wait = on_wait
+        self.todo_queue = multiprocessing.Queue(self.num_workers * 3)
+        self.result_queue = multiprocessing.Queue(self.num_workers * 3)
+        # pids of the workers that have said they're done
+        self.finished = set()
+        self.closing = False
+
+        # the histogram has to exist before the workers are forked
+        if metric:
+            metrics.track(metric)
+
+        def worker(todo_queue, result_queue):
+            while True:
+                extract_record = todo_queue.get()
+                if extract_record is None:
+                    # tell the parent we're done, then exit cleanly
+                    if get_stats():
+                        get_stats().flush()
+                    result_queue.put(os.getpid())
+                    return
+
+                sent = []
+                def send_result(*args):
+                    result_queue.put(args)
+                    sent.append(True)
+
+                try:
+                    _get_extractor(send_result, verbose, *extract_record, metric=metric)()
+                except Exception as e:
+                    # whatever went wrong, the parent still needs to hear how this file went
+                    traceback.print_exc()
+                    if not sent:
+                        filename, filetype, record = (tuple(extract_record) + (None, None))[:3]
+                        send_result((False, 'Failed to extract from %s: %s' % (filename, e)), None, filename, filetype, 'text', False, record)
+
+        def start_worker():
+            proc = multiprocessing.Process(target=profiled(worker), args=(self.todo_queue, self.result_queue))
+            proc.start()
+            return proc
+        self._start_worker = start_worker
+
+        self.processes = [start_worker() for i in range(self.num_workers)]
+
+    def _check_workers(self):
+        # a worker that died without saying it was done (killed, or crashed somewhere that
+        # couldn't be caught) took whatever it was working on with it, so replace it
+        for i, proc in enumerate(self.processes):
+            if not proc.is_alive() and proc.pid not in self.finished and not self.closing:
+                print 'Extraction worker %s died with exit code %s; starting another.' % (proc.pid, proc.exitcode)
+                proc.join()
+                self.processes[i] = self._start_worker()
+
+    def _live_workers(self):
+        return [proc for proc in self.processes if proc.is_alive() and proc.pid not in self.finished]
+
+    def _wait(self):
+        # give the workers a moment, without blocking everybody else if we're under gevent
+        if self.cooperative:
+            time.sleep(0.1)
+            self._drain_results()
+        else:
+            self._drain_results(timeout=0.1)
+        self._check_workers()
+        if self.on_wait:
+            self.on_wait()
+
+    def _drain_results(self, timeout=None):
+        """Hand any results that have come back to status_func; with a timeout,
+        wait that long for the first one."""
+        from Queue import Empty
 
-    num_workers = getattr(settings, 'EXTRACTORS', multiprocessing.cpu_count())
-    todo_queue = multiprocessing.JoinableQueue(num_workers * 3)
-    
-    def worker(todo_queue):
         while True:
             try:
-                extract_record = todo_queue.get()
+                if timeout:
+                    result = self.result_queue.get(True, timeout)
+                    timeout = None
+                else:
+                    result = self.result_queue.get(False)
             except Empty:
                 return
 
-            _get_extractor(status_func, verbose, *extract_record)()
-            todo_queue.task_done()
+            if type(result) is int:
+                self.finished.add(result)
+            elif self.status_func:
+                self.status_func(*result)
+
+    def _put(self, item):
+        from Queue import Full
+
+        while True:
+            try:
+                self.todo_queue.put(item, False)
+                break
+            except Full:
+                if self.closing and not self._live_workers():
+                    # nobody left to take it
+                    return
+                # the workers may be stuck waiting for us to take their results
+                self._wait()
+        self._drain_results()
+
+    def put(self, extract_record):
+        self._put(extract_record)
+
+    def close(self):
+        # one sentinel for each worker that's still around to take one
+        self.closing = True
+        for proc in self._live_workers():
+            self._put(None)
+
+        # and wait for each of them to either say it's done or die trying
+        while self._live_workers():
+            self._wait()
+        self._drain_results()
+
+        for proc in self.processes:
+            proc.join()
+
+def mp_bulk_extract(extract_iterable, status_func=None, verbose=False, num_workers=None, on_wait=None):
+    pool = ExtractionPool(status_func, verbose, num_workers=num_workers, on_wait=on_wait)
 
-    processes = []
-    for i in range(num_workers):
-        proc = multiprocessing.Process(target=worker, args=(todo_queue,))
-        proc.start()
-        processes.append(proc)
-    
     for extract_record in extract_iterable:
-        todo_queue.put(extract_record)
+        pool.put(extract_record)
 
-    todo_queue.join()
-    
-    for proc in processes:
-        proc.terminate()
+    pool.close()
 
     return
 
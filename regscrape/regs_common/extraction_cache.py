@@ -0,0 +1,116 @@
+"""On-disk cache of extraction results, keyed by what was extracted rather
+than by where it came from.
+
+Mass-comment campaigns produce thousands of byte-for-byte identical files,
+and there's no point running pdftohtml or antiword over every one of them.
+Entries are keyed by the SHA-1 of the file's contents plus a version string
+for the set of extractors that could be used on it, so changing a chain (or
+bumping CACHE_VERSION) makes the old entries unreachable rather than wrong.
+The order of the chain doesn't count, since it's adjusted as we go.
+
+Each entry is a gzipped text file plus a small JSON file with the output
+mode, whether OCR was used and so on; failures are cached too, so that an
+identical broken file isn't retried over and over. Both are written to a
+temporary name and renamed into place, so concurrent extraction workers
+never see half an entry."""
+
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+import settings
+
+# bump this when an extractor's behavior changes without its chain changing
+CACHE_VERSION = 1
+
+def is_enabled():
+    return getattr(settings, 'EXTRACTION_CACHE', True)
+
+def cache_dir():
+    return getattr(settings, 'EXTRACTION_CACHE_DIR', os.path.join(settings.DATA_DIR, 'extraction_cache'))
+
+def chain_version(chain):
+    return hashlib.md5('%s:%s' % (CACHE_VERSION, ','.join(sorted(extractor.__str__() for extractor in chain)))).hexdigest()[:8]
+
+def file_hash(filename):
+    digest = hashlib.sha1()
+    f = open(filename, 'rb')
+    while True:
+        chunk = f.read(1024 * 1024)
+        if not chunk:
+            break
+        digest.update(chunk)
+    f.close()
+    return digest.hexdigest()
+
+def cache_key(filename, chain):
+    from regs_common import blob_store
+    # blobs are named after the hash already, which saves reading the whole file
+    return '%s-%s' % (blob_store.digest_of(filename) or file_hash(filename), chain_version(chain))
+
+def _paths(key):
+    directory = os.path.join(cache_dir(), key[:2])
+    return directory, os.path.join(directory, key + '.txt.gz'), os.path.join(directory, key + '.json')
+
+def lookup(key):
+    """Return the cached result for a key (a dict with at least 'success', plus
+    'text' as SpooledText for successes), or None if there isn't one."""
+    from regs_common.processing import SpooledText, new_spool, SPOOL_CHUNK
+
+    directory, text_path, meta_path = _paths(key)
+    try:
+        meta = json.load(open(meta_path))
+        if meta['success']:
+            text_file = gzip.open(text_path, 'rb')
+            out, path = new_spool()
+            size = 0
+            while True:
+                chunk = text_file.read(SPOOL_CHUNK)
+                if not chunk:
+                    break
+                out.write(chunk)
+                size += len(chunk)
+            out.close()
+            text_file.close()
+            meta['text'] = SpooledText(path, size, meta.get('truncated', False))
+        return meta
+    except (IOError, ValueError, KeyError):
+        return None
+
+def _write_atomically(directory, path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        out = os.fdopen(fd, 'wb')
+        write(out)
+        out.close()
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def store(key, success, text=None, output_type="text", used_ocr=False, extractor=None, error=None):
+    directory, text_path, meta_path = _paths(key)
+    try:
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another worker may have just made it
+                if not os.path.isdir(directory):
+                    raise
+
+        if success:
+            def write_text(out):
+                gz = gzip.GzipFile(fileobj=out, mode='wb')
+                for chunk in text.chunks():
+                    gz.write(chunk)
+                gz.close()
+            _write_atomically(directory, text_path, write_text)
+
+        # the metadata goes last, since it's what makes the entry visible
+        meta = {'success': success, 'output_type': output_type, 'ocr': used_ocr, 'extractor': extractor, 'error': error, 'truncated': text.truncated if success else False}
+        _write_atomically(directory, meta_path, lambda out: json.dump(meta, out))
+    except (IOError, OSError) as e:
+        # a cache that can't be written to shouldn't stop extraction
+        print 'Failed to cache extraction result %s: %s' % (key, e)
@@ -0,0 +1,96 @@
+"""Success and failure counts for each extractor, broken down by the type a
+file was declared as and the type it was sniffed as, kept in db.extractor_stats
+and used to decide which type's extractor to try first when a file turns
+out not to be what it was declared as. Only each type's main extractor is
+reordered; the fallbacks stay at the end, since some of them (catdoc,
+pdftotext) almost never fail but produce worse text.
+
+Counts are accumulated in memory and added to the database in batches,
+since extraction workers see a lot of files. Workers flush what they have
+when they're told to exit, and each process re-reads the totals every
+REFRESH seconds."""
+
+import time
+import settings
+
+FLUSH_EVERY = 50
+FLUSH_AGE = 30
+REFRESH = 600
+
+def _key(declared, sniffed, extractor):
+    return '%s|%s|%s' % (declared, sniffed, extractor)
+
+class ExtractorStats(object):
+    def __init__(self, db=None):
+        self._db = db
+        self.totals = {}
+        self.pending = {}
+        self.pending_count = 0
+        self.last_flush = time.time()
+        self.last_load = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            from regs_models import Doc
+            self._db = Doc._get_db()
+        return self._db
+
+    def load(self):
+        self.totals = {}
+        for row in self.db.extractor_stats.find():
+            self.totals[row['_id']] = (row.get('succeeded', 0), row.get('failed', 0))
+        self.last_load = time.time()
+
+    def counts(self, declared, sniffed, extractor):
+        if self.last_load is None or time.time() - self.last_load > REFRESH:
+            self.load()
+        succeeded, failed = self.totals.get(_key(declared, sniffed, extractor), (0, 0))
+        pending_succeeded, pending_failed = self.pending.get(_key(declared, sniffed, extractor), (0, 0))
+        return succeeded + pending_succeeded, failed + pending_failed
+
+    def success_rate(self, declared, sniffed, extractor):
+        # add-one smoothing, so an extractor we know nothing about counts as a coin flip
+        succeeded, failed = self.counts(declared, sniffed, extractor)
+        return (succeeded + 1) / float(succeeded + failed + 2)
+
+    def order(self, chain, declared, sniffed):
+        """Sort interchangeable extractors by likelihood of success, keeping the
+        configured order for ties. Don't pass fallbacks in here; they'd win."""
+        indexed = list(enumerate(chain))
+        indexed.sort(key=lambda item: (-self.success_rate(declared, sniffed, item[1].__str__()), item[0]))
+        return [extractor for index, extractor in indexed]
+
+    def record(self, declared, sniffed, extractor, succeeded):
+        key = _key(declared, sniffed, extractor)
+        counts = self.pending.get(key, (0, 0))
+        self.pending[key] = (counts[0] + 1, counts[1]) if succeeded else (counts[0], counts[1] + 1)
+        self.pending_count += 1
+
+        if self.pending_count >= FLUSH_EVERY or time.time() - self.last_flush > FLUSH_AGE:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        self.pending_count = 0
+        self.last_flush = time.time()
+
+        for key, (succeeded, failed) in pending.iteritems():
+            declared, sniffed, extractor = key.split('|')
+            self.db.extractor_stats.update(
+                {'_id': key},
+                {
+                    '$inc': {'succeeded': succeeded, 'failed': failed},
+                    '$set': {'declared': declared, 'sniffed': sniffed, 'extractor': extractor}
+                },
+                upsert=True
+            )
+            total = self.totals.get(key, (0, 0))
+            self.totals[key] = (total[0] + succeeded, total[1] + failed)
+
+_stats = None
+def get_stats():
+    global _stats
+    if _stats is None and getattr(settings, 'ADAPTIVE_EXTRACTORS', True):
+        _stats = ExtractorStats()
+    return _stats
@@ -0,0 +1,51 @@
+"""Work out what a downloaded file actually is from its first few bytes,
+since the type regulations.gov declares for a view is often wrong."""
+
+import zipfile
+
+MAGIC = [
+    ('%PDF', 'pdf'),
+    ('{\\rtf', 'rtf'),
+    ('\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'msw8'), # OLE compound file, which for us means old-style Word
+    ('\xffWPC', 'wp8'),
+]
+
+HTML_MARKERS = ('<!doctype html', '<html', '<?xml', '<head', '<body')
+
+def _looks_like_text(head):
+    if not head:
+        return False
+    if '\x00' in head:
+        return False
+    printable = sum(1 for c in head if c in '\t\n\r' or ' ' <= c <= '~' or c >= '\x80')
+    return printable / float(len(head)) > 0.95
+
+def sniff(filename, head_size=1024):
+    """Return the EXTRACTORS key that matches the file's contents, or None if we can't tell."""
+    try:
+        f = open(filename, 'rb')
+        head = f.read(head_size)
+        f.close()
+    except IOError:
+        return None
+
+    for magic, filetype in MAGIC:
+        if head.startswith(magic):
+            return filetype
+
+    if head.startswith('PK\x03\x04'):
+        # docx is a zip with a word/ directory in it
+        try:
+            names = zipfile.ZipFile(filename).namelist()
+        except (zipfile.BadZipfile, IOError):
+            return None
+        return 'msw12' if any(name.startswith('word/') for name in names) else None
+
+    stripped = head.lstrip('\xef\xbb\xbf \t\r\n').lower()
+    if any(stripped.startswith(marker) for marker in HTML_MARKERS):
+        return 'html'
+
+    if _looks_like_text(head):
+        return 'txt'
+
+    return None
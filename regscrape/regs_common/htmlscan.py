@@ -0,0 +1,168 @@
+"""A single-pass scanner for the HTML our extractors produce (mostly
+pdftohtml's), for checking whether there's any real text in it.
+
+It can be fed a chunk at a time and only ever looks at each character once,
+so unlike the old regular expressions it doesn't need the whole document in
+memory, and it can stop as soon as it's seen some text.
+
+What counts as text is what html_is_empty has always looked for: anything
+outside of a tag, inside the body, and not part of the "Document Outline"
+that pdftohtml puts at the top of the page. The one difference is a body
+that's never closed, which the old expressions took to be empty; here it
+counts, since that's what HTML cut off at EXTRACTION_MAX_TEXT looks like.
+With collect=True it also
+keeps that text, with line breaks where block tags were, which is how
+normalize makes the plain-text copies of HTML views."""
+
+import re
+
+# we only need the start of a tag to know what it is
+MAX_TAG = 256
+
+# the only tags that change what we're looking at
+_state_tag = re.compile(r'<\s*(?:/?\s*body|/?\s*ul|a\s[^>]*name="outline")', re.I)
+# a stretch of nothing but tags and whitespace, which pdftohtml produces a lot of
+_tag_run = re.compile(r'(?:\s*<[^>]*>)*\s*')
+# tags that start a new line when we're collecting the text
+LINE_BREAKS = set(['br', 'p', '/p', 'div', '/div', 'li', 'tr', '/tr', 'hr', 'table', '/table'] + ['h%s' % i for i in range(1, 7)] + ['/h%s' % i for i in range(1, 7)])
+
+class HtmlScanner(object):
+    def __init__(self, collect=False):
+        self.has_text = False
+        self.collect = collect
+        self.text = []
+
+        self._in_body = False
+        self._in_tag = False
+        self._tag = ''
+        # whether the last thing collected was a line break we added
+        self._broke = False
+        # None outside the outline, 0 between its anchor and its list, and the list depth inside it
+        self._outline = None
+        # text seen between the outline's anchor and its list, which should only be its heading
+        self._heading = ''
+
+    def feed(self, data):
+        if self.has_text and not self.collect:
+            return
+
+        pos = 0
+        length = len(data)
+        while pos < length:
+            if not self._in_tag and (not self._in_body or self._outline > 0):
+                # nothing here counts, so jump straight to the next tag that could change that
+                match = _state_tag.search(data, pos)
+                if match is None:
+                    self._skip_to_end(data, pos)
+                    return
+                pos = match.start() + 1
+                self._in_tag = True
+            elif self._in_tag:
+                end = data.find('>', pos)
+                if end == -1:
+                    self._tag = (self._tag + data[pos:])[:MAX_TAG]
+                    return
+                self._handle_tag((self._tag + data[pos:end])[:MAX_TAG])
+                self._tag = ''
+                self._in_tag = False
+                pos = end + 1
+            else:
+                if not self.collect and self._outline is None:
+                    # let the regex engine get past runs of markup in one go
+                    run_end = _tag_run.match(data, pos).end()
+                    if run_end > pos:
+                        # but stop short of any tag that could change our state; out here that's only
+                        # </body> or the outline's anchor, so it's only worth looking if they could be there
+                        run = data[pos:run_end].lower()
+                        hits = [hit for hit in (run.find('body'), run.find('outline')) if hit != -1]
+                        if hits:
+                            # (and then only from the tag the first of them is in)
+                            start = max(data.rfind('<', pos, pos + min(hits)), pos)
+                            state_tag = _state_tag.search(data, start, run_end)
+                            if state_tag:
+                                run_end = state_tag.start()
+                        pos = run_end
+                        if pos >= length:
+                            return
+
+                start = data.find('<', pos)
+                if start == -1:
+                    self._handle_text(data[pos:])
+                    return
+                if start > pos:
+                    self._handle_text(data[pos:start])
+                self._in_tag = True
+                pos = start + 1
+
+    def _skip_to_end(self, data, pos):
+        # all we need to know about what we skipped is whether it left us inside a tag
+        last_open = data.rfind('<', pos)
+        if last_open > data.rfind('>', pos):
+            self._in_tag = True
+            self._tag = data[last_open + 1:][:MAX_TAG]
+
+    def _handle_tag(self, tag):
+        tag = tag.strip().lower()
+        name = tag.split(None, 1)[0].rstrip('/') if tag else ''
+
+        if name == 'body':
+            self._in_body = True
+        elif name == '/body':
+            self._in_body = False
+        elif self._outline == 0 and name not in ('a', '/a', 'h1', '/h1', 'ul'):
+            # that wasn't an outline after all
+            self._not_outline()
+        elif self._outline is not None:
+            if name == 'ul':
+                self._outline += 1
+            elif name == '/ul' and self._outline > 0:
+                self._outline -= 1
+                if self._outline == 0:
+                    self._outline = None
+        elif name == 'a' and self._in_body and 'name="outline"' in tag:
+            self._outline = 0
+            self._heading = ''
+
+        if self.collect and name in LINE_BREAKS and self._in_body and self._outline is None:
+            self.text.append('\n')
+            self._broke = True
+
+    def _not_outline(self):
+        # so whatever we took for its heading was just text
+        self._outline = None
+        heading, self._heading = self._heading, ''
+        if heading:
+            self._handle_text(heading)
+
+    def _handle_text(self, text):
+        if not self._in_body:
+            return
+        if self._outline == 0:
+            self._heading += text
+            if 'document outline'.startswith(' '.join(self._heading.split()).lower()):
+                return
+            # anything else means that wasn't an outline after all
+            self._not_outline()
+            return
+        if self._outline is not None:
+            return
+        if not self.has_text and text.strip():
+            self.has_text = True
+        if self.collect:
+            # pdftohtml follows each <br> with a newline of its own
+            if self._broke and text.startswith('\n'):
+                text = text[1:]
+            self._broke = False
+            self.text.append(text)
+
+    def get_text(self):
+        return ''.join(self.text)
+
+def html_has_text(text, chunk_size=64 * 1024):
+    """Whether an HTML string has any real text in it, stopping as soon as it finds some."""
+    scanner = HtmlScanner()
+    for start in xrange(0, len(text), chunk_size):
+        scanner.feed(text[start:start + chunk_size])
+        if scanner.has_text:
+            return True
+    return False
@@ -0,0 +1,186 @@
+"""On-disk HTTP cache for API fetches and downloads, so that re-scraping a
+repaired document or re-downloading a reset view doesn't fetch everything
+again when nothing has changed.
+
+Each entry is a small JSON file recording the response's ETag and
+Last-Modified headers, how long it stays fresh, and the size and SHA-1 of
+its body. API responses keep their body next to it in the cache. Downloads
+are already on disk under DOWNLOAD_DIR, so the entry just points at the
+file, or at its blob once blob_store has taken it. An entry is only used while its body is still there and still
+matches the recorded size (and, if the file has been touched since, the
+hash).
+
+Entries still within their Cache-Control max-age (or Expires) are served
+without asking the server at all. Otherwise we send If-None-Match /
+If-Modified-Since, and a 304 is answered from disk. API keys are left out
+of cache keys, so changing keys doesn't empty the cache."""
+
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import cStringIO
+import email.utils
+import settings
+
+from regs_common.extraction_cache import file_hash
+
+def is_enabled():
+    return getattr(settings, 'HTTP_CACHE', True)
+
+def cache_dir():
+    return getattr(settings, 'HTTP_CACHE_DIR', os.path.join(settings.DATA_DIR, 'http_cache'))
+
+_api_key = re.compile(r'([?&])api_key=[^&]*&?')
+def cache_key(url):
+    return hashlib.sha1(_api_key.sub(r'\1', url).rstrip('?&')).hexdigest()
+
+def _paths(key):
+    directory = os.path.join(cache_dir(), key[:2])
+    return directory, os.path.join(directory, key + '.json'), os.path.join(directory, key + '.body')
+
+def _write_atomically(directory, path, data):
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another downloader may have just made it
+            if not os.path.isdir(directory):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        out = os.fdopen(fd, 'wb')
+        out.write(data)
+        out.close()
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def _intact(entry):
+    try:
+        stat = os.stat(entry['path'])
+    except OSError:
+        return False
+    if stat.st_size != entry['size']:
+        return False
+    if entry.get('blob'):
+        # blobs are named after their hash, and the hash we have is of the uncompressed contents anyway
+        return True
+    # only worth reading the whole thing again if something's been at it
+    return stat.st_mtime == entry['mtime'] or file_hash(entry['path']) == entry['sha1']
+
+def lookup(url):
+    """The cache entry for url, as a dict, or None if there isn't a usable one."""
+    if not is_enabled():
+        return None
+
+    directory, meta_path, body_path = _paths(cache_key(url))
+    try:
+        entry = json.load(open(meta_path))
+    except (IOError, ValueError):
+        return None
+    return entry if _intact(entry) else None
+
+def _freshness(headers, now):
+    """When a response stops being fresh, going by its headers; None means revalidate every time."""
+    cache_control = [part.strip().lower() for part in (headers.get('cache-control') or '').split(',')]
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return None
+    for part in cache_control:
+        if part.startswith('max-age='):
+            try:
+                return now + int(part.split('=', 1)[1])
+            except ValueError:
+                return None
+
+    expires = headers.get('expires')
+    if expires:
+        parsed = email.utils.parsedate_tz(expires)
+        if parsed:
+            return email.utils.mktime_tz(parsed)
+    return None
+
+def is_fresh(entry):
+    return entry['fresh_until'] is not None and time.time() < entry['fresh_until']
+
+def conditional_headers(entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def cacheable(headers):
+    if 'no-store' in (headers.get('cache-control') or '').lower():
+        return False
+    # without a validator we can't ask whether it's changed, so there's no point
+    return bool(headers.get('etag') or headers.get('last-modified') or _freshness(headers, time.time()))
+
+def store(url, headers, body=None, path=None):
+    """Remember a 200 response for url: either its body (for API responses), or
+    the path of the file it was saved to (for downloads)."""
+    if not is_enabled() or not cacheable(headers):
+        return None
+
+    directory, meta_path, body_path = _paths(cache_key(url))
+    try:
+        if body is not None:
+            _write_atomically(directory, body_path, body)
+            path = body_path
+            sha1 = hashlib.sha1(body).hexdigest()
+        else:
+            sha1 = file_hash(path)
+
+        now = time.time()
+        entry = {
+            'url': _api_key.sub(r'\1', url).rstrip('?&'),
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'fresh_until': _freshness(headers, now),
+            'stored': now,
+            'path': os.path.abspath(path),
+            'size': os.path.getsize(path),
+            'mtime': os.stat(path).st_mtime,
+            'sha1': sha1,
+        }
+        # the metadata goes last, since it's what makes the entry visible
+        _write_atomically(directory, meta_path, json.dumps(entry))
+        return entry
+    except (IOError, OSError) as e:
+        # a cache that can't be written to shouldn't stop anything
+        print 'Failed to cache response for %s: %s' % (url, e)
+        return None
+
+def revalidated(url, entry, headers):
+    """Note a 304 for an entry, which can come with new freshness information."""
+    entry['fresh_until'] = _freshness(headers, time.time())
+    if headers.get('etag'):
+        entry['etag'] = headers.get('etag')
+    directory, meta_path, body_path = _paths(cache_key(url))
+    try:
+        _write_atomically(directory, meta_path, json.dumps(entry))
+    except (IOError, OSError):
+        pass
+    return entry
+
+def stored_as_blob(url, blob_path):
+    """Point a download's entry at the blob_store blob its file was moved into."""
+    directory, meta_path, body_path = _paths(cache_key(url))
+    try:
+        entry = json.load(open(meta_path))
+        entry.update({'path': os.path.abspath(blob_path), 'size': os.path.getsize(blob_path), 'mtime': os.stat(blob_path).st_mtime, 'blob': True})
+        _write_atomically(directory, meta_path, json.dumps(entry))
+    except (IOError, OSError, ValueError):
+        pass
+
+def open_body(entry):
+    """A cached API response's body, as a file-like object."""
+    f = open(entry['path'], 'rb')
+    body = f.read()
+    f.close()
+    return cStringIO.StringIO(body)
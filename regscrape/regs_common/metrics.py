@@ -0,0 +1,88 @@
+"""Throughput and latency metrics for run.py commands.
+
+The runner calls start() before running a command and summary() afterwards;
+the summary ends up under 'metrics' in the command's --parsable output,
+which is how pipeline.py gets hold of it. Commands call observe() with the
+time each item of work took; because the latency histogram lives in shared
+memory, this works from multiprocessing workers as long as they're forked
+after start().
+
+Work that isn't what the command is counting (extraction done on the side
+by rdg_download --extract, say) goes under a name of its own: track() the
+name before forking any workers, then observe() with it, and it's reported
+separately instead of skewing the command's own latencies."""
+
+import time
+import datetime
+import resource
+
+from regs_common.mp_types import Histogram
+
+_started = None
+_latency = None
+_named = {}
+
+def start():
+    global _started, _latency, _named
+    _started = time.time()
+    _latency = Histogram()
+    _named = {}
+
+def track(name):
+    if _latency is not None and name not in _named:
+        _named[name] = Histogram()
+
+def observe(seconds, name=None):
+    histogram = _named.get(name) if name else _latency
+    if histogram is not None:
+        histogram.observe(seconds)
+
+def _peak_rss_kb():
+    # our own peak, or the biggest of our (waited-for) children if that's larger
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+# the keys commands use in their returned stats for things they actually got done
+SUCCESS_KEYS = set(['downloaded', 'extracted', 'scraped', 'fetched', 'stored', 'updated', 'repaired', 'deleted', 'recounted', 'new_records', 'existing_records', 'docs', 'docket', 'document', 'total'])
+
+def _count_items(stats):
+    # fall back to adding up the successes in a command's returned stats
+    if type(stats) is not dict:
+        return 0
+    total = 0
+    for key, value in stats.iteritems():
+        if key in SUCCESS_KEYS and type(value) in (int, long):
+            total += value
+        elif type(value) is dict and key not in _named:
+            # anything with a metric of its own is counted there
+            total += _count_items(value)
+    return total
+
+def _named_summary(histogram):
+    return {
+        'items': histogram.count,
+        'latency_p50': histogram.percentile(50),
+        'latency_p95': histogram.percentile(95)
+    }
+
+def summary(stats=None):
+    finished = time.time()
+    duration = finished - _started
+
+    items = _latency.count if _latency is not None and _latency.count else _count_items(stats)
+
+    out = {
+        'started': datetime.datetime.fromtimestamp(_started).isoformat(),
+        'finished': datetime.datetime.fromtimestamp(finished).isoformat(),
+        'duration': duration,
+        'items': items,
+        'items_per_second': items / duration if duration > 0 else None,
+        'peak_rss_kb': _peak_rss_kb(),
+        'latency_p50': _latency.percentile(50) if _latency is not None else None,
+        'latency_p95': _latency.percentile(95) if _latency is not None else None
+    }
+    for name, histogram in _named.iteritems():
+        out[name] = _named_summary(histogram)
+    return out
@@ -1,6 +1,7 @@
 from multiprocessing import RLock
 import multiprocessing.sharedctypes
 import ctypes
+import math
 
 class SynchronizedCounter(multiprocessing.sharedctypes.Synchronized):
     def increment(self, amount=1):
@@ -12,4 +13,52 @@ class SynchronizedCounter(multiprocessing.sharedctypes.Synchronized):
 
 def Counter():
     value = multiprocessing.sharedctypes.RawValue(ctypes.c_uint)
-    return SynchronizedCounter(value, RLock())
\ No newline at end of file
+    return SynchronizedCounter(value, RLock())
+
+class Histogram(object):
+    """A log-scale latency histogram in shared memory, so that forked workers
+    can all record into the same one. Buckets grow by 10% from 1ms, which is
+    plenty of resolution for percentiles of things that take seconds."""
+
+    MIN = 0.001
+    GROWTH = 1.1
+    BUCKETS = 200
+
+    def __init__(self):
+        self._counts = multiprocessing.sharedctypes.RawArray(ctypes.c_uint, self.BUCKETS)
+        self._lock = RLock()
+
+    def _bucket(self, value):
+        if value <= self.MIN:
+            return 0
+        return min(int(math.log(value / self.MIN, self.GROWTH)) + 1, self.BUCKETS - 1)
+
+    def _bucket_value(self, bucket):
+        # upper bound of the bucket
+        return self.MIN * (self.GROWTH ** bucket)
+
+    def observe(self, value):
+        bucket = self._bucket(value)
+        self._lock.acquire()
+        try:
+            self._counts[bucket] += 1
+        finally:
+            self._lock.release()
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    def percentile(self, p):
+        counts = list(self._counts)
+        total = sum(counts)
+        if not total:
+            return None
+
+        target = total * p / 100.0
+        running = 0
+        for bucket, count in enumerate(counts):
+            running += count
+            if running >= target:
+                return self._bucket_value(bucket)
+        return self._bucket_value(len(counts) - 1)
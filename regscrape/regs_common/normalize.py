@@ -0,0 +1,178 @@
+"""Cleanup for extracted text, and the plain-text version of HTML views.
+
+Extractor output is supposed to be utf-8 but often isn't quite: there are
+stray control characters, Windows-1252 punctuation from old Word files, and
+(in HTML) non-breaking spaces spelled every which way. TextNormalizer fixes
+all of that a chunk at a time. Control characters are deleted from the raw
+bytes with a translate table. Bytes that aren't valid utf-8 are repaired
+by reading them as cp1252 rather than being thrown away. Everything that
+needs folding (non-breaking and zero-width spaces, C1 controls, and for
+HTML the &nbsp; entities) is handled by one precompiled substitution.
+
+HTML views also get a plain-text copy stored in GridFS next to their
+content when they're extracted. Search indexing, entity matching and FR
+annotation all want plain text, and view_text gives them that copy instead
+of having each of them strip the HTML again. Views extracted before there
+was such a thing get theirs from ./run.py backfill_plain_text; until then
+view_text works it out on the fly, without storing anything."""
+
+import re
+import codecs
+import gridfs
+from HTMLParser import HTMLParser
+
+from regs_common.htmlscan import HtmlScanner
+
+CHUNK = 64 * 1024
+
+# ASCII control characters, except for tab, newline and carriage return; none
+# of these bytes can be part of a multibyte utf-8 character, so it's safe to
+# delete them before decoding
+_ASCII_CONTROLS = ''.join(map(chr, range(0, 9) + range(11, 13) + range(14, 32) + [127]))
+
+# replacements for (utf-8 encoded) characters we don't want to keep as they are
+FOLD = {
+    '\xc2\xa0': ' ', # no-break space
+    '\xe2\x80\xaf': ' ', # narrow no-break space
+    '\xe2\x80\x87': ' ', # figure space
+    '\xc2\xad': '', # soft hyphen
+    '\xe2\x80\x8b': '', # zero-width space
+    '\xef\xbb\xbf': '', # byte order mark
+}
+# C1 controls go too
+FOLD.update(('\xc2' + chr(c), '') for c in range(0x80, 0xa0))
+
+HTML_FOLD = dict(FOLD)
+HTML_FOLD.update((entity, ' ') for entity in ('&nbsp;', '&nbsp', '&#160;', '&#160', '&#xa0;', '&#xa0', '&#xA0;', '&#xA0'))
+
+def _fold_re(table):
+    # longest first, so that &nbsp; wins over &nbsp
+    return re.compile('|'.join(re.escape(key) for key in sorted(table, key=len, reverse=True)))
+_fold = _fold_re(FOLD)
+_html_fold = _fold_re(HTML_FOLD)
+
+# an HTML entity is at most this long, so that's how much we might have to hold back between chunks
+MAX_ENTITY = 8
+
+def _repair(error):
+    # most invalid utf-8 we see is Windows-1252 (smart quotes and the like from Word),
+    # so read the offending bytes that way; anything cp1252 doesn't have is dropped
+    return error.object[error.start:error.end].decode('cp1252', 'ignore'), error.end
+codecs.register_error('regs_cp1252', _repair)
+
+class TextNormalizer(object):
+    """Normalizes raw extractor output a chunk at a time, returning clean utf-8."""
+
+    def __init__(self, output_type="text"):
+        self.html = output_type == 'html'
+        self._fold, self._table = (_html_fold, HTML_FOLD) if self.html else (_fold, FOLD)
+        self._decoder = codecs.getincrementaldecoder('utf-8')('regs_cp1252')
+        self._held = ''
+
+    def _replace(self, match):
+        return self._table[match.group()]
+
+    def feed(self, chunk, final=False):
+        # the decoder holds back any partial character, so what comes out of
+        # it never has a multibyte sequence split between chunks
+        chunk = self._held + self._decoder.decode(chunk.translate(None, _ASCII_CONTROLS), final).encode('utf-8')
+        self._held = ''
+        if self.html and not final:
+            # don't cut an entity in half
+            amp = chunk.rfind('&', -MAX_ENTITY)
+            if amp != -1:
+                chunk, self._held = chunk[:amp], chunk[amp:]
+        return self._fold.sub(self._replace, chunk)
+
+    def finish(self):
+        return self.feed('', True)
+
+def normalize(text, output_type="text"):
+    normalizer = TextNormalizer(output_type)
+    return normalizer.feed(text, True)
+
+# plain text from HTML
+
+_unescape = HTMLParser().unescape
+
+def html_plain_chunks(chunks):
+    """Turn (normalized) HTML into plain text, a chunk at a time: just the body
+    text, with line breaks where block tags were and entities unescaped, and
+    without pdftohtml's document outline."""
+    scanner = HtmlScanner(collect=True)
+    decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+    held = u''
+    for chunk in chunks:
+        scanner.feed(decoder.decode(chunk))
+        text, scanner.text = held + scanner.get_text(), []
+
+        amp = text.rfind('&', -MAX_ENTITY)
+        if amp != -1 and ';' not in text[amp:]:
+            text, held = text[:amp], text[amp:]
+        else:
+            held = u''
+
+        if text:
+            yield (_unescape(text) if '&' in text else text).encode('utf-8')
+    if held:
+        yield _unescape(held).encode('utf-8')
+
+# collections whose plain-text lookups this process has already made sure are indexed
+_indexed = set()
+
+def _plain_text_files(view):
+    from regs_models import Doc
+    files = Doc._get_db()[view.content.collection_name].files
+    if view.content.collection_name not in _indexed:
+        files.ensure_index('plain_text_of', sparse=True)
+        files.ensure_index('view_url', sparse=True)
+        _indexed.add(view.content.collection_name)
+    return files
+
+def store_plain_text(view, html_chunks):
+    """Save the plain text of an HTML view's content next to it, replacing any earlier copy."""
+    fs = view.content.fs
+    # the last extraction's copy, if there was one
+    for old in _plain_text_files(view).find({'view_url': view.url}, fields=['_id']):
+        fs.delete(old['_id'])
+
+    out = fs.new_file(content_type='text/plain', plain_text_of=view.content.grid_id, view_url=view.url)
+    for chunk in html_plain_chunks(html_chunks):
+        out.write(chunk)
+    out.close()
+    return out._id
+
+def _content_chunks(view):
+    content = view.content.get()
+    while True:
+        chunk = content.read(CHUNK)
+        if not chunk:
+            break
+        yield chunk
+
+def has_plain_text(view):
+    return _plain_text_files(view).find_one({'plain_text_of': view.content.grid_id}, fields=['_id']) is not None
+
+def view_text(view):
+    """The plain text of an extracted view, as unicode. For HTML views this is
+    the copy stored at extraction time, or if there isn't one, the same thing
+    worked out from the HTML (but not stored; that's backfill_plain_text's job)."""
+    if not view.content:
+        return u''
+
+    if view.mode != 'html':
+        return view.content.read().decode('utf-8', 'ignore')
+
+    # (this makes sure the lookup is indexed)
+    _plain_text_files(view)
+    try:
+        return view.content.fs.get_last_version(plain_text_of=view.content.grid_id).read().decode('utf-8', 'ignore')
+    except gridfs.errors.NoFile:
+        return ''.join(html_plain_chunks(_content_chunks(view))).decode('utf-8', 'ignore')
+
+def backfill(view):
+    """Store the plain text of an HTML view that doesn't have it yet; returns whether it needed doing."""
+    if not view.content or view.mode != 'html' or has_plain_text(view):
+        return False
+    store_plain_text(view, _content_chunks(view))
+    return True
@@ -0,0 +1,121 @@
+"""OCR for scanned PDFs.
+
+The images are pulled out of the PDF with pdfimages, converted to greyscale
+TIFFs, and run through tesseract several at a time. Every job gets its own
+temporary directory, and subprocesses are pointed at it with cwd= rather
+than by changing the whole worker's working directory.
+
+OCR is slow, so it's the last thing tried for a PDF: it only runs once
+pdftohtml and pdftotext have both come up empty, which means there's no
+text layer worth checking for here. Only the first OCR_MAX_PAGES pages are
+looked at. Everything is run in its own process group against a deadline
+(the usual extraction timeout plus OCR_TIMEOUT_PER_PAGE for each page), and
+the whole group is killed if it's missed."""
+
+import os
+import re
+import shutil
+import tempfile
+import time
+import multiprocessing
+import settings
+
+from regs_common.exceptions import ExtractionFailed, ChildTimeout
+
+_number_finder = re.compile(r'(\d+)')
+def _natural_key(name):
+    # so that page-10 comes after page-9
+    return [int(part) if part.isdigit() else part for part in _number_finder.split(name)]
+
+def _run(args, deadline, cwd=None):
+    """Run a command to completion or the deadline; returns its return code, stdout and stderr."""
+    from regs_common.processing import group_popen, kill_group, wait_until
+
+    # output goes to files so we can wait on the process without it blocking on a full pipe
+    out, err = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+    proc = group_popen(args, cwd=cwd, stdin=open(os.devnull), stdout=out, stderr=err)
+    try:
+        wait_until(proc, deadline)
+    except ChildTimeout:
+        kill_group(proc)
+        raise
+
+    out.seek(0)
+    err.seek(0)
+    return proc.returncode, out.read(), err.read()
+
+def _check_run(args, deadline, cwd, error_message):
+    returncode, output, error = _run(args, deadline, cwd)
+    if error or returncode != 0:
+        raise ExtractionFailed(error_message)
+
+def ocr_images(images, working, deadline, num_processes=None):
+    """Run tesseract over each image, num_processes at a time, and return their text in order."""
+    from regs_common.processing import group_popen, kill_group
+    # every extraction worker may be OCRing at once, so by default they share the cores out
+    num_processes = num_processes if num_processes else getattr(settings, 'OCR_PROCESSES', max(1, multiprocessing.cpu_count() // getattr(settings, 'EXTRACTORS', multiprocessing.cpu_count())))
+
+    devnull = open(os.devnull, 'w')
+    todo = list(images)
+    running = []
+    try:
+        while todo or running:
+            while todo and len(running) < num_processes:
+                image = todo.pop(0)
+                running.append(group_popen(['tesseract', image, image.rsplit('.', 1)[0]], cwd=working, stdin=open(os.devnull), stdout=devnull, stderr=devnull))
+
+            running = [proc for proc in running if proc.poll() is None]
+            if running:
+                if time.time() >= deadline:
+                    raise ChildTimeout()
+                time.sleep(0.05)
+    except ChildTimeout:
+        for proc in running:
+            kill_group(proc)
+        raise
+    finally:
+        devnull.close()
+
+    out = []
+    for image in images:
+        txt_path = os.path.join(working, image.rsplit('.', 1)[0] + '.txt')
+        if os.path.exists(txt_path):
+            out.append(open(txt_path).read())
+    return out
+
+def pdf_ocr(filename):
+    from regs_common.processing import ocr_scrub, extraction_timeout, pdf_page_count
+
+    max_pages = getattr(settings, 'OCR_MAX_PAGES', 50)
+    pages = pdf_page_count(filename)
+    pages = min(pages, max_pages) if max_pages else pages
+    deadline = time.time() + extraction_timeout(filename) + pages * getattr(settings, 'OCR_TIMEOUT_PER_PAGE', 15) * getattr(settings, 'EXTRACTION_TIMEOUT_FACTOR', 1)
+
+    working = tempfile.mkdtemp(prefix='ocr-', dir=getattr(settings, 'OCR_TMP_DIR', None))
+    try:
+        args = ['pdfimages']
+        if max_pages:
+            args += ['-l', str(max_pages)]
+        _check_run(args + [os.path.abspath(filename), 'page'], deadline, working, "Failed to extract image data from PDF.")
+
+        pnm_match = re.compile(r"page-[0-9]+\.p.m$")
+        pnms = sorted([file for file in os.listdir(working) if pnm_match.match(file)], key=_natural_key)
+        if not pnms:
+            raise ExtractionFailed("No images found in PDF.")
+
+        _check_run(['gm', 'mogrify', '-format', 'tiff', '-type', 'Grayscale'] + pnms, deadline, working, "Failed to convert images to tiff.")
+
+        tiffs = [pnm.rsplit('.', 1)[0] + '.tiff' for pnm in pnms]
+        tiffs = [tiff for tiff in tiffs if os.path.exists(os.path.join(working, tiff))]
+        if not tiffs:
+            raise ExtractionFailed("Converted tiffs not found.")
+
+        texts = ocr_images(tiffs, working, deadline)
+        if not texts:
+            raise ExtractionFailed("OCR failed to find any text.")
+
+        return ocr_scrub('\n'.join(texts) + '\n')
+    finally:
+        shutil.rmtree(working, ignore_errors=True)
+pdf_ocr.__str__ = lambda: 'tesseract'
+pdf_ocr.ocr = True
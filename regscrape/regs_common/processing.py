@@ -3,7 +3,6 @@
 from bson.code import Code
 from pymongo.errors import OperationFailure, InvalidDocument
 import subprocess, os, urlparse, json
-from gevent import Timeout
 from regs_models import *
 from exceptions import ExtractionFailed, ChildTimeout
 import os
@@ -15,8 +14,13 @@ import sys
 import regs_common
 import operator
 import zlib
+import string
 import settings
 
+from regs_common.cursors import resumable_find
+from regs_common.htmlscan import HtmlScanner, html_has_text
+from regs_common.normalize import TextNormalizer
+
 def find_views(**params):
     db = Doc._get_db()
     
@@ -26,6 +30,9 @@ def find_views(**params):
     if 'query' in params:
         query = params['query']
         del params['query']
+
+    # with a checkpoint name, scan in resumable batches rather than with one long cursor
+    checkpoint = params.pop('checkpoint', None)
     
     # create the actual map function
     conditions = dict([('views.%s' % item[0], item[1]) for item in params.items()])
@@ -34,7 +41,7 @@ def find_views(**params):
     results = itertools.chain.from_iterable(
         itertools.imap(
             lambda doc: [{'view': View._from_son(view), 'doc': doc['_id']} for view in doc['views'] if all(item[0] in view and view[item[0]] == item[1] for item in params.items())],
-            db.docs.find(conditions)
+            resumable_find(db.docs, conditions, checkpoint=checkpoint) if checkpoint else db.docs.find(conditions)
         )
     )
     
@@ -50,6 +57,9 @@ def find_attachment_views(**params):
         query = params['query']
         del params['query']
 
+    # with a checkpoint name, scan in resumable batches rather than with one long cursor
+    checkpoint = params.pop('checkpoint', None)
+
     # create the actual map function
     conditions = dict([('attachments.views.%s' % item[0], item[1]) for item in params.items()])
     conditions.update(query)
@@ -62,7 +72,7 @@ def find_attachment_views(**params):
                     for view in attachment['views'] if all(item[0] in view and view[item[0]] == item[1] for item in params.items())
                 ] for attachment in doc['attachments']
             ] if 'attachments' in doc else [], []),
-            db.docs.find(conditions)
+            resumable_find(db.docs, conditions, checkpoint=checkpoint) if checkpoint else db.docs.find(conditions)
         )
     )
 
@@ -116,6 +126,178 @@ def update_attachment_view(doc, attachment, view):
     del db
 
 
+class ViewUpdateBatcher(object):
+    """Write-behind replacement for update_view and update_attachment_view.
+
+    Changes are coalesced per view (only the latest state of each view gets
+    written) and flushed once max_size views are pending or the oldest one has
+    been waiting max_age seconds. The age is checked whenever a change comes
+    in; callers whose changes can stop arriving for a while should also call
+    flush_if_due() from wherever they wait, and flush() or close() when done.
+    Document views are written with
+    a single positional $set keyed on the view URL, all in one bulk request;
+    attachment views can't be addressed that way (only one positional operator
+    is allowed per update), so each document's attachment views are located
+    with one small read and then written with one $set, which checks that
+    they haven't moved since.
+
+    If given, on_flush is called with the records (dicts of doc, view and
+    possibly attachment, like the ones find_views returns) that were written,
+    and on_error with each record that couldn't be, and the exception."""
+
+    def __init__(self, max_size=None, max_age=None, on_flush=None, on_error=None):
+        self.max_size = max_size if max_size else getattr(settings, 'VIEW_UPDATE_BATCH_SIZE', 500)
+        self.max_age = max_age if max_age else getattr(settings, 'VIEW_UPDATE_BATCH_AGE', 5)
+        self.on_flush = on_flush
+        self.on_error = on_error
+        self.errors = 0
+
+        self._views = {}
+        self._attachment_views = {}
+        self._oldest = None
+
+    # same names and signatures as the unbatched functions, so they can be dropped in
+    def update_view(self, doc, view):
+        self._views[(doc, view.url)] = {'doc': doc, 'view': view}
+        self._added()
+
+    def update_attachment_view(self, doc, attachment, view):
+        self._attachment_views[(doc, attachment, view.url)] = {'doc': doc, 'attachment': attachment, 'view': view}
+        self._added()
+
+    def __len__(self):
+        return len(self._views) + len(self._attachment_views)
+
+    def _added(self):
+        if self._oldest is None:
+            self._oldest = time.time()
+        if len(self) >= self.max_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if self._oldest is not None and time.time() - self._oldest >= self.max_age:
+            self.flush()
+
+    def flush(self):
+        """Write everything pending; returns a list of (record, exception) for the writes that failed."""
+        # swap out the pending changes first, since under gevent more can come in while we write
+        views, self._views = self._views, {}
+        attachment_views, self._attachment_views = self._attachment_views, {}
+        self._oldest = None
+
+        if not views and not attachment_views:
+            return []
+
+        db = Doc._get_db()
+
+        failures = []
+        if views:
+            failures.extend(self._flush_views(db, views.values()))
+        if attachment_views:
+            failures.extend(self._flush_attachment_views(db, attachment_views.values()))
+
+        del db
+
+        self.errors += len(failures)
+        failed = set(id(record) for record, error in failures)
+        if self.on_error:
+            for record, error in failures:
+                self.on_error(record, error)
+        if self.on_flush:
+            self.on_flush([record for record in views.values() + attachment_views.values() if id(record) not in failed])
+        return failures
+
+    def _flush_views(self, db, records):
+        updates = [
+            ({'_id': record['doc'], 'views.url': record['view'].url}, {'$set': {'views.$': record['view'].to_mongo()}})
+            for record in records
+        ]
+
+        if hasattr(db.docs, 'initialize_unordered_bulk_op'):
+            bulk = db.docs.initialize_unordered_bulk_op()
+            for query, update in updates:
+                bulk.find(query).update_one(update)
+            try:
+                bulk.execute()
+                return []
+            except (OperationFailure, InvalidDocument) as e:
+                write_errors = getattr(e, 'details', None) and e.details.get('writeErrors')
+                if write_errors:
+                    print 'Failed to save %s view updates: %s' % (len(write_errors), e)
+                    return [(records[error['index']], e) for error in write_errors]
+                # nothing to say which ones, so find out the slow way
+
+        failures = []
+        for record, (query, update) in zip(records, updates):
+            try:
+                db.docs.update(query, update, safe=True)
+            except (OperationFailure, InvalidDocument) as e:
+                print 'Failed to save view update for %s: %s' % (query['_id'], e)
+                failures.append((record, e))
+        return failures
+
+    def _flush_attachment_views(self, db, records):
+        by_doc = {}
+        for record in records:
+            by_doc.setdefault(record['doc'], []).append(record)
+
+        failures = []
+        for doc, doc_records in by_doc.iteritems():
+            # the positions come from a separate read, so the write only goes through if everything's
+            # still where we saw it; if something got pushed or pulled in between, look again
+            for attempt in range(2):
+                current = db.docs.find_one({'_id': doc}, {'attachments.object_id': 1, 'attachments.views.url': 1})
+                positions = {}
+                for a_idx, attachment in enumerate(current.get('attachments', []) if current else []):
+                    for v_idx, view in enumerate(attachment.get('views', [])):
+                        positions[(attachment.get('object_id'), view.get('url'))] = (a_idx, v_idx)
+
+                query = {'_id': doc}
+                to_set = {}
+                positioned = []
+                for record in doc_records:
+                    position = positions.get((record['attachment'], record['view'].url))
+                    if position:
+                        query['attachments.%s.object_id' % position[0]] = record['attachment']
+                        query['attachments.%s.views.%s.url' % position] = record['view'].url
+                        to_set['attachments.%s.views.%s' % position] = record['view'].to_mongo()
+                        positioned.append(record)
+                    else:
+                        failures.extend(self._save_attachment_view(record))
+
+                doc_records = []
+                if to_set:
+                    try:
+                        result = db.docs.update(query, {'$set': to_set}, safe=True)
+                    except (OperationFailure, InvalidDocument) as e:
+                        # it's one write, so none of them made it
+                        print 'Failed to save attachment view updates for %s: %s' % (doc, e)
+                        failures.extend((record, e) for record in positioned)
+                    else:
+                        if not result or not result.get('n'):
+                            doc_records = positioned
+
+                if not doc_records:
+                    break
+            else:
+                # still moving around under us; fall back to the slow way
+                for record in doc_records:
+                    failures.extend(self._save_attachment_view(record))
+        return failures
+
+    def _save_attachment_view(self, record):
+        try:
+            update_attachment_view(**record)
+        except (OperationFailure, InvalidDocument) as e:
+            print 'Failed to save attachment view update for %s: %s' % (record['doc'], e)
+            return [(record, e)]
+        return []
+
+    def close(self):
+        return self.flush()
+
 # the following is from http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
 def which(program):
     import os
@@ -134,42 +316,244 @@ def which(program):
 
     return None
 
-# the following is from http://stackoverflow.com/questions/92438/stripping-non-printable-characters-from-a-string-in-python
-import unicodedata, re
+# extractor
+POPEN = subprocess.Popen
+def _check_output(output, run_error, error, output_type):
+    # cleanup (control characters, non-breaking spaces and so on) happens when it's spooled
+    if (output_type == 'text' and not output.strip()) or (output_type == 'html' and html_is_empty(output)) or (error and (error in output or error in run_error)):
+        raise ExtractionFailed()
+    return output
 
-control_chars = ''.join(map(unichr, range(0,10) + range(11,13) + range(14,32) + range(127,160)))
+SPOOL_CHUNK = 64 * 1024
 
-control_char_re = re.compile('[%s]' % re.escape(control_chars))
+def max_text_size():
+    return getattr(settings, 'EXTRACTION_MAX_TEXT', 32 * 1024 * 1024)
 
-def remove_control_chars(s):
-    return control_char_re.sub('', s)
+class SpooledText(object):
+    """Extracted text (already cleaned up and utf-8 encoded) that lives in a
+    file rather than in memory. It's cheap to pass between processes, and it's
+    up to whoever finally consumes it to remove() it."""
+
+    def __init__(self, path, size=0, truncated=False):
+        self.path = path
+        self.size = size
+        self.truncated = truncated
+
+    def chunks(self, chunk_size=SPOOL_CHUNK):
+        f = open(self.path, 'rb')
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        f.close()
+
+    def read(self):
+        return ''.join(self.chunks())
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def new_spool():
+    import tempfile
+    fd, path = tempfile.mkstemp(prefix='extracted-', suffix='.txt', dir=getattr(settings, 'EXTRACTION_SPOOL_DIR', None))
+    return os.fdopen(fd, 'wb'), path
+
+class TextSpooler(object):
+    """Checks and normalizes extractor output a chunk at a time, writing the
+    result to a spool file and stopping once max_size bytes have been written."""
+
+    def __init__(self, output_type="text", error=None, max_size=None):
+        self.output_type = output_type
+        self.error = error
+        self.max_size = max_size if max_size else max_text_size()
+
+        self.out, self.path = new_spool()
+        self.size = 0
+        self.truncated = False
+        self.has_text = False
+        self.error_seen = False
+        # HTML is checked for real text as it goes by
+        self.html_scanner = HtmlScanner() if output_type == 'html' else None
+
+        self._normalizer = TextNormalizer(output_type)
+        self._error_tail = ''
+
+    def write(self, chunk):
+        """Add a chunk of raw output; returns False once the cap has been reached."""
+        if self.error:
+            # look across the chunk boundary too
+            window = self._error_tail + chunk
+            if self.error in window:
+                self.error_seen = True
+            self._error_tail = window[-(len(self.error) - 1):] if len(self.error) > 1 else ''
+
+        return self._emit(self._normalizer.feed(chunk))
+
+    def _emit(self, data):
+        if self.truncated:
+            return False
+        if not self.has_text:
+            if self.html_scanner:
+                self.html_scanner.feed(data)
+                self.has_text = self.html_scanner.has_text
+            elif data.strip():
+                self.has_text = True
+
+        room = self.max_size - self.size
+        if len(data) > room:
+            # cut on a character boundary
+            data = data[:room].decode('utf-8', 'ignore').encode('utf-8')
+            self.truncated = True
+
+        self.out.write(data)
+        self.size += len(data)
+        return not self.truncated
+
+    def finish(self, run_error='', check=True):
+        """Close the spool and return it as SpooledText, or (if check is set) raise
+        ExtractionFailed if the output didn't pass the usual checks."""
+        self._emit(self._normalizer.finish())
+        self.out.close()
+
+        spooled = SpooledText(self.path, self.size, self.truncated)
+        if not check:
+            return spooled
+
+        failed = not self.has_text or self.error_seen or (self.error and self.error in run_error)
+
+        if failed:
+            spooled.remove()
+            raise ExtractionFailed()
+        return spooled
+
+    def discard(self):
+        self.out.close()
+        SpooledText(self.path).remove()
+
+def spool_string(output, output_type="text"):
+    """Clean up and spool output that an in-process extractor has already checked."""
+    if isinstance(output, SpooledText):
+        return output
+    spooler = TextSpooler(output_type)
+    spooler.write(output)
+    return spooler.finish(check=False)
+
+_pdf_page_finder = re.compile(r'/Type\s*/Page(?![a-zA-Z])')
+_page_count_cache = {}
+def pdf_page_count(filename):
+    """Count the pages in a PDF by looking for page objects, without starting a
+    process; returns 0 for non-PDFs, or if the pages are hidden in compressed
+    object streams."""
+    key = (filename, os.path.getmtime(filename))
+    if key in _page_count_cache:
+        return _page_count_cache[key]
+
+    count = 0
+    f = open(filename, 'rb')
+    if f.read(4) == '%PDF':
+        buf = ''
+        while True:
+            chunk = f.read(SPOOL_CHUNK)
+            buf += chunk
+            # leave the last few bytes for next time, in case a match is split across chunks
+            limit = len(buf) - 32 if chunk else len(buf)
+            count += sum(1 for match in _pdf_page_finder.finditer(buf) if match.start() < limit)
+            buf = buf[max(limit, 0):]
+            if not chunk:
+                break
+    f.close()
+
+    # it gets asked about the same file once per extractor in the chain
+    _page_count_cache.clear()
+    _page_count_cache[key] = count
+    return count
+
+def extraction_timeout(filename):
+    """How long to give an extractor: EXTRACTION_TIMEOUT, plus some extra per
+    megabyte and per PDF page, up to EXTRACTION_TIMEOUT_MAX; all of it scaled
+    by EXTRACTION_TIMEOUT_FACTOR, which the slow lane turns up."""
+    try:
+        size_mb = os.path.getsize(filename) / float(1024 * 1024)
+        pages = pdf_page_count(filename)
+    except (IOError, OSError):
+        size_mb, pages = 0, 0
+
+    timeout = getattr(settings, 'EXTRACTION_TIMEOUT', 120) + \
+        size_mb * getattr(settings, 'EXTRACTION_TIMEOUT_PER_MB', 10) + \
+        pages * getattr(settings, 'EXTRACTION_TIMEOUT_PER_PAGE', 2)
+    timeout = min(timeout, getattr(settings, 'EXTRACTION_TIMEOUT_MAX', 1800))
+    return timeout * getattr(settings, 'EXTRACTION_TIMEOUT_FACTOR', 1)
+
+def group_popen(args, **kwargs):
+    """Popen in a process group of its own, so kill_group can take out anything it starts too."""
+    return POPEN(args, preexec_fn=os.setsid, **kwargs)
+
+def kill_group(proc):
+    import signal
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
+
+def wait_until(proc, deadline):
+    """Wait for a process to exit, raising ChildTimeout if it's still going at the deadline."""
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            raise ChildTimeout()
+        time.sleep(0.05)
+    return proc.returncode
 
-# extractor
-POPEN = subprocess.Popen
-_nbsp = re.compile('(&nbsp;?|&#160;?|&#xa0;?)')
 def binary_extractor(binary, error=None, append=[], output_type="text"):
+    """Run a program over the file and use its stdout. The output is cleaned up
+    and spooled to disk as it's read, so the result is SpooledText, and output
+    beyond EXTRACTION_MAX_TEXT is cut off (and the program stopped)."""
     if not type(binary) == list:
         binary = [binary]
     def extractor(filename):
-        interpreter = POPEN(binary + [filename] + append, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        import tempfile, select
+        deadline = time.time() + extraction_timeout(filename)
+
+        # stderr goes to a file so that a chatty program can't block while we're reading stdout
+        stderr = tempfile.TemporaryFile()
+        interpreter = group_popen(binary + [filename] + append, stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=stderr)
+        spooler = TextSpooler(output_type, error)
         
-        timeout = Timeout(getattr(settings, 'EXTRACTION_TIMEOUT', 120), ChildTimeout)
-        timeout.start()
+        # the deadline is enforced with select rather than a gevent timer, so it works
+        # whether or not we've been monkey-patched (and cooperatively if we have)
+        fd = interpreter.stdout.fileno()
         try:
-            output, run_error = interpreter.communicate('')
-            timeout.cancel()
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                    raise ChildTimeout()
+                chunk = os.read(fd, SPOOL_CHUNK)
+                if not chunk:
+                    break
+                if not spooler.write(chunk):
+                    # we've got as much as we're going to keep
+                    kill_group(interpreter)
+                    break
+            interpreter.stdout.close()
+            wait_until(interpreter, deadline)
         except ChildTimeout:
             print 'killing %s' % filename
-            interpreter.kill()
+            kill_group(interpreter)
+            spooler.discard()
             raise
         
-        if (output_type == 'text' and not output.strip()) or (output_type == 'html' and html_is_empty(output)) or (error and (error in output or error in run_error)):
-            raise ExtractionFailed()
-        elif output_type == 'html':
-            # strip non-breaking spaces
-            return _nbsp.sub(' ', output)
-        else:
-            return output
+        stderr.seek(0)
+        run_error = stderr.read(SPOOL_CHUNK)
+        stderr.close()
+
+        spooled = spooler.finish(run_error)
+        if spooled.truncated:
+            print 'Truncated output of %s from %s at %s bytes' % (binary[0], filename, spooled.size)
+        return spooled
     
     extractor.__str__ = lambda: binary[0]
     extractor.output_type = output_type
@@ -184,103 +568,75 @@ def script_extractor(script, error=None, output_type="text"):
     
     return extractor
 
+def python_extractor(function, name, error=None, output_type="text"):
+    """Like binary_extractor, but for extraction we can do without starting a
+    process: function takes a filename and returns the output as a (utf-8) str,
+    and any exception it raises counts as a failure."""
+    def extractor(filename):
+        try:
+            output = function(filename)
+        except ExtractionFailed:
+            raise
+        except Exception as e:
+            raise ExtractionFailed(str(e))
+
+        return _check_output(output, '', error, output_type)
+
+    extractor.__str__ = lambda: name
+    extractor.output_type = output_type
+
+    return extractor
+
+def read_file(filename):
+    f = open(filename, 'rb')
+    output = f.read()
+    f.close()
+    return output
+
+def html_to_text(filename):
+    import html2text
+    html = unicode(read_file(filename), 'utf-8', 'ignore')
+    return html2text.html2text(html).encode('utf-8')
+
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+def docx_text(filename):
+    # the same thing extract_docx.py does, without the extra interpreter: the
+    # text of each paragraph in word/document.xml, with blank lines between them
+    import zipfile
+    from xml.etree import cElementTree as etree
+
+    archive = zipfile.ZipFile(filename)
+    document = etree.fromstring(archive.read('word/document.xml'))
+    archive.close()
+
+    paragraphs = []
+    for paragraph in document.iter(_WORD_NS + 'p'):
+        text = u''.join(node.text for node in paragraph.iter(_WORD_NS + 't') if node.text)
+        if text:
+            paragraphs.append(text.encode('utf-8'))
+    return '\n\n'.join(paragraphs)
+
 _tag_stripper = re.compile(r'<[^>]*?>')
 def strip_tags(text):
     return _tag_stripper.sub('', text)
 
-_body_finder = re.compile(r"<body[^>]*>(.*)</body>", re.I | re.DOTALL)
-_outline_finder = re.compile(r'<a name="outline"></a>\s*<h1>Document Outline</h1>\s*<ul>.*</ul>', re.I | re.DOTALL)
 def html_is_empty(text):
-    # grab the body
-    body = _body_finder.findall(text)
-    if not body:
-        return True
-    
-    # explicitly strip out pdftohtml's document outlines
-    without_outline = _outline_finder.sub("", body[0])
-    
-    body_text = strip_tags(without_outline).strip()
-    if not body_text:
-        return True
-    
-    return False
+    # body text only, and explicitly not pdftohtml's document outlines; see htmlscan
+    return not html_has_text(text)
+
+# everything that isn't a letter or whitespace, for deleting with str.translate
+_OCR_GARBAGE = ''.join(c for c in map(chr, range(256)) if c not in string.ascii_letters + string.whitespace)
 
 def ocr_scrub(text):
-    lines = re.split(r'\n', text)
-    garbage = re.compile(r'[^a-zA-Z\s]')
-    
-    def is_real_line(word):
-        letter_length = len(garbage.sub('', word))
-        return letter_length and len(word) and letter_length/float(len(word)) >= 0.5
-    
-    filtered_lines = [line.strip() for line in lines if line and is_real_line(line)]
+    # keep the lines that are at least half letters
+    filtered_lines = []
+    for line in text.split('\n'):
+        letters = len(line.translate(None, _OCR_GARBAGE))
+        if letters and 2 * letters >= len(line):
+            filtered_lines.append(line.strip())
     filtered_text = '\n'.join(filtered_lines)
     
-    if len(filtered_text) / float(len(text)) < 0.5:
+    if 2 * len(filtered_text) < len(text):
         raise ExtractionFailed('This is does not appear to be text.')
     
     return filtered_text
-
-def pdf_ocr(filename):
-    basename = os.path.basename(filename).split('.')[0]
-    working = '/tmp/%s' % basename
-    if not os.path.exists(working):
-        os.mkdir(working)
-    os.chdir(working)
-    
-    def cleanup():
-        if working and working != '/tmp/':
-            os.chdir('..')
-            subprocess.Popen(['rm', '-rf', working], stdout=subprocess.PIPE).communicate()
-    
-    extractor = subprocess.Popen(['pdfimages', filename, basename], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    extractor_output, extractor_error = extractor.communicate()
-    if extractor_error:
-        cleanup()
-        raise ExtractionFailed("Failed to extract image data from PDF.")
-    
-    pnm_match = re.compile(r"[a-zA-Z0-9]+-[0-9]+\.p.m")
-    pnms = [file for file in os.listdir(working) if pnm_match.match(file)]
-    if not pnms:
-        cleanup()
-        raise ExtractionFailed("No images found in PDF.")
-    
-    converter = subprocess.Popen(['gm', 'mogrify', '-format', 'tiff', '-type', 'Grayscale'] + pnms, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    converter_output, converter_error = converter.communicate()
-    if converter_error:
-        cleanup()
-        raise ExtractionFailed("Failed to convert images to tiff.")
-    
-    tiff_match = re.compile(r"[a-zA-Z0-9]+-[0-9]+\.tiff")
-    tiffs = [file for file in os.listdir(working) if tiff_match.match(file)]
-    if not tiffs:
-        cleanup()
-        raise ExtractionFailed("Converted tiffs not found.")
-    
-    out = cStringIO.StringIO()
-    for tiff in tiffs:
-        tiff_base = tiff.split('.')[0]
-        ocr = subprocess.Popen(['tesseract', tiff, tiff_base], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        ocr_output, ocr_error = ocr.communicate()
-        
-    txt_match = re.compile(r"[a-zA-Z0-9]+-[0-9]+\.txt")
-    txts = [file for file in os.listdir(working) if txt_match.match(file)]
-    if not txts:
-        cleanup()
-        raise ExctractionFailed("OCR failed to find any text.")
-    
-    for txt in txts:
-        ocr_file = open(txt, 'r')
-        out.write(ocr_file.read())
-        out.write('\n')
-    
-    try:
-        return_data =  ocr_scrub(out.getvalue())
-    except ExtractionFailed:
-        cleanup()
-        raise
-    
-    cleanup()
-    return return_data
-pdf_ocr.__str__ = lambda: 'tesseract'
-pdf_ocr.ocr = True
@@ -0,0 +1,206 @@
+"""Profiling support for run.py commands (see the runner's --profile option).
+
+Three modes are supported:
+  cpu  - cProfile with a CPU-time clock, plus a collapsed-stack file of
+         samples taken while the process was burning CPU (for flamegraph.pl)
+  wall - cProfile with a wall clock, plus collapsed stacks sampled on a timer
+  mem  - a top-N allocation report from tracemalloc where it's available,
+         or peak RSS and live object counts by type where it isn't
+
+Stack samples are taken from a real (unpatched) thread rather than with
+signal timers, because a profiling signal would cut short every time.sleep
+in the command under Python 2.
+
+Worker processes started with multiprocessing need their targets wrapped in
+profiled() to be covered. The wrapper writes the worker's profile when its
+target returns, which is how ExtractionPool's workers finish now that
+they're shut down with a sentinel each. The scraping and parsing commands
+still stop theirs with terminate(), so the profile is also written when the
+worker receives SIGTERM. A worker that dies any other way (killed, or
+crashed outright) leaves no profile."""
+
+import os
+import sys
+import time
+import signal
+import datetime
+
+MODES = ('cpu', 'wall', 'mem')
+SAMPLE_INTERVAL = 0.01
+MEM_TOP_N = 50
+
+# set by configure() in the runner, and inherited by forked workers
+_config = None
+
+def configure(mode, name, directory=None):
+    global _config
+    import settings
+
+    if mode not in MODES:
+        raise ValueError('Unknown profiling mode %s; expected one of %s' % (mode, ', '.join(MODES)))
+
+    directory = directory if directory else getattr(settings, 'PROFILE_DIR', os.path.join(settings.DATA_DIR, 'profiles'))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    _config = {'mode': mode, 'name': name, 'directory': directory}
+
+def is_enabled():
+    return _config is not None
+
+def _original(module, name):
+    # under gevent we want the real thread and the real sleep
+    try:
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    except ImportError:
+        return getattr(__import__(module), name)
+
+def _frame_label(frame):
+    code = frame.f_code
+    return '%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class StackSampler(object):
+    """Periodically records the target thread's stack in collapsed form.
+
+    In CPU mode a sample only counts if the process used CPU time since the
+    previous one, and is weighted by how much it used."""
+
+    def __init__(self, thread_id, cpu=False, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.cpu = cpu
+        self.interval = interval
+        self.stacks = {}
+        self.running = False
+
+    def _cpu_time(self):
+        times = os.times()
+        return times[0] + times[1]
+
+    def _loop(self):
+        sleep = _original('time', 'sleep')
+        last_cpu = self._cpu_time()
+        while self.running:
+            sleep(self.interval)
+
+            weight = 1
+            if self.cpu:
+                now_cpu = self._cpu_time()
+                weight = int(round((now_cpu - last_cpu) / self.interval))
+                last_cpu = now_cpu
+                if weight <= 0:
+                    continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + weight
+
+    def start(self):
+        self.running = True
+        _original('thread', 'start_new_thread')(self._loop, ())
+
+    def stop(self):
+        self.running = False
+
+    def write(self, path):
+        out = open(path, 'w')
+        for stack, count in sorted(self.stacks.items()):
+            out.write('%s %s\n' % (stack, count))
+        out.close()
+
+class Profiler(object):
+    def __init__(self, mode, directory, name):
+        self.mode = mode
+        self.base = os.path.join(directory, '%s-%s-%s-%s' % (name, mode, datetime.datetime.now().strftime('%Y%m%d%H%M%S'), os.getpid()))
+        self.paths = []
+
+    def start(self):
+        if self.mode in ('cpu', 'wall'):
+            import cProfile
+            self.profile = cProfile.Profile(time.clock) if self.mode == 'cpu' else cProfile.Profile()
+            # the real thread id, since once gevent is patched in get_ident gives a greenlet's,
+            # and sys._current_frames() has never heard of those
+            self.sampler = StackSampler(_original('thread', 'get_ident')(), cpu=self.mode == 'cpu')
+            self.sampler.start()
+            self.profile.enable()
+        else:
+            try:
+                import tracemalloc
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+            except ImportError:
+                self.tracemalloc = None
+        return self
+
+    def stop(self):
+        """Stop profiling and write out the artifacts; returns their paths."""
+        if self.mode in ('cpu', 'wall'):
+            self.profile.disable()
+            self.sampler.stop()
+
+            self.paths.append(self.base + '.prof')
+            self.profile.dump_stats(self.paths[-1])
+
+            self.paths.append(self.base + '.collapsed')
+            self.sampler.write(self.paths[-1])
+        else:
+            self.paths.append(self.base + '.mem.txt')
+            out = open(self.paths[-1], 'w')
+            self._write_memory_report(out)
+            out.close()
+
+        return self.paths
+
+    def _write_memory_report(self, out):
+        import resource
+
+        out.write('Peak RSS: %s KB\n' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        out.write('Peak RSS of waited-for children: %s KB\n\n' % resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+        if self.tracemalloc:
+            snapshot = self.tracemalloc.take_snapshot()
+            out.write('Top %s allocation sites:\n' % MEM_TOP_N)
+            for stat in snapshot.statistics('lineno')[:MEM_TOP_N]:
+                out.write('%s\n' % stat)
+            self.tracemalloc.stop()
+        else:
+            # no tracemalloc on this interpreter, so settle for what's still alive
+            import gc
+            counts = {}
+            for obj in gc.get_objects():
+                name = type(obj).__name__
+                counts[name] = counts.get(name, 0) + 1
+            out.write('tracemalloc unavailable; top %s live object types:\n' % MEM_TOP_N)
+            for name, count in sorted(counts.items(), key=lambda item: item[1], reverse=True)[:MEM_TOP_N]:
+                out.write('%10d %s\n' % (count, name))
+
+def start(suffix=None):
+    if not _config:
+        return None
+    name = _config['name'] + ('-%s' % suffix if suffix else '')
+    return Profiler(_config['mode'], _config['directory'], name).start()
+
+def profiled(target):
+    """Wrap a multiprocessing target so that it's profiled like its parent."""
+    if not _config:
+        return target
+
+    def wrapper(*args, **kwargs):
+        profiler = start('worker')
+
+        def on_term(signum, frame):
+            profiler.stop()
+            os._exit(0)
+        signal.signal(signal.SIGTERM, on_term)
+
+        try:
+            return target(*args, **kwargs)
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            profiler.stop()
+    return wrapper
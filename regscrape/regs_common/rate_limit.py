@@ -0,0 +1,180 @@
+"""A token bucket for each rate-limited API host, shared by every process on
+the machine, so that we stay under api.data.gov's per-key limit instead of
+running into it and then idling every worker for an hour.
+
+Each bucket's state lives in a small file under RATE_LIMIT_DIR, and every
+change to it is made under an flock. Scrapers, downloaders and dump
+commands running side by side therefore all draw from the same budget.
+acquire() takes its token straight away and then sleeps until the bucket
+would have had it. The bucket can go into debt this way, which makes
+waiters line up in the order they asked instead of all rushing in when it
+refills. A rate-limit response from the server puts the bucket at least
+BACKOFF_START seconds' worth of tokens into debt, doubling for each
+backoff in a row up to RATE_LIMIT_BACKOFF_MAX. Every process then waits
+that out in acquire(), with no sleeping of its own. Requests that were in
+flight together tend to get turned away together, so the debt is a floor
+rather than added up, and they only count as one more in a row."""
+
+import os
+import time
+import fcntl
+import urlparse
+import settings
+
+# hosts we limit ourselves on, with how many requests we allow in how many seconds;
+# api.data.gov allows 1000 an hour per key, and we leave a little room for the burst
+DEFAULT_LIMITS = {
+    'api.data.gov': (950, 3600),
+}
+
+BACKOFF_START = 60
+
+def limits():
+    return getattr(settings, 'RATE_LIMITS', DEFAULT_LIMITS)
+
+def state_dir():
+    return getattr(settings, 'RATE_LIMIT_DIR', os.path.join(settings.DATA_DIR, 'rate_limit'))
+
+class TokenBucket(object):
+    def __init__(self, name, requests, per, burst=None, path=None):
+        self.name = name
+        self.rate = requests / float(per)
+        # a minute's worth by default
+        self.capacity = burst if burst else max(1, int(self.rate * 60))
+        self.path = path if path else os.path.join(state_dir(), '%s.bucket' % name)
+        self.max_backoff = getattr(settings, 'RATE_LIMIT_BACKOFF_MAX', 3600)
+
+        # what we last saw of the backoff, so success doesn't have to take the lock to clear it
+        self._strikes = 0
+
+    def _update(self, func):
+        """Call func(state, now) with the bucket's refilled state, under the lock, and save whatever it changes."""
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # someone else got there first
+                pass
+
+        f = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0644), 'r+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            now = time.time()
+
+            try:
+                fields = f.read().split()
+                state = {'tokens': float(fields[0]), 'updated': float(fields[1]), 'strikes': int(fields[2])}
+                # when the current run of backoffs last struck (missing from older files)
+                state['backed_off'] = float(fields[3]) if len(fields) > 3 else 0.0
+            except (ValueError, IndexError):
+                # new (or mangled), so start full
+                state = {'tokens': float(self.capacity), 'updated': now, 'strikes': 0, 'backed_off': 0.0}
+
+            state['tokens'] = min(self.capacity, state['tokens'] + max(now - state['updated'], 0) * self.rate)
+            state['updated'] = now
+
+            result = func(state, now)
+            self._strikes = state['strikes']
+
+            f.seek(0)
+            f.truncate()
+            f.write('%r %r %d %r\n' % (state['tokens'], state['updated'], state['strikes'], state['backed_off']))
+            f.flush()
+            return result
+        finally:
+            # closing releases the lock
+            f.close()
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until they'd have been there; returns how long we slept."""
+        def take(state, now):
+            state['tokens'] -= tokens
+            return -state['tokens'] / self.rate if state['tokens'] < 0 else 0
+
+        wait = self._update(take)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def _delay(self, strikes):
+        return min(BACKOFF_START * 2 ** max(strikes - 1, 0), self.max_backoff)
+
+    def backoff(self):
+        """Note that the server told us to slow down, and make everyone wait; returns the delay."""
+        def strike(state, now):
+            # a 429 that arrives while we're still waiting out the last one was most likely
+            # in flight alongside it, so it's the same strike, not another one
+            current = self._delay(state['strikes'])
+            if not state['strikes'] or state['tokens'] >= 0 or now - state['backed_off'] >= current:
+                state['strikes'] += 1
+                state['backed_off'] = now
+            delay = self._delay(state['strikes'])
+            state['tokens'] = min(state['tokens'], -delay * self.rate)
+            return delay
+        return self._update(strike)
+
+    def succeeded(self):
+        """Note a request that got through, which resets the backoff."""
+        if self._strikes:
+            def reset(state, now):
+                state['strikes'] = 0
+            self._update(reset)
+
+    def update_remaining(self, remaining):
+        """Bring the bucket down to what the server says we have left, if it thinks that's less."""
+        def sync(state, now):
+            state['tokens'] = min(state['tokens'], remaining)
+        self._update(sync)
+
+    def reset(self):
+        """Refill the bucket and forget any backoff."""
+        def refill(state, now):
+            state['tokens'] = float(self.capacity)
+            state['strikes'] = 0
+            state['backed_off'] = 0.0
+        self._update(refill)
+
+    def level(self):
+        """The bucket's current fill level, without taking anything from it."""
+        def read(state, now):
+            return {
+                'name': self.name,
+                'tokens': state['tokens'],
+                'capacity': self.capacity,
+                'rate': self.rate,
+                'wait': -state['tokens'] / self.rate if state['tokens'] < 0 else 0,
+                'strikes': state['strikes'],
+            }
+        return self._update(read)
+
+_buckets = {}
+def for_host(host):
+    """The bucket for a host, or None if we don't limit ourselves there."""
+    if host not in limits():
+        return None
+    if host not in _buckets:
+        _buckets[host] = TokenBucket(host, *limits()[host])
+    return _buckets[host]
+
+def for_url(url):
+    return for_host(urlparse.urlparse(url).hostname)
+
+def back_off(limiter, fallback):
+    """Back off a host's bucket, or if we don't limit ourselves there, just sleep for fallback seconds the old way."""
+    if limiter:
+        return limiter.backoff()
+    time.sleep(fallback)
+    return fallback
+
+def remaining_from_headers(limiter, headers):
+    """Keep the bucket in line with api.data.gov's own count, if the response has one."""
+    remaining = headers.get('x-ratelimit-remaining', None) if limiter else None
+    if remaining is not None:
+        try:
+            remaining = int(remaining)
+        except ValueError:
+            return
+        # it only matters when it's close to running out, so don't take the lock otherwise
+        if remaining < limiter.capacity:
+            limiter.update_remaining(remaining)
@@ -0,0 +1,110 @@
+"""Registry of runnable commands, so that the runner can find a command (and
+know whether it wants gevent) without importing every commands package in
+turn to look for it.
+
+The registry is built by parsing the command modules rather than importing
+them, and is cached as JSON next to the other data files; it's rebuilt
+whenever a command file is added, removed or modified."""
+
+import os
+import ast
+import imp
+import json
+import tempfile
+import settings
+
+REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'command_registry.json')
+
+def command_libs():
+    return ['regs_common'] + settings.SITES
+
+def _command_files():
+    """Map of command file path -> (lib, command name), found without importing anything."""
+    out = {}
+    for lib in command_libs():
+        try:
+            lib_path = imp.find_module(lib)[1]
+        except ImportError:
+            continue
+
+        commands_dir = os.path.join(lib_path, 'commands')
+        if not os.path.isdir(commands_dir):
+            continue
+
+        for filename in sorted(os.listdir(commands_dir)):
+            if filename.endswith('.py') and not filename.startswith('_'):
+                out[os.path.join(commands_dir, filename)] = (lib, filename[:-3])
+    return out
+
+def describe_module(path):
+    """Statically inspect a command module for the things the runner needs to know."""
+    tree = ast.parse(open(path).read(), path)
+
+    info = {'gevent': True, 'runnable': False, 'description': None}
+    doc = ast.get_docstring(tree)
+    if doc:
+        info['description'] = doc.strip().split('\n')[0]
+
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == 'run':
+            info['runnable'] = True
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id == 'GEVENT' and isinstance(node.value, ast.Name):
+                    info['gevent'] = node.value.id != 'False'
+    return info
+
+def build_registry(files=None):
+    files = files if files is not None else _command_files()
+
+    commands = {}
+    for path in sorted(files.keys(), key=lambda path: (command_libs().index(files[path][0]), path)):
+        lib, name = files[path]
+        if name in commands:
+            # earlier libraries win, as they always have
+            continue
+
+        info = describe_module(path)
+        if not info['runnable']:
+            continue
+
+        commands[name] = {
+            'module': '%s.commands.%s' % (lib, name),
+            'gevent': info['gevent'],
+            'description': info['description']
+        }
+
+    return {
+        'commands': commands,
+        'files': dict((path, os.stat(path).st_mtime) for path in files)
+    }
+
+def load_registry():
+    files = _command_files()
+    current = dict((path, os.stat(path).st_mtime) for path in files)
+
+    try:
+        registry = json.load(open(REGISTRY_FILE))
+        if registry.get('files') == current:
+            return registry['commands']
+    except (IOError, ValueError, AttributeError, KeyError):
+        # missing or mangled, so it's as good as stale
+        pass
+
+    registry = build_registry(files)
+    # the pipeline starts lots of commands at once, so write it somewhere else and move it into
+    # place, so nobody reads it half-written
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(REGISTRY_FILE), prefix='.tmp-')
+    except (IOError, OSError):
+        # not the end of the world; we'll just rebuild it next time
+        return registry['commands']
+    try:
+        out = os.fdopen(fd, 'w')
+        json.dump(registry, out, indent=1, sort_keys=True)
+        out.close()
+        os.rename(tmp_path, REGISTRY_FILE)
+    except (IOError, OSError):
+        os.unlink(tmp_path)
+
+    return registry['commands']
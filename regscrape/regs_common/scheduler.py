@@ -0,0 +1,170 @@
+import settings
+import multiprocessing
+
+DEFAULT_SEQUENCE = [
+    'rdg_dump_api',
+    'rdg_parse_api',
+    'rdg_scrape',
+    'rdg_download',
+    'extract',
+    'extract_slow',
+    'create_dockets',
+    'rdg_scrape_dockets',
+    'add_to_search',
+    'run_aggregates'
+]
+
+# each stage can start for an agency once all of the stages it lists have completed for that agency
+DEFAULT_DEPENDENCIES = {
+    'rdg_dump_api': [],
+    'rdg_parse_api': ['rdg_dump_api'],
+    'rdg_scrape': ['rdg_parse_api'],
+    'rdg_download': ['rdg_scrape'],
+    'extract': ['rdg_download'],
+    # another go at whatever timed out in extract; nothing waits for it, since it can take a while
+    'extract_slow': ['extract'],
+    'create_dockets': ['rdg_parse_api'],
+    'rdg_scrape_dockets': ['create_dockets'],
+    'add_to_search': ['extract', 'rdg_scrape_dockets'],
+    'run_aggregates': ['extract', 'rdg_scrape_dockets']
+}
+
+# how many copies of each command may run at once, across all agencies
+DEFAULT_LIMITS = {
+    'extract': 4,
+    'extract_slow': 1,
+    'run_aggregates': 1
+}
+
+def dependencies_for(sequence, dependencies=DEFAULT_DEPENDENCIES):
+    """Project the dependency graph onto a (possibly overridden) sequence.
+
+    Dependencies on stages that aren't part of the sequence are replaced by
+    those stages' own dependencies, and stages we know nothing about just
+    wait for whatever comes before them in the sequence."""
+    in_sequence = set(sequence)
+
+    def resolve(stage, seen):
+        out = set()
+        for dep in dependencies.get(stage, []):
+            if dep in seen:
+                continue
+            seen.add(dep)
+            if dep in in_sequence:
+                out.add(dep)
+            else:
+                out |= resolve(dep, seen)
+        return out
+
+    graph = {}
+    for i, stage in enumerate(sequence):
+        if stage in dependencies:
+            graph[stage] = resolve(stage, set([stage]))
+        else:
+            graph[stage] = set(sequence[i - 1:i])
+    return graph
+
+def dependents_of(stage, graph):
+    """Return every stage that transitively depends on the given one."""
+    out = set()
+    frontier = [stage]
+    while frontier:
+        current = frontier.pop()
+        for other, deps in graph.iteritems():
+            if current in deps and other not in out:
+                out.add(other)
+                frontier.append(other)
+    return out
+
+class Scheduler(object):
+    def __init__(self, overrides=None, limits=None, default_limit=1, max_running=None):
+        self.overrides = overrides if overrides is not None else {}
+        self.limits = limits if limits is not None else getattr(settings, 'PIPELINE_LIMITS', DEFAULT_LIMITS)
+        self.default_limit = default_limit
+        self.max_running = max_running if max_running else getattr(settings, 'PIPELINE_MAX_RUNNING', multiprocessing.cpu_count())
+        self._graphs = {}
+
+    def sequence_for(self, agency):
+        return self.overrides.get(agency, DEFAULT_SEQUENCE)
+
+    def graph_for(self, agency):
+        sequence = tuple(self.sequence_for(agency))
+        if sequence not in self._graphs:
+            self._graphs[sequence] = dependencies_for(list(sequence))
+        return self._graphs[sequence]
+
+    def limit_for(self, command):
+        return self.limits.get(command, self.default_limit)
+
+    def stages_to_reset(self, agency, completed):
+        """Given an agency's completed-stage map, return the stages that need
+        to be re-run because they, or something they depend on, failed."""
+        graph = self.graph_for(agency)
+        failed = [stage for stage in self.sequence_for(agency) if stage in completed and type(completed[stage]) != dict]
+
+        to_reset = set()
+        for stage in failed:
+            to_reset.add(stage)
+            to_reset |= dependents_of(stage, graph)
+        return [stage for stage in self.sequence_for(agency) if stage in to_reset and stage in completed]
+
+    def ready_stages(self, agency, completed, running):
+        """Stages for this agency that aren't done or running and whose dependencies are all done."""
+        graph = self.graph_for(agency)
+        return [
+            stage for stage in self.sequence_for(agency)
+            if stage not in completed and (agency, stage) not in running and all(dep in completed for dep in graph[stage])
+        ]
+
+    def is_finished(self, agency, completed):
+        return all(stage in completed for stage in self.sequence_for(agency))
+
+    def next_tasks(self, agency_records, running):
+        """Decide which (agency, command) pairs to start now.
+
+        Slots are handed out round-robin: each pass over the agencies gives
+        every agency at most one new stage, starting with the agencies that
+        currently have the least going on (and the smallest ones among those),
+        so that a couple of huge agencies can't monopolize a command."""
+        command_counts = {}
+        agency_counts = {}
+        for agency, command in running:
+            command_counts[command] = command_counts.get(command, 0) + 1
+            agency_counts[agency] = agency_counts.get(agency, 0) + 1
+
+        candidates = {}
+        for record in agency_records:
+            ready = self.ready_stages(record['_id'], record['completed'], running)
+            if ready:
+                candidates[record['_id']] = (record.get('count', 0), ready)
+
+        total = len(running)
+        to_start = []
+        while candidates and total < self.max_running:
+            order = sorted(candidates.keys(), key=lambda agency: (agency_counts.get(agency, 0), candidates[agency][0]))
+            started_any = False
+            for agency in order:
+                if total >= self.max_running:
+                    break
+
+                count, ready = candidates[agency]
+                startable = [command for command in ready if command_counts.get(command, 0) < self.limit_for(command)]
+                if not startable:
+                    del candidates[agency]
+                    continue
+
+                command = startable[0]
+                to_start.append((agency, command))
+                command_counts[command] = command_counts.get(command, 0) + 1
+                agency_counts[agency] = agency_counts.get(agency, 0) + 1
+                total += 1
+                started_any = True
+
+                ready.remove(command)
+                if not ready:
+                    del candidates[agency]
+
+            if not started_any:
+                break
+
+        return to_start
@@ -0,0 +1,167 @@
+import os
+import errno
+import fcntl
+import select
+import signal
+import subprocess
+import datetime
+
+STDERR_TAIL = 64 * 1024
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class Child(object):
+    def __init__(self, key, proc):
+        self.key = key
+        self.proc = proc
+        self.pid = proc.pid
+        self.started = datetime.datetime.now()
+        self.finished = None
+        self.returncode = None
+        self.rusage = None
+        self.stdout_chunks = []
+        self.stderr_chunks = []
+        self.stderr_size = 0
+
+    @property
+    def stdout(self):
+        return ''.join(self.stdout_chunks)
+
+    @property
+    def stderr(self):
+        return ''.join(self.stderr_chunks)
+
+    def _append_stderr(self, data):
+        # only keep the tail of stderr; it's for diagnostics, and some commands are chatty
+        self.stderr_chunks.append(data)
+        self.stderr_size += len(data)
+        while self.stderr_size > STDERR_TAIL and len(self.stderr_chunks) > 1:
+            self.stderr_size -= len(self.stderr_chunks.pop(0))
+
+class Supervisor(object):
+    """Runs child processes and wakes up only when one of them produces output
+    or exits, rather than polling on a timer.
+
+    Child exits are noticed via SIGCHLD, which writes to a self-pipe so that
+    the select() in wait() returns immediately; stdout and stderr are drained
+    as they're written so a chatty child can never block on a full pipe."""
+
+    def __init__(self):
+        self.children = {}
+        self._fds = {}
+
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        _set_nonblocking(self._wakeup_r)
+        _set_nonblocking(self._wakeup_w)
+
+        signal.signal(signal.SIGCHLD, self._sigchld_handler)
+        # otherwise a child exiting in the middle of, say, a Mongo write makes it fail with EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def _sigchld_handler(self, signum, frame):
+        try:
+            os.write(self._wakeup_w, '.')
+        except OSError:
+            # the pipe is full, which means a wakeup is already pending
+            pass
+
+    def spawn(self, key, args, **kwargs):
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, **kwargs)
+        proc.stdin.close()
+
+        child = Child(key, proc)
+        for stream, sink in ((proc.stdout, child.stdout_chunks.append), (proc.stderr, child._append_stderr)):
+            fd = stream.fileno()
+            _set_nonblocking(fd)
+            self._fds[fd] = (child, stream, sink)
+
+        self.children[key] = child
+        return child
+
+    def __len__(self):
+        return len(self.children)
+
+    def _drain(self, fd):
+        child, stream, sink = self._fds[fd]
+        while True:
+            try:
+                data = os.read(fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                data = ''
+
+            if not data:
+                # EOF
+                stream.close()
+                del self._fds[fd]
+                return
+            sink(data)
+
+    def _reap(self):
+        finished = []
+        for key, child in self.children.items():
+            try:
+                pid, status, rusage = os.wait4(child.pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                pid, status, rusage = child.pid, 0, None
+
+            if pid == 0:
+                continue
+
+            child.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            child.proc.returncode = child.returncode
+            child.finished = datetime.datetime.now()
+            child.rusage = rusage
+
+            # pick up whatever the child wrote before exiting, then let go of its pipes
+            # even if a stray grandchild is still holding them open
+            for fd in [fd for fd, info in self._fds.items() if info[0] is child]:
+                self._drain(fd)
+                if fd in self._fds:
+                    self._fds[fd][1].close()
+                    del self._fds[fd]
+
+            del self.children[key]
+            finished.append(child)
+        return finished
+
+    def wait(self, timeout=None):
+        """Block until at least one child exits or the timeout passes, keeping
+        all output pipes drained in the meantime. Returns the finished children."""
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout) if timeout is not None else None
+
+        finished = self._reap()
+        while not finished:
+            remaining = None
+            if deadline:
+                remaining = max((deadline - datetime.datetime.now()).total_seconds(), 0)
+
+            try:
+                readable = select.select([self._wakeup_r] + self._fds.keys(), [], [], remaining)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                # a signal came in; let the caller see it if it was something other than a child exit
+                return self._reap()
+
+            for fd in readable:
+                if fd == self._wakeup_r:
+                    try:
+                        while os.read(self._wakeup_r, 1024):
+                            pass
+                    except OSError:
+                        pass
+                elif fd in self._fds:
+                    self._drain(fd)
+
+            finished = self._reap()
+            if not readable:
+                # timed out
+                break
+
+        return finished
@@ -0,0 +1,188 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from regs_common.htmlscan import HtmlScanner, html_has_text
+from regs_common.normalize import TextNormalizer, normalize, html_plain_chunks
+from regs_common.scheduler import Scheduler, dependencies_for, DEFAULT_SEQUENCE
+from regs_common import rate_limit
+
+
+def page(body, close=True):
+    return '<html><head><title>doc</title></head>\n<body bgcolor="#A0A0A0">\n%s%s</html>\n' % (body, '</body>\n' if close else '')
+
+OUTLINE = '<a name="outline"></a><h1>Document Outline</h1>\n<ul><li><a href="#1">Section 1</a></li>\n<ul><li><a href="#2">Part</a></li></ul></ul><hr>\n'
+
+
+class TestHtmlHasText(unittest.TestCase):
+
+    def test_outline_only(self):
+        self.assertFalse(html_has_text(page(OUTLINE + '<a name=1></a><b></b> <br>\n<hr>\n')))
+        self.assertTrue(html_has_text(page(OUTLINE + '<a name=1></a>Comment text<br>\n')))
+
+    def test_anchor_without_outline(self):
+        # the old expressions only dropped a real outline (anchor, heading, list), so neither of these is one
+        self.assertTrue(html_has_text(page('<a name="outline"></a>Comment text<br>\n')))
+        self.assertTrue(html_has_text(page('<a name="outline"></a><h1>Document Outline</h1><p>\n')))
+
+    def test_heading_split_between_chunks(self):
+        text = page(OUTLINE)
+        for chunk_size in (1, 7, 64):
+            self.assertFalse(html_has_text(text, chunk_size))
+
+    def test_unclosed_body(self):
+        # unlike the old expressions, which called this empty; HTML cut off at EXTRACTION_MAX_TEXT looks like this
+        self.assertTrue(html_has_text(page('Comment text<br>\n', close=False)))
+        self.assertFalse(html_has_text(page('<b></b> <br>\n', close=False)))
+
+    def test_no_body(self):
+        self.assertFalse(html_has_text('<html><head><title>Comment text</title></head></html>'))
+
+    def test_collect(self):
+        scanner = HtmlScanner(collect=True)
+        scanner.feed(page(OUTLINE + '<p>First</p>Second<br>\nThird'))
+        self.assertEqual('\n\n\nFirst\nSecond\nThird', scanner.get_text())
+
+        scanner = HtmlScanner(collect=True)
+        scanner.feed(page('<a name="outline"></a>Not an outline<br>\n'))
+        self.assertEqual('\nNot an outline\n', scanner.get_text())
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        rate_limit.time = self.clock
+        self.dir = tempfile.mkdtemp()
+        self.bucket = rate_limit.TokenBucket('test', 3600, 3600, path=os.path.join(self.dir, 'test.bucket'))
+
+    def tearDown(self):
+        rate_limit.time = __import__('time')
+        shutil.rmtree(self.dir)
+
+    def test_acquire(self):
+        # a minute's worth to start with, then one a second
+        for i in range(60):
+            self.assertEqual(0, self.bucket.acquire())
+        self.assertAlmostEqual(1, self.bucket.acquire())
+        # having slept for it, the next one's a second away too
+        self.assertAlmostEqual(1, self.bucket.acquire())
+
+    def test_backoff_burst(self):
+        # everything in flight getting turned away at once is one strike, not twenty
+        for i in range(20):
+            self.assertEqual(rate_limit.BACKOFF_START, self.bucket.backoff())
+        level = self.bucket.level()
+        self.assertEqual(1, level['strikes'])
+        self.assertAlmostEqual(rate_limit.BACKOFF_START, level['wait'])
+
+    def test_backoff_in_a_row(self):
+        self.bucket.backoff()
+        self.clock.sleep(rate_limit.BACKOFF_START + 1)
+        self.assertEqual(2 * rate_limit.BACKOFF_START, self.bucket.backoff())
+        self.bucket.backoff()
+        self.assertEqual(2, self.bucket.level()['strikes'])
+
+        self.clock.sleep(2 * rate_limit.BACKOFF_START + 1)
+        self.bucket.succeeded()
+        self.assertEqual(rate_limit.BACKOFF_START, self.bucket.backoff())
+
+    def test_backoff_max(self):
+        for i in range(20):
+            self.clock.sleep(self.bucket.max_backoff + 1)
+            delay = self.bucket.backoff()
+        self.assertEqual(self.bucket.max_backoff, delay)
+        self.assertAlmostEqual(self.bucket.max_backoff, self.bucket.level()['wait'])
+
+
+class TestScheduler(unittest.TestCase):
+
+    def completed_through(self, stage):
+        return dict((done, {}) for done in DEFAULT_SEQUENCE[:DEFAULT_SEQUENCE.index(stage) + 1])
+
+    def test_dependencies_for(self):
+        graph = dependencies_for(['rdg_dump_api', 'rdg_parse_api', 'extract', 'something_new'])
+        # the stages in between aren't running, so extract waits for what they waited for
+        self.assertEqual(set(['rdg_parse_api']), graph['extract'])
+        # and stages we don't know about wait for whatever came before them
+        self.assertEqual(set(['extract']), graph['something_new'])
+        self.assertEqual(set(), graph['rdg_dump_api'])
+
+    def test_stages_to_reset(self):
+        scheduler = Scheduler(max_running=4)
+        completed = self.completed_through('rdg_scrape_dockets')
+        completed['rdg_download'] = 'parse_failure'
+        self.assertEqual(['rdg_download', 'extract', 'extract_slow'], scheduler.stages_to_reset('A', completed))
+
+        completed['rdg_download'] = {}
+        self.assertEqual([], scheduler.stages_to_reset('A', completed))
+
+    def test_ready_stages(self):
+        scheduler = Scheduler(max_running=4)
+        completed = self.completed_through('rdg_parse_api')
+        # scraping and docket creation only need the parse
+        self.assertEqual(['rdg_scrape', 'create_dockets'], scheduler.ready_stages('A', completed, {}))
+        self.assertEqual(['create_dockets'], scheduler.ready_stages('A', completed, {('A', 'rdg_scrape'): None}))
+
+    def test_limits(self):
+        scheduler = Scheduler(limits={'extract': 2}, max_running=10)
+        records = [{'_id': agency, 'completed': self.completed_through('rdg_download'), 'count': count} for agency, count in [('A', 30), ('B', 10), ('C', 20)]]
+        # the smallest agencies go first, and the one that can't extract gets on with something else
+        self.assertEqual([('B', 'extract'), ('C', 'extract'), ('A', 'create_dockets')], scheduler.next_tasks(records, {}))
+        self.assertNotIn(('A', 'extract'), scheduler.next_tasks(records, {('B', 'extract'): None, ('C', 'extract'): None}))
+
+    def test_round_robin(self):
+        scheduler = Scheduler(limits={}, default_limit=5, max_running=3)
+        records = [
+            {'_id': 'BIG', 'completed': self.completed_through('rdg_parse_api'), 'count': 1000},
+            {'_id': 'SMALL', 'completed': self.completed_through('rdg_parse_api'), 'count': 10},
+        ]
+        # each agency gets a stage before either gets a second one
+        self.assertEqual([('SMALL', 'rdg_scrape'), ('BIG', 'rdg_scrape'), ('SMALL', 'create_dockets')], scheduler.next_tasks(records, {}))
+
+        # and whoever has the least going on comes first
+        running = {('SMALL', 'rdg_scrape'): None}
+        self.assertEqual([('BIG', 'rdg_scrape'), ('SMALL', 'create_dockets')], scheduler.next_tasks(records, running)[:2])
+
+
+class TestNormalize(unittest.TestCase):
+
+    def test_controls(self):
+        self.assertEqual('a\tb\nc\r\nd', normalize('a\x00\tb\x07\nc\r\nd\x7f'))
+
+    def test_cp1252(self):
+        self.assertEqual('\xe2\x80\x9cquoted\xe2\x80\x9d caf\xc3\xa9', normalize('\x93quoted\x94 caf\xe9'))
+
+    def test_fold(self):
+        self.assertEqual('a b cd', normalize('a\xc2\xa0b c\xc2\xadd\xe2\x80\x8b'))
+        # entities are only spaces in HTML
+        self.assertEqual('a&nbsp;b', normalize('a&nbsp;b'))
+        self.assertEqual('a b c', normalize('a&nbsp;b&#160;c', 'html'))
+
+    def test_chunks(self):
+        text = '\xef\xbb\xbfcaf\xc3\xa9 &nbsp;x&#xA0;y \x93z\x94 \xe2\x82\xac'
+        for output_type in ('text', 'html'):
+            normalizer = TextNormalizer(output_type)
+            pieces = [normalizer.feed(char) for char in text] + [normalizer.finish()]
+            self.assertEqual(normalize(text, output_type), ''.join(pieces))
+
+    def test_html_plain_chunks(self):
+        html = page('<p>Fish &amp; chips</p>caf&eacute;')
+        self.assertEqual('\n\nFish & chips\ncaf\xc3\xa9', ''.join(html_plain_chunks([html])))
+        # entities split between chunks still come out whole
+        self.assertEqual('\n\nFish & chips\ncaf\xc3\xa9', ''.join(html_plain_chunks([html[i:i + 5] for i in range(0, len(html), 5)])))
+
+
+if __name__ == '__main__':
+    unittest.main()
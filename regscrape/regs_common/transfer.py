@@ -2,12 +2,27 @@ import urllib2, urllib3
 import subprocess
 from gevent.pool import Pool
 from gevent import Timeout
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore
 import greenlet
 import settings
 import datetime
 import sys
 import traceback
 import time
+import os
+import re
+import json
+import base64
+import hashlib
+import shutil
+import urlparse
+import collections
+from regs_common import metrics
+from regs_common import rate_limit
+from regs_common import http_cache
+from regs_common import blob_store
+from regs_common.exceptions import IncompleteDownload
 
 def pump(input, output, chunk_size):
     size = 0
@@ -56,44 +71,277 @@ def tpump(input, output, chunk_size):
         size += len(chunk)
     return size
 
+# partial downloads: the bytes so far go in output_file + '.part', and what we need to
+# ask for the rest (and to check we got all of it) in output_file + '.part.json'
+def _part_paths(output_file):
+    return output_file + '.part', output_file + '.part.json'
+
+def _remove_part(output_file):
+    for path in _part_paths(output_file):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def _load_part(output_file, url):
+    """How much of url we already have from an earlier try, and what we knew about it then."""
+    part_path, meta_path = _part_paths(output_file)
+    try:
+        meta = json.load(open(meta_path))
+        size = os.path.getsize(part_path)
+        age = time.time() - os.path.getmtime(part_path)
+    except (IOError, OSError, ValueError):
+        return 0, None
+
+    # we can only pick up where we left off if it's the same file, and the server can tell us it hasn't changed
+    if meta.get('url') != url or not meta.get('validator') or age > getattr(settings, 'DOWNLOAD_PART_MAX_AGE', 7 * 86400):
+        return 0, None
+    return size, meta
+
+_content_range = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+def _parse_content_range(value):
+    match = _content_range.match(value or '')
+    if not match:
+        return None, None
+    start, total = match.groups()
+    return int(start), int(total) if total != '*' else None
+
+def _md5_matches(path, content_md5):
+    md5 = hashlib.md5()
+    f = open(path, 'rb')
+    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+        md5.update(chunk)
+    f.close()
+    return base64.b64encode(md5.digest()) == content_md5.strip()
+
+def _finish_part(output_file, size, meta):
+    """Check a finished .part file against what the server told us, and move it into place."""
+    part_path, meta_path = _part_paths(output_file)
+    if meta['length'] is not None and size != meta['length']:
+        if size > meta['length']:
+            # something's gone wrong that resuming won't fix
+            _remove_part(output_file)
+        raise IncompleteDownload('Got %s bytes of %s.' % (size, meta['length']))
+
+    if meta['md5'] and not _md5_matches(part_path, meta['md5']):
+        _remove_part(output_file)
+        raise IncompleteDownload('Downloaded file failed its checksum.')
+
+    os.rename(part_path, output_file)
+    _remove_part(output_file)
+    return size
+
+def _from_cache(entry, output_file):
+    if entry.get('blob'):
+        # it's in the blob store, maybe compressed; the store will notice it already has it
+        return blob_store.copy_out(entry['path'], output_file)
+    # otherwise usually it's a re-download of a file that's still where we left it
+    if entry['path'] != os.path.abspath(output_file):
+        part_path, meta_path = _part_paths(output_file)
+        shutil.copyfile(entry['path'], part_path)
+        os.rename(part_path, output_file)
+    return entry['size']
+
 def download_pooled(url, output_file):
-    transfer = CPOOL.urlopen("GET", url, timeout=10, preload_content=False)
-    if transfer.status != 200:
+    """Download url to output_file, resuming from whatever an earlier try left in
+    its .part file if the server supports ranges, and checking the result against
+    the server's length (and Content-MD5, if it sends one) before moving it into place.
+    Files we've downloaded before are only fetched again if they've changed."""
+    cached = http_cache.lookup(url)
+    if cached and http_cache.is_fresh(cached):
+        return _from_cache(cached, output_file)
+
+    part_path, meta_path = _part_paths(output_file)
+    have, meta = _load_part(output_file, url)
+
+    headers = {}
+    if have:
+        headers['Range'] = 'bytes=%s-' % have
+        # and if it's changed since, just send the whole thing
+        headers['If-Range'] = meta['validator']
+    elif cached:
+        headers.update(http_cache.conditional_headers(cached))
+    transfer = CPOOL.urlopen("GET", url, headers=headers, timeout=10, preload_content=False)
+
+    if transfer.status == 304 and cached:
+        transfer.release_conn()
+        http_cache.revalidated(url, cached, transfer.headers)
+        return _from_cache(cached, output_file)
+    elif transfer.status == 416 and have and have == meta['length']:
+        # we'd already got all of it
+        transfer.release_conn()
+        return _finish_part(output_file, have, meta)
+    elif transfer.status == 206 and have:
+        start, total = _parse_content_range(transfer.headers.get('content-range'))
+        if start != have:
+            transfer.release_conn()
+            _remove_part(output_file)
+            raise urllib2.HTTPError(url, transfer.status, 'Server sent the wrong range', transfer.headers, None)
+        mode = 'ab'
+    elif transfer.status == 200:
+        have, mode = 0, 'wb'
+        length = transfer.headers.get('content-length')
+        total = int(length) if length and length.isdigit() else None
+    else:
+        if have:
+            # maybe it was the range it didn't like; start over next time
+            _remove_part(output_file)
         raise urllib2.HTTPError(url, transfer.status, transfer.reason, transfer.headers, None)
 
-    out = open(output_file, 'wb')
-    size = tpump(transfer, out, 16 * 1024)
-    out.close()
+    # lengths are of what's on the wire, so with a content-encoding there's nothing to check or resume
+    encoded = transfer.headers.get('content-encoding', 'identity') != 'identity'
+    etag = transfer.headers.get('etag')
+    # weak etags aren't allowed in If-Range
+    validator = etag if etag and not etag.startswith('W/') else transfer.headers.get('last-modified')
+    if mode == 'ab':
+        # a range response describes the range, so the whole file's checksum (and maybe its length) come from last time
+        meta = {'url': url, 'validator': validator or meta['validator'], 'length': total if total is not None else meta['length'], 'md5': meta['md5']}
+    else:
+        meta = {
+            'url': url,
+            'validator': None if encoded else validator,
+            'length': None if encoded else total,
+            'md5': None if encoded else transfer.headers.get('content-md5'),
+        }
+    if meta['validator']:
+        json.dump(meta, open(meta_path, 'w'))
+    else:
+        # we won't be able to resume this one
+        _remove_part(output_file)
+
+    # if this times out, what we've got so far stays in the .part file for the next try
+    out = open(part_path, mode)
+    try:
+        size = have + tpump(transfer, out, 16 * 1024)
+    finally:
+        out.close()
 
+    size = _finish_part(output_file, size, meta)
+    http_cache.store(url, transfer.headers, path=output_file)
     return size
 
-def _get_downloader(status_func, download_func, retries, verbose, min_size, url, filename, record=None):
+# how much slower than usual a download can be and still count as going well
+LATENCY_TOLERANCE = 2.0
+
+class HostConcurrency(object):
+    """An AIMD limit on how many downloads run against one host at once. Each
+    download that goes well and isn't unusually slow adds 1/limit, so the limit
+    grows by about one per round of downloads. A timeout, a 5xx or a 429 halves
+    it, at most once per round, so a burst of failures from one overload only
+    counts once."""
+
+    def __init__(self, host, start, maximum):
+        self.host = host
+        self.limit = float(min(start, maximum))
+        self.maximum = maximum
+        self.active = 0
+        self.failures = 0
+        # moving average of seconds per 64k (or per request, for small files)
+        self.cost = None
+        self._last_decrease = 0
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        while self.active >= int(self.limit):
+            waiter = AsyncResult()
+            self._waiters.append(waiter)
+            waiter.get()
+        self.active += 1
+
+    def release(self, outcome, elapsed=None, size=0):
+        """Give the slot back; outcome is 'ok', 'failed' (the host is struggling) or anything else for no signal."""
+        self.active -= 1
+
+        if outcome == 'ok':
+            cost = elapsed / max(1.0, size / 65536.0)
+            if self.cost is None or cost <= self.cost * LATENCY_TOLERANCE:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.cost = cost if self.cost is None else 0.8 * self.cost + 0.2 * cost
+        elif outcome == 'failed':
+            self.failures += 1
+            now = time.time()
+            # one decrease per round: wait about as long as a download takes
+            if now - self._last_decrease > max(1.0, self.cost or 0):
+                self.limit = max(1.0, self.limit / 2)
+                self._last_decrease = now
+
+        # let in as many as there's now room for
+        for i in xrange(max(int(self.limit) - self.active, 0)):
+            if not self._waiters:
+                break
+            self._waiters.popleft().set()
+
+class AdaptiveConcurrency(object):
+    def __init__(self, start=None, maximum=None):
+        self.start = start if start else getattr(settings, 'DOWNLOADERS', 5)
+        self.maximum = maximum if maximum else getattr(settings, 'DOWNLOADERS_PER_HOST_MAX', self.start * 4)
+        self.hosts = {}
+
+    def for_url(self, url):
+        host = urlparse.urlparse(url).hostname
+        if host not in self.hosts:
+            self.hosts[host] = HostConcurrency(host, self.start, self.maximum)
+        return self.hosts[host]
+
+    def report(self):
+        for host, concurrency in sorted(self.hosts.items()):
+            print '%s: ended at %s concurrent downloads, %s failures' % (host, int(concurrency.limit), concurrency.failures)
+
+def _get_downloader(status_func, download_func, retries, verbose, min_size, url, filename, record=None, concurrency=None, slots=None):
     def download_file():
+        download_start = time.time()
+        limiter = rate_limit.for_url(url)
+        host = concurrency.for_url(url) if concurrency else None
         for try_num in xrange(retries):
             if verbose: print 'Downloading %s (try #%d, downloader %s)...' % (url, try_num, hash(greenlet.getcurrent()))
             
             download_succeeded = False
             download_message = None
             size = 0
+            # what this try says about how the host is holding up
+            outcome = 'failed'
+            # the token comes first, so nothing holds a download slot while it waits out the rate limit
+            if limiter:
+                limiter.acquire()
+            if host:
+                host.acquire()
+            # and only then one of the download slots all the hosts share, so a host
+            # that's backed up leaves them free for everyone else
+            if slots:
+                slots.acquire()
             try:
                 start = datetime.datetime.now()
                 size = download_func(url, filename)
                 download_succeeded = True
+                outcome = 'ok'
                 elapsed = datetime.datetime.now() - start
             except urllib2.HTTPError as e:
                 if verbose: print 'Download of %s failed due to error %s.' % (url, e.code)
                 download_message = e.code
+                if int(e.code) < 500 and int(e.code) != 429:
+                    # not found and the like are about the file, not the host
+                    outcome = None
                 
                 if int(e.code) == 429:
-                    if verbose: print 'Error occurred due to rate limiting; waiting 10 minutes.'
-                    time.sleep(600)
+                    if verbose: print 'Error occurred due to rate limiting; backing off.'
+                    rate_limit.back_off(limiter, 600)
             except Timeout as e:
                 if verbose: print 'Download of %s timed out.' % url
+            except IncompleteDownload as e:
+                if verbose: print 'Download of %s was incomplete: %s' % (url, e)
+                download_message = str(e)
             except:
                 exc = sys.exc_info()
                 if verbose: print traceback.print_tb(exc[2])
+            finally:
+                if slots:
+                    slots.release()
+                if host:
+                    host.release(outcome, (datetime.datetime.now() - start).total_seconds(), size)
             
             if download_succeeded:
+                if limiter:
+                    limiter.succeeded()
                 if size >= min_size:
                     # print status
                     ksize = int(round(size/1024.0))
@@ -104,6 +352,7 @@ def _get_downloader(status_func, download_func, retries, verbose, min_size, url,
                     download_message = "Resulting file was smaller than the minimum file size."
                     if verbose: print download_message
         
+        metrics.observe(time.time() - download_start)
         status_func(
             (download_succeeded, download_message),
             url,
@@ -127,16 +376,35 @@ def bulk_download(download_iterable, status_func=None, retries=3, verbose=False,
 CPOOL = None
 def pooled_bulk_download(download_iterable, status_func=None, retries=5, verbose=False, min_size=0):
     num_downloaders = getattr(settings, 'DOWNLOADERS', 5)
+
+    # each host gets its own concurrency limit, which adapts to how well it's coping. Downloads
+    # wait in line for their host before taking one of the DOWNLOADERS_MAX slots shared by all
+    # hosts, so a slow host's backlog doesn't hold up the others; only once DOWNLOADS_QUEUED
+    # downloads are waiting do we stop reading more work
+    concurrency = AdaptiveConcurrency() if getattr(settings, 'ADAPTIVE_DOWNLOADS', True) else None
+    slots = None
+    if concurrency:
+        max_active = getattr(settings, 'DOWNLOADERS_MAX', num_downloaders * 20)
+        slots = BoundedSemaphore(max_active)
+        pool_size = getattr(settings, 'DOWNLOADS_QUEUED', max_active * 5)
+        per_host = concurrency.maximum
+    else:
+        pool_size = per_host = num_downloaders
+
     global CPOOL
     if not CPOOL:
-        CPOOL = urllib3.PoolManager(num_pools=2, maxsize=num_downloaders * 2)
+        # a connection pool per host we're downloading from, each big enough for that host's busiest
+        CPOOL = urllib3.PoolManager(num_pools=getattr(settings, 'DOWNLOAD_HOSTS', 20), maxsize=per_host)
 
-    workers = Pool(num_downloaders)
+    workers = Pool(pool_size)
     
     # keep the downloaders busy with tasks as long as there are more results
     for download_record in download_iterable:
-        workers.spawn(_get_downloader(status_func, download_pooled, retries, verbose, min_size, *download_record))
+        workers.spawn(_get_downloader(status_func, download_pooled, retries, verbose, min_size, *download_record, concurrency=concurrency, slots=slots))
     
     workers.join()
+
+    if concurrency and verbose:
+        concurrency.report()
     
     return
\ No newline at end of file
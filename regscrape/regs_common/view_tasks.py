@@ -0,0 +1,208 @@
+"""A leased work queue of views waiting to be downloaded or extracted.
+
+Rather than having every download or extraction run rescan db.docs for views
+in the right state, the queue_views command walks the documents once and
+writes a small record per pending view into db.view_tasks; any number of
+workers, on any number of machines, can then claim tasks atomically. A
+claim is a lease: if the worker holding it dies, the task becomes claimable
+again once the lease runs out. Workers claim well ahead of what they're
+actually working on, so a live worker keeps its leases going with
+keep_alive(), and only closes out tasks it still holds.
+
+Task ids are derived from the stage and the view's identity, so enqueuing is
+idempotent and a task can be completed knowing only the view it was for."""
+
+import os
+import time
+import socket
+import hashlib
+import datetime
+import settings
+
+from pymongo.errors import DuplicateKeyError
+from regs_models import *
+
+STAGES = ('download', 'extract')
+
+# ids of the tasks this process has leased and not yet closed out, and when we last renewed them
+_held = set()
+_renewed = [0]
+
+def _db():
+    return Doc._get_db()
+
+def _owner():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+def _lease():
+    return getattr(settings, 'VIEW_TASK_LEASE', 1800)
+
+def ensure_indexes(db=None):
+    db = db if db else _db()
+    db.view_tasks.ensure_index([('stage', 1), ('state', 1), ('lease_expires', 1)])
+    db.view_tasks.ensure_index([('stage', 1), ('agency', 1), ('state', 1)])
+
+def task_id(stage, doc, url, attachment=None):
+    return hashlib.md5('|'.join([stage, doc, attachment or '', url]).encode('utf-8')).hexdigest()
+
+def enqueue(stage, record, agency=None, docket_id=None, db=None):
+    """Add (or re-open) a task for the view in a find_views-style record.
+    Tasks that are currently leased are left alone."""
+    db = db if db else _db()
+    view = record['view']
+    _id = task_id(stage, record['doc'], view.url, record.get('attachment'))
+
+    try:
+        db.view_tasks.update({'_id': _id, 'state': {'$ne': 'leased'}}, {'$set': {
+            'stage': stage,
+            'state': 'pending',
+            'doc': record['doc'],
+            'attachment': record.get('attachment'),
+            'url': view.url,
+            'type': view.type,
+            'path': view.file_path,
+            'agency': agency,
+            'docket_id': docket_id
+        }}, upsert=True, safe=True)
+    except DuplicateKeyError:
+        # somebody is working on it right now
+        pass
+
+def populate(stage, find_func, find_conditions, db=None):
+    """Walk db.docs once and enqueue a task for every matching view."""
+    db = db if db else _db()
+    ensure_indexes(db)
+
+    count = 0
+    last_doc = (None, None, None)
+    for record in find_func(**find_conditions):
+        # views from the same document come out together, so only look each one up once
+        if record['doc'] != last_doc[0]:
+            doc = db.docs.find_one({'_id': record['doc']}, {'agency': 1, 'docket_id': 1})
+            last_doc = (record['doc'], doc.get('agency'), doc.get('docket_id'))
+        agency, docket_id = last_doc[1:]
+
+        enqueue(stage, record, agency=agency, docket_id=docket_id, db=db)
+        count += 1
+    return count
+
+def claim(stage, agency=None, docket_id=None, attachments=False, view_type=None, lease=None, db=None):
+    """Atomically lease the next available task for a document view (or, with
+    attachments=True, an attachment view), or return None if there aren't any."""
+    db = db if db else _db()
+    now = datetime.datetime.now()
+    lease = lease if lease else _lease()
+
+    query = {
+        'stage': stage,
+        '$or': [
+            {'state': 'pending'},
+            {'state': 'leased', 'lease_expires': {'$lt': now}}
+        ],
+        'attachment': {'$ne': None} if attachments else None
+    }
+    if agency:
+        query['agency'] = agency
+    if docket_id:
+        query['docket_id'] = docket_id
+    if view_type:
+        query['type'] = view_type
+
+    task = db.view_tasks.find_and_modify(
+        query=query,
+        update={
+            '$set': {'state': 'leased', 'lease_expires': now + datetime.timedelta(seconds=lease), 'owner': _owner()},
+            '$inc': {'attempts': 1}
+        },
+        new=True
+    )
+    if task:
+        _held.add(task['_id'])
+    return task
+
+def renew(lease=None, db=None):
+    """Extend the leases on all the tasks this process still holds."""
+    db = db if db else _db()
+    _renewed[0] = time.time()
+    if not _held:
+        return
+    lease = lease if lease else _lease()
+    db.view_tasks.update(
+        {'_id': {'$in': list(_held)}, 'state': 'leased', 'owner': _owner()},
+        {'$set': {'lease_expires': datetime.datetime.now() + datetime.timedelta(seconds=lease)}},
+        multi=True, safe=True
+    )
+
+def keep_alive(db=None):
+    """Renew our leases if a third of the lease has gone by since we last did;
+    cheap enough to call whenever there's a moment."""
+    if _held and time.time() - _renewed[0] >= _lease() / 3.0:
+        renew(db=db)
+
+def _close(task_id, state, db):
+    # only if it's still ours; if our lease ran out, whoever has it now gets to say how it went
+    _held.discard(task_id)
+    return db.view_tasks.find_and_modify(
+        query={'_id': task_id, 'state': 'leased', 'owner': _owner()},
+        update={'$set': {'state': state, 'lease_expires': None}}
+    )
+
+def _load_record(task, db):
+    """Turn a task back into a find_views-style record with the view as it currently stands."""
+    if task['attachment']:
+        doc = db.docs.find_one({'_id': task['doc']}, {'attachments': 1})
+        views = [view for attachment in (doc or {}).get('attachments', []) if attachment.get('object_id') == task['attachment'] for view in attachment.get('views', [])]
+    else:
+        doc = db.docs.find_one({'_id': task['doc']}, {'views': 1})
+        views = (doc or {}).get('views', [])
+
+    matching = [view for view in views if view.get('url') == task['url']]
+    if not matching:
+        return None
+
+    record = {'view': View._from_son(matching[0]), 'doc': task['doc']}
+    if task['attachment']:
+        record['attachment'] = task['attachment']
+    return record
+
+def claimed_views(stage, agency=None, docket_id=None, attachments=False, view_type=None, is_pending=None):
+    """Keep claiming tasks and yield their records until the queue runs dry.
+
+    is_pending, if given, is called with each view to check it still needs
+    doing; tasks whose views don't are closed out as skipped."""
+    db = _db()
+    while True:
+        # we're called for more whenever a slot frees up, so this is a good time
+        keep_alive(db)
+        task = claim(stage, agency=agency, docket_id=docket_id, attachments=attachments, view_type=view_type, db=db)
+        if not task:
+            return
+
+        record = _load_record(task, db)
+        if record is None or (is_pending and not is_pending(record['view'])):
+            _close(task['_id'], 'skipped', db)
+            continue
+
+        yield record
+
+def complete(stage, record, state='done', next_stage=None, db=None):
+    """Close out the task for a record's view; if it succeeded and there's a
+    next stage, queue the view up for that. Returns False if we don't hold
+    the task (it was never claimed, or our lease ran out and someone else
+    has it now)."""
+    db = db if db else _db()
+    task = _close(task_id(stage, record['doc'], record['view'].url, record.get('attachment')), state, db)
+    if not task:
+        return False
+
+    if next_stage and state == 'done':
+        enqueue(next_stage, record, agency=task.get('agency'), docket_id=task.get('docket_id'), db=db)
+    return True
+
+def completer(stage, succeeded, next_stage=None):
+    """Build an on_flush callback for a ViewUpdateBatcher that closes out the
+    task for each view once it's been written."""
+    def on_flush(records):
+        for record in records:
+            complete(stage, record, 'done' if succeeded(record['view']) else 'failed', next_stage=next_stage)
+    return on_flush
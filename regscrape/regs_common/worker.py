@@ -0,0 +1,283 @@
+"""A long-lived worker daemon that keeps the expensive imports (and the entity
+trie) in memory and forks a fresh child for each command it's sent, so that
+commands start warm instead of paying for a new interpreter every time.
+
+gevent has to be patched in before anything else is imported, and commands
+that don't use it mustn't have it patched in at all, so there are really two
+daemons: one for plain commands on the socket itself, and one, forked off
+before preloading, that patches first and listens on <socket>.gevent. The
+client picks the right one from the command registry.
+
+Clients connect and send a single JSON line of the form
+{"argv": [...], "cwd": "..."}. The command's stdout and stderr come back
+over the socket as frames, followed by its exit status, so the client can
+print exactly what ./run.py would have printed (including the --parsable
+JSON) and exit the same way."""
+
+import os
+import sys
+import json
+import errno
+import select
+import signal
+import socket
+import struct
+import traceback
+
+# each frame is a one-letter stream ('o' for stdout, 'e' for stderr, 'x' for
+# the exit status) and a length (or, for 'x', the status), then the data
+FRAME = struct.Struct('!ci')
+CHUNK = 64 * 1024
+
+def gevent_socket(socket_path):
+    return socket_path + '.gevent'
+
+def preload():
+    # everything that makes a cold start slow
+    import gevent, gevent.pool, gevent.monkey
+    import pymongo, mongoengine
+    import regs_models
+    import pyquery, lxml.html
+    import urllib3
+
+    load_trie()
+
+def load_trie():
+    import time
+    from regs_common.entities import load_trie_from_mongo
+
+    start = time.time()
+    print '[%s] Loading trie...' % os.getpid()
+    load_trie_from_mongo(reload=True)
+    print '[%s] Loaded trie in %s seconds.' % (os.getpid(), time.time() - start)
+
+def _reset_connections():
+    # building the trie left the daemon with open Mongo connections, and every child
+    # would otherwise be talking over those same sockets, so make each open its own
+    from regs_common.gevent_mongo import Mongo
+    if hasattr(Mongo, '_instance'):
+        del Mongo._instance
+
+    from mongoengine import connection
+    connection._connections.clear()
+    connection._dbs.clear()
+
+def _reap(signum=None, frame=None):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+
+def _read_request(conn):
+    data = ''
+    while '\n' not in data:
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data)
+
+def _run_command(request, stdout, stderr):
+    """Run a command in this (freshly forked) process, with its output going to the given fds; doesn't return."""
+    code = 0
+    try:
+        _reset_connections()
+        os.chdir(request.get('cwd', os.getcwd()))
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+
+        from regs_common.commands.runner import run_command
+        run_command(['run.py'] + request['argv'])
+    except SystemExit as e:
+        code = e.code if type(e.code) is int else (1 if e.code else 0)
+    except:
+        traceback.print_exc()
+        code = 1
+
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+def _run_child(conn):
+    # put signal handling back the way a fresh interpreter would have it
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    code = 1
+    try:
+        request = _read_request(conn)
+
+        # the command runs in a child of its own, so that we can pass its two
+        # output streams along separately and find out how it exited
+        out_read, out_write = os.pipe()
+        err_read, err_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            os.close(out_read)
+            os.close(err_read)
+            _run_command(request, out_write, err_write)
+        os.close(out_write)
+        os.close(err_write)
+
+        streams = {out_read: 'o', err_read: 'e'}
+        while streams:
+            try:
+                readable = select.select(streams.keys(), [], [])[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                data = os.read(fd, CHUNK)
+                if data:
+                    conn.sendall(FRAME.pack(streams[fd], len(data)) + data)
+                else:
+                    os.close(fd)
+                    del streams[fd]
+
+        status = os.waitpid(pid, 0)[1]
+        # killed by a signal comes out the way a shell would report it
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+        conn.sendall(FRAME.pack('x', code))
+    except:
+        traceback.print_exc()
+    finally:
+        os._exit(code)
+
+def _serve(socket_path, others=[]):
+    preload()
+    # the trie's built, so nothing needs the connections it was built over any more
+    _reset_connections()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(64)
+
+    def stop(signum, frame):
+        for pid in others:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        listener.close()
+        os.unlink(socket_path)
+        os._exit(0)
+
+    def reload_trie(signum, frame):
+        for pid in others:
+            os.kill(pid, signal.SIGHUP)
+        load_trie()
+        _reset_connections()
+
+    signal.signal(signal.SIGCHLD, _reap)
+    signal.siginterrupt(signal.SIGCHLD, False)
+    signal.signal(signal.SIGHUP, reload_trie)
+    signal.signal(signal.SIGTERM, stop)
+
+    print '[%s] Worker daemon listening on %s' % (os.getpid(), socket_path)
+    while True:
+        try:
+            conn, address = listener.accept()
+        except socket.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            _run_child(conn)
+
+        conn.close()
+
+def serve(socket_path):
+    gevent_pid = os.fork()
+    if gevent_pid == 0:
+        from gevent.monkey import patch_all
+        patch_all()
+        _serve(gevent_socket(socket_path))
+        os._exit(0)
+
+    _serve(socket_path, others=[gevent_pid])
+
+def wants_gevent(argv):
+    """Whether a command should go to the gevent daemon, going by the same things the runner does."""
+    if not argv or argv[0].startswith('-'):
+        return False
+    if argv[0].endswith('.py'):
+        from regs_common.registry import describe_module
+        try:
+            return describe_module(argv[0])['gevent']
+        except (IOError, SyntaxError):
+            return False
+
+    from regs_common.registry import load_registry
+    registry = load_registry()
+    return registry[argv[0]]['gevent'] if argv[0] in registry else False
+
+def _recv_exactly(conn, size):
+    data = ''
+    while len(data) < size:
+        try:
+            chunk = conn.recv(size - len(data))
+        except socket.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def submit(socket_path, argv):
+    """Send a command to the daemon, copy its output to our stdout and stderr,
+    and return its exit status."""
+    if wants_gevent(argv):
+        socket_path = gevent_socket(socket_path)
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except socket.error as e:
+        sys.stderr.write('Could not connect to worker daemon at %s: %s\n' % (socket_path, e))
+        return 1
+
+    conn.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n')
+    conn.shutdown(socket.SHUT_WR)
+
+    outputs = {'o': sys.stdout, 'e': sys.stderr}
+    code = None
+    while code is None:
+        header = _recv_exactly(conn, FRAME.size)
+        if header is None:
+            sys.stderr.write('Worker daemon at %s hung up before the command finished\n' % socket_path)
+            code = 1
+            break
+
+        stream, length = FRAME.unpack(header)
+        if stream == 'x':
+            code = length
+        else:
+            data = _recv_exactly(conn, length)
+            if data is None:
+                continue
+            outputs[stream].write(data)
+            outputs[stream].flush()
+
+    conn.close()
+    return code
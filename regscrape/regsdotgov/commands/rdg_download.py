@@ -7,12 +7,17 @@ from optparse import OptionParser
 arg_parser = OptionParser()
 arg_parser.add_option("-a", "--agency", dest="agency", action="store", type="string", default=None, help="Specify an agency to which to limit the dump.")
 arg_parser.add_option("-d", "--docket", dest="docket", action="store", type="string", default=None, help="Specify a docket to which to limit the dump.")
+arg_parser.add_option("-x", "--extract", dest="extract", action="store_true", default=False, help="Extract text from each file as soon as it finishes downloading instead of waiting for the extract command.")
+arg_parser.add_option("-q", "--queue", dest="queue", action="store_true", default=False, help="Claim views from the view_tasks queue (see queue_views) instead of scanning all documents.")
 
 def run(options, args):
     # global imports hack so we don't mess up gevent loading
-    global pooled_bulk_download, settings, subprocess, os, urlparse, sys, traceback, datetime, pymongo, hashlib
-    from regs_common.processing import find_views, update_view, find_attachment_views, update_attachment_view
+    global pooled_bulk_download, ExtractionPool, view_status_func, view_save_error_func, ViewUpdateBatcher, view_tasks, blob_store, http_cache, gevent, settings, subprocess, os, urlparse, sys, traceback, datetime, pymongo, hashlib
+    from regs_common.processing import find_views, update_view, find_attachment_views, update_attachment_view, ViewUpdateBatcher
     from regs_common.transfer import pooled_bulk_download
+    from regs_common.extraction import ExtractionPool, view_status_func, view_save_error_func
+    from regs_common import view_tasks, blob_store, http_cache
+    import gevent
     import subprocess, os, urlparse, sys, traceback, datetime, hashlib
     import pymongo
     
@@ -36,10 +41,59 @@ def run_for_view_type(view_label, find_func, update_func, options):
     if options.docket:
         query['docket_id'] = options.docket
     
-    views = find_func(downloaded="no", query=query)
+    attachments = find_func.__name__ == 'find_attachment_views'
+    def get_views():
+        if options.queue:
+            # claim work from the shared task queue instead of scanning documents
+            return view_tasks.claimed_views('download', agency=options.agency, docket_id=options.docket, attachments=attachments, is_pending=lambda view: view.downloaded == "no")
+        return find_func(downloaded="no", query=query, checkpoint='rdg_download:%s:%s:%s' % (find_func.__name__, options.agency, options.docket))
+    views = get_views()
     
     # track stats -- no locks because yay for cooperative multitasking
     stats = {'downloaded': 0, 'failed': 0}
+
+    # in streaming mode, finished files go straight to a pool of extraction workers so that
+    # extraction overlaps with the rest of the downloads
+    extraction_pool = None
+    if options.extract:
+        stats['sent_to_extraction'] = 0
+        stats['extraction'] = {'extracted': 0, 'failed': 0}
+
+        # extraction results get their own batcher, since the download one hands off everything it writes
+        extraction_batcher = ViewUpdateBatcher(on_flush=view_tasks.completer('extract', lambda view: view.extracted == "yes") if options.queue else None, on_error=view_save_error_func(stats['extraction'], verbose=not options.parsable))
+        extract_status_func = view_status_func(getattr(extraction_batcher, update_func.__name__), stats['extraction'], verbose=not options.parsable)
+        # extraction times are kept apart from download times, so neither skews the other
+        extraction_pool = ExtractionPool(extract_status_func, verbose=not options.parsable, cooperative=True, on_wait=extraction_batcher.flush_if_due, metric='extraction')
+
+    # blob references that change once a view is saved: id(view) -> (old digest, new digest)
+    blob_changes = {}
+
+    # close out tasks and hand files off only once their downloaded state has actually been
+    # written, so that a late flush can't clobber what the extractor saves
+    def on_flush(records):
+        for record in records:
+            # the view now points at its new blob, so the old one (if any) can go
+            blob_change = blob_changes.pop(id(record['view']), None)
+            if blob_change and blob_change[0]:
+                blob_store.release(blob_change[0])
+
+            if options.queue:
+                # when we're extracting as we go there's no need to queue the extraction up separately
+                view_tasks.complete('download', record, 'done' if record['view'].downloaded == "yes" else 'failed', next_stage=None if extraction_pool else 'extract')
+
+            if extraction_pool and record['view'].downloaded == "yes":
+                extraction_pool.put((record['view'].file_path, record['view'].type, record))
+                stats['sent_to_extraction'] += 1
+
+    def on_error(record, error):
+        # the view still points wherever it did, so take back the reference to the new blob
+        blob_change = blob_changes.pop(id(record['view']), None)
+        if blob_change:
+            blob_store.release(blob_change[1])
+
+    # the batcher's methods are named after the unbatched functions they replace
+    batcher = ViewUpdateBatcher(on_flush=on_flush, on_error=on_error)
+    save_view = getattr(batcher, update_func.__name__)
     
     # hack around stupid Python closure behavior
     v_array = [views]
@@ -60,7 +114,7 @@ def run_for_view_type(view_label, find_func, update_func, options):
                 yield (fetch_url, save_path, result)
             except pymongo.errors.OperationFailure:
                 # occasionally pymongo seems to lose track of the cursor for some reason, so reset the query
-                v_array[0] = find_func(downloaded="no", query=query)
+                v_array[0] = get_views()
                 continue
             except StopIteration:
                 break
@@ -68,14 +122,52 @@ def run_for_view_type(view_label, find_func, update_func, options):
     def status_func(status, url, filename, result):
         if status[0]:
             result['view'].downloaded = "yes"
+            if blob_store.is_enabled():
+                # identical files get stored (and compressed) once; hashing and compressing
+                # happen in a thread so the other downloads carry on meanwhile
+                threadpool = gevent.get_hub().threadpool
+                digest = None
+                try:
+                    digest = threadpool.apply(blob_store.file_digest, (filename,))
+                    # count the reference before looking for the blob, so blob_gc can't delete it
+                    # out from under us; the old one is released once the view is saved
+                    blob_store.add_ref(digest)
+                    filename = threadpool.apply(blob_store.put, (filename, digest))
+                    blob_changes[id(result['view'])] = (blob_store.digest_of(result['view'].file_path), digest)
+                    http_cache.stored_as_blob(url, filename)
+                except (IOError, OSError) as e:
+                    # it's still perfectly usable where it is
+                    print 'Failed to move %s into the blob store: %s' % (filename, e)
+                    if digest:
+                        blob_store.release(digest)
             result['view'].file_path = filename
             stats['downloaded'] += 1
         else:
             result['view'].downloaded = "failed"
             stats['failed'] += 1
-        update_func(**result)
+        save_view(**result)
     
+    # downloads can go quiet for a while (a slow host, a long backoff), so don't leave what's
+    # already finished sitting unsaved until the next one comes in, and don't let the leases
+    # on what's still waiting run out either
+    def flush_periodically():
+        while True:
+            gevent.sleep(1)
+            batcher.flush_if_due()
+            if extraction_pool:
+                extraction_batcher.flush_if_due()
+            if options.queue:
+                view_tasks.keep_alive()
+    flusher = gevent.spawn(flush_periodically)
+
     pooled_bulk_download(download_generator(), status_func, verbose=not options.parsable, min_size=MIN_SIZE)
+    flusher.kill()
+    batcher.close()
+
+    if extraction_pool:
+        print 'Waiting for extraction of %s to finish.' % view_label
+        extraction_pool.close()
+        extraction_batcher.close()
 
     print 'Done with %s.' % view_label
     
@@ -9,6 +9,7 @@ def run(options, args):
     import os, time, sys
     from regsdotgov.search import search, parsed_search
     from regs_common.transfer import download
+    from regs_common import rate_limit
 
     search_args = {
         # order ascending by posted date to reduce pagination errors
@@ -51,8 +52,9 @@ def run(options, args):
             except (urllib2.HTTPError, httplib.HTTPException) as e:
                 if i < 2:
                     if hasattr(e, 'code') and e.code in (503, 429) and 'rate' in e.read().lower():
-                        print 'Download failed because of rate limiting; will retry in an hour...'
-                        time.sleep(3600)
+                        # the shared limiter makes the next search (and everyone else's requests) wait it out
+                        print 'Download failed because of rate limiting; backing off...'
+                        rate_limit.back_off(rate_limit.for_host('api.data.gov'), 3600)
                     else:
                         print 'Download failed; will retry in 10 seconds...'
                         time.sleep(10)
@@ -12,6 +12,9 @@ import json
 import re
 from regs_common.tmp_redis import TmpRedis
 from regs_common.mp_types import Counter
+from regs_common.profiling import profiled
+from regs_common.cursors import resumable_find
+from regs_common import metrics
 from regs_common.util import listify
 from regsdotgov.document import make_view
 from regs_models import *
@@ -96,7 +99,9 @@ def reconcile_worker(todo_queue, cache_wrapper, now, repaired_counter, updated_c
     while True:
         record = todo_queue.get()
         
+        start = time.time()
         reconcile_process(record, cache, db, now, repaired_counter, updated_counter, deleted_counter)
+        metrics.observe(time.time() - start)
         
         todo_queue.task_done()
     
@@ -139,7 +144,7 @@ def reconcile_dumps(options, cache_wrapper, now):
     
     processes = []
     for i in range(num_workers):
-        proc = multiprocessing.Process(target=reconcile_worker, args=(todo_queue, cache_wrapper, now, repaired_counter, updated_counter, deleted_counter))
+        proc = multiprocessing.Process(target=profiled(reconcile_worker), args=(todo_queue, cache_wrapper, now, repaired_counter, updated_counter, deleted_counter))
         proc.start()
         processes.append(proc)
     
@@ -153,18 +158,9 @@ def reconcile_dumps(options, cache_wrapper, now):
         conditions['docket_id'] = options.docket
 
     fields = {'_id': 1, 'scraped': 1, 'views.downloaded': 1, 'views.type': 1, 'attachments.views.downloaded': 1, 'attachments.views.type': 1, 'attachments.object_id': 1}
-    to_check = db.docs.find(conditions, fields)
+    checkpoint = 'rdg_parse_api:reconcile:%s:%s' % (options.agency, options.docket)
     
-    while True:
-        try:
-            record = to_check.next()
-        except pymongo.errors.OperationFailure:
-            print 'OH NOES!'
-            to_scrape = db.docs.find(conditions, fields)
-            continue
-        except StopIteration:
-            break
-            
+    for record in resumable_find(db.docs, conditions, fields, checkpoint=checkpoint):
         todo_queue.put(record)
     
     todo_queue.join()
@@ -241,7 +237,7 @@ def parse_dumps(options, cache_wrapper):
     sys.stdout.write('Starting parser workers...\n')
     processes = []
     for i in range(num_workers):
-        proc = multiprocessing.Process(target=parser_worker, args=(todo_queue, done_queue, cache_wrapper))
+        proc = multiprocessing.Process(target=profiled(parser_worker), args=(todo_queue, done_queue, cache_wrapper))
         proc.start()
         processes.append(proc)
     
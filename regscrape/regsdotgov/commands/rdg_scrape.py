@@ -7,12 +7,14 @@ import urllib2, urllib3
 import sys
 import os
 import traceback
-import pymongo
 import time
 
 import multiprocessing
 from Queue import Empty
 from regs_common.mp_types import Counter
+from regs_common.profiling import profiled
+from regs_common.cursors import resumable_find
+from regs_common import metrics
 from regs_common.exceptions import DoesNotExist, RateLimitException
 
 from optparse import OptionParser
@@ -45,8 +47,8 @@ def process_record(record, num_succeeded, num_failed, cpool):
         except KeyboardInterrupt:
             raise
         except RateLimitException:
+            # ddg_request has already backed off, so the retry waits its turn in the shared limiter
             print '### Warning: scrape failed on try %s because of RATE LIMIT' % i
-            time.sleep(3600)
         except:
             print 'Warning: scrape failed on try %s' % i
             error = sys.exc_info()
@@ -88,7 +90,9 @@ def worker(todo_queue, num_succeeded, num_failed):
     while True:
         record = Doc._from_son(todo_queue.get())
         
+        start = time.time()
         process_record(record, num_succeeded, num_failed, cpool)
+        metrics.observe(time.time() - start)
         
         todo_queue.task_done()
 
@@ -107,7 +111,7 @@ def run(options, args):
     
     processes = []
     for i in range(num_workers):
-        proc = multiprocessing.Process(target=worker, args=(todo_queue, num_succeeded, num_failed))
+        proc = multiprocessing.Process(target=profiled(worker), args=(todo_queue, num_succeeded, num_failed))
         proc.start()
         processes.append(proc)
     
@@ -116,18 +120,11 @@ def run(options, args):
         conditions['agency'] = options.agency
     if options.docket:
         conditions['docket_id'] = options.docket
-    to_scrape = Doc.objects(**conditions).only('id', 'last_seen', 'created', 'views', 'attachments')
+    fields = {'_id': 1, 'last_seen': 1, 'created': 1, 'views': 1, 'attachments': 1}
+    checkpoint = 'rdg_scrape:%s:%s' % (options.agency, options.docket)
     
-    while True:
-        try:
-            record = to_scrape.next()
-        except pymongo.errors.OperationFailure:
-            to_scrape = Doc.objects(**conditions).only('id', 'last_seen', 'created', 'views', 'attachments')
-            continue
-        except StopIteration:
-            break
-            
-        todo_queue.put(record.to_mongo())
+    for record in resumable_find(Doc._get_db().docs, conditions, fields, checkpoint=checkpoint):
+        todo_queue.put(record)
     
     todo_queue.join()
     
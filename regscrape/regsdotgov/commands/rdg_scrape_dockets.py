@@ -13,6 +13,8 @@ import time
 import multiprocessing
 from Queue import Empty
 from regs_common.mp_types import Counter
+from regs_common.profiling import profiled
+from regs_common import metrics
 from regs_common.exceptions import DoesNotExist, RateLimitException
 
 from optparse import OptionParser
@@ -44,8 +46,8 @@ def process_record(record, num_succeeded, num_failed, cpool):
         except KeyboardInterrupt:
             raise
         except RateLimitException:
+            # ddg_request has already backed off, so the retry waits its turn in the shared limiter
             print '### Warning: scrape failed on try %s because of RATE LIMIT' % i
-            time.sleep(3600)
         except:
             error = sys.exc_info()
             print 'Warning: scrape failed on try %s' % i
@@ -72,7 +74,9 @@ def worker(todo_queue, num_succeeded, num_failed):
     while True:
         record = todo_queue.get()
         
+        start = time.time()
         process_record(record, num_succeeded, num_failed, cpool)
+        metrics.observe(time.time() - start)
         
         todo_queue.task_done()
 
@@ -91,7 +95,7 @@ def run(options, args):
     
     processes = []
     for i in range(num_workers):
-        proc = multiprocessing.Process(target=worker, args=(todo_queue, num_succeeded, num_failed))
+        proc = multiprocessing.Process(target=profiled(worker), args=(todo_queue, num_succeeded, num_failed))
         proc.start()
         processes.append(proc)
         
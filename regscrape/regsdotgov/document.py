@@ -5,9 +5,12 @@ from regs_common.exceptions import DoesNotExist, RateLimitException
 from pytz import timezone
 import dateutil.parser
 import datetime
+import cStringIO
 from settings import RDG_API_KEY, DDG_API_KEY
 from regs_models import *
 from regs_common.util import listify, crockford_hash
+from regs_common import rate_limit
+from regs_common import http_cache
 from name_cleaver import IndividualNameCleaver
 
 DATE_FORMAT = re.compile('^(?P<month>\w+) (?P<day>\d{2}) (?P<year>\d{4}), at (?P<hour>\d{2}):(?P<minute>\d{2}) (?P<ampm>\w{2}) (?P<timezone>[\w ]+)$')
@@ -34,21 +37,58 @@ def check_date(value):
 
 RATE_CODES = set([503, 429])
 def ddg_request(url, cpool=None):
+    # responses we've seen before come from the local cache: without asking at all
+    # if they're still fresh, and otherwise if the server says they haven't changed
+    cached = http_cache.lookup(url)
+    if cached and http_cache.is_fresh(cached):
+        return http_cache.open_body(cached)
+
+    request_headers = {'Accept': 'application/json,*/*'}
+    if cached:
+        request_headers.update(http_cache.conditional_headers(cached))
+
+    # wait our turn with everything else on this host that's using the key
+    limiter = rate_limit.for_url(url)
+    if limiter:
+        limiter.acquire()
+
     if cpool:
-        response = cpool.urlopen("GET", url, headers={'Accept': 'application/json,*/*'}, preload_content=False)
+        response = cpool.urlopen("GET", url, headers=request_headers, preload_content=False)
         if response.status in RATE_CODES:
             if 'rate' in response.read().lower():
+                rate_limit.back_off(limiter, 3600)
                 raise RateLimitException()
-        return response
+        status, headers = response.status, response.headers
     else:
-        req = urllib2.Request(url, headers={'Accept': 'application/json,*/*'})
+        req = urllib2.Request(url, headers=request_headers)
         try:
             response = urllib2.urlopen(req)
-            return response
+            status, headers = response.getcode(), response.info()
         except urllib2.HTTPError as e:
-            if e.code in RATE_CODES and 'rate' in e.read().lower():
+            if e.code == 304 and cached:
+                # urllib2 counts this as an error, but it's the best kind of answer
+                response, status, headers = e, 304, e.info()
+            elif e.code in RATE_CODES and 'rate' in e.read().lower():
+                rate_limit.back_off(limiter, 3600)
                 raise RateLimitException()
-            raise
+            else:
+                raise
+
+    if limiter:
+        # a 503 that isn't about the rate limit gets this far with the pool, and it's no success
+        if status < 400:
+            limiter.succeeded()
+        rate_limit.remaining_from_headers(limiter, headers)
+
+    if status == 304 and cached:
+        response.read()
+        http_cache.revalidated(url, cached, headers)
+        return http_cache.open_body(cached)
+    elif status == 200 and http_cache.is_enabled():
+        body = response.read()
+        http_cache.store(url, headers, body=body)
+        return cStringIO.StringIO(body)
+    return response
 
 def _v1_get_document(id, cpool=None):
     url_args = {
@@ -2,6 +2,7 @@ import urllib2
 import json
 import datetime
 from regs_common.util import listify
+from regs_common import rate_limit
 from regs_models import *
 
 from settings import RDG_API_KEY, DDG_API_KEY
@@ -37,8 +38,17 @@ def _v3_search(per_page, position, **args):
         url_args[ARG_NAMES.get(key, key)] = value
     
     url = "http://api.data.gov/regulations/v3/documents.json?" + '&'.join(['%s=%s' % arg for arg in url_args.items()])
+    limiter = rate_limit.for_url(url)
+    if limiter:
+        limiter.acquire()
+
     req = urllib2.Request(url, headers={'Accept': 'application/json,*/*'})
-    return urllib2.urlopen(req)
+    response = urllib2.urlopen(req)
+
+    if limiter:
+        limiter.succeeded()
+        rate_limit.remaining_from_headers(limiter, response.info())
+    return response
 
 search = _v3_search
 
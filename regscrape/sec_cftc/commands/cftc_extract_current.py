@@ -8,6 +8,7 @@ from optparse import OptionParser
 import settings
 
 from regs_common.util import crockford_hash
+from regs_common import blob_store
 from regs_models import *
 
 # FIXME: split this out
@@ -31,7 +32,7 @@ def run(options, args):
     parser = etree.HTMLParser()
     for doc in Doc.objects(**query):
         print "Processing %s..." % doc.id
-        page_data = open(doc.views[0].file_path).read()
+        page_data = blob_store.open_file(doc.views[0].file_path).read()
         page = pq(etree.fromstring(page_data, parser))
         
         text_block = page('.dyn_wrap div.ClearBoth')